@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# #########################################################################
+# Copyright (c) 2015, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2015. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+
+"""
+Pluggable FFT backend.
+
+All the FFTs of wavepy are calculated with the functions of this module,
+which have the same signature of their counterparts in :py:mod:`numpy.fft`,
+with the backend selected by :py:func:`set_backend`:
+
+* ``'numpy'``: :py:mod:`numpy.fft` (single thread).
+* ``'scipy'``: :py:mod:`scipy.fft`, with ``workers`` threads. scipy keeps
+  its own cache of plans.
+* ``'pyfftw'``: `pyFFTW <https://pyfftw.readthedocs.io>`_ (if installed),
+  with ``workers`` threads. The FFTW plans are cached for each transform,
+  shape and dtype of the input, and for each value of the other parameters.
+  The plans are created with ``FFTW_ESTIMATE``, and replaced by a plan
+  created with ``FFTW_MEASURE`` when the same shape is transformed
+  repeatedly, so shapes used only a few times (for instance batches of
+  different sizes) are not measured. The FFTW wisdom is reused for new
+  plans. As in :py:mod:`numpy.fft`, the input is never overwritten.
+
+The initial backend and number of threads are given by the environment
+variables ``WAVEPY_FFT_BACKEND`` and ``WAVEPY_FFT_WORKERS``, or ``'numpy'``
+and 1. As for ``scipy.fft``, a negative number of threads counts from the
+number of cpu's (``-1`` for all of them).
+
+Example
+-------
+
+>>> import wavepy.fft as wpfft
+>>> wpfft.set_backend('scipy', workers=8)
+>>> with wpfft.use_backend('pyfftw', workers=-1):
+...     res = single_2Dgrating_analyses(img, img_ref, harmonicPeriod)
+
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import contextlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from numpy.fft import fftshift, ifftshift, fftfreq, rfftfreq
+
+
+__authors__ = "Walan Grizolli"
+__copyright__ = "Copyright (c) 2016-2017, Argonne National Laboratory"
+__version__ = "0.1.0"
+__docformat__ = "restructuredtext en"
+__all__ = ['clear_plan_cache', 'fft', 'fft2', 'fftfreq', 'fftn', 'fftshift',
+           'get_backend', 'ifft', 'ifft2', 'ifftn', 'ifftshift', 'irfft',
+           'irfft2', 'rfft', 'rfft2', 'rfftfreq', 'set_backend',
+           'use_backend']
+
+
+_BACKENDS = ('numpy', 'scipy', 'pyfftw')
+
+# maximum number of cached pyFFTW plans
+_PLAN_CACHE_SIZE = 64
+
+# number of uses of a pyFFTW plan before it is replaced by a measured plan
+_MEASURE_AFTER = 4
+
+# complex to real transforms, which FFTW calculates overwriting the input
+_C2R_TRANSFORMS = ('irfft', 'irfft2')
+
+_state = {'backend': 'numpy', 'workers': 1, 'module': np.fft}
+
+_plans = OrderedDict()
+_plans_lock = threading.Lock()
+
+
+def _backend_module(backend):
+    """
+    Module with the FFT functions of ``backend``.
+    """
+
+    if backend not in _BACKENDS:
+        raise ValueError('wavepy: FFT backend must be one of ' +
+                         ', '.join(_BACKENDS) + '.')
+
+    if backend == 'numpy':
+        return np.fft
+
+    elif backend == 'scipy':
+        import scipy.fft
+        return scipy.fft
+
+    else:
+        try:
+            import pyfftw
+        except ImportError:
+            raise ImportError('wavepy: FFT backend pyfftw requires pyFFTW.')
+        import pyfftw.builders
+        return pyfftw.builders
+
+
+def set_backend(backend='numpy', workers=None):
+    '''
+    Select the backend of all the FFTs of wavepy.
+
+    Parameters
+    ----------
+    backend : str
+        ``'numpy'``, ``'scipy'`` or ``'pyfftw'``.
+
+    workers : int
+        number of threads used by the ``'scipy'`` and ``'pyfftw'`` backends.
+        Negative values count from the number of cpu's (``-1`` for all of
+        them). Default is 1.
+
+    '''
+
+    if workers is None:
+        workers = 1
+
+    if int(workers) != workers or workers == 0:
+        raise ValueError('wavepy: workers must be a non zero integer.')
+
+    _state['module'] = _backend_module(backend)
+    _state['backend'] = backend
+    _state['workers'] = int(workers)
+
+
+def get_backend():
+    '''
+    Returns
+    -------
+    str, int
+        current backend and number of threads, see :py:func:`set_backend`.
+    '''
+
+    return _state['backend'], _state['workers']
+
+
+@contextlib.contextmanager
+def use_backend(backend='numpy', workers=None):
+    '''
+    Context manager to use ``backend`` (see :py:func:`set_backend`) only in
+    a block of code. The previous backend is restored at the end of the
+    block.
+    '''
+
+    previous = get_backend()
+
+    set_backend(backend, workers)
+
+    try:
+        yield
+    finally:
+        set_backend(*previous)
+
+
+def clear_plan_cache():
+    '''
+    Remove all cached plans of the ``'pyfftw'`` backend.
+    '''
+
+    with _plans_lock:
+        _plans.clear()
+
+
+def _nthreads(workers):
+    """
+    Number of threads for ``workers``, see :py:func:`set_backend`.
+    """
+
+    if workers < 0:
+        return max(1, (os.cpu_count() or 1) + 1 + workers)
+
+    return workers
+
+
+def _fftw_input(a):
+    """
+    ``a`` as an array with a data type supported by FFTW.
+    """
+
+    a = np.asarray(a)
+
+    if a.dtype in (np.float32, np.float64, np.complex64, np.complex128):
+        return a
+    elif a.dtype.kind == 'c':
+        return a.astype(np.complex128)
+    else:
+        return a.astype(np.float64)
+
+
+def _transform(name, a, **kwargs):
+    """
+    Calculate the transform ``name`` (for instance ``'fft2'``) of ``a`` with
+    the current backend.
+    """
+
+    backend = _state['backend']
+    module = _state['module']
+
+    if backend == 'numpy':
+        return getattr(module, name)(a, **kwargs)
+
+    elif backend == 'scipy':
+        return getattr(module, name)(a, workers=_state['workers'], **kwargs)
+
+    a = _fftw_input(a)
+    nthreads = _nthreads(_state['workers'])
+
+    key = (name, a.shape, a.dtype.str, tuple(sorted(kwargs.items())),
+           nthreads)
+
+    # a plan is removed from the cache while it is used, so concurrent calls
+    # (from different threads) never share its internal arrays
+    with _plans_lock:
+        plan, uses = _plans.pop(key, (None, 0))
+
+    uses += 1
+
+    if plan is None or uses == _MEASURE_AFTER:
+        import pyfftw
+        effort = 'FFTW_MEASURE' if uses >= _MEASURE_AFTER else 'FFTW_ESTIMATE'
+        plan = getattr(module, name)(pyfftw.empty_aligned(a.shape,
+                                                          dtype=a.dtype),
+                                     threads=nthreads,
+                                     planner_effort=effort,
+                                     **kwargs)
+
+    if name in _C2R_TRANSFORMS:
+        # FFTW overwrites the input of these transforms, so it is
+        # calculated on a copy of a
+        result = plan(a.copy()).copy()
+    else:
+        result = plan(a).copy()
+
+    with _plans_lock:
+        _plans[key] = (plan, uses)
+        while len(_plans) > _PLAN_CACHE_SIZE:
+            _plans.popitem(last=False)
+
+    return result
+
+
+def _keywords(**kwargs):
+    """
+    Remove the parameters with default values (``None``), so the defaults
+    of each backend are used. Sequences (shapes and axes) are converted to
+    tuples, to be used in the keys of the cache of plans.
+    """
+
+    return {key: (tuple(value) if np.iterable(value) and
+                  not isinstance(value, str) else value)
+            for key, value in kwargs.items() if value is not None}
+
+
+def fft(a, n=None, axis=-1, norm=None):
+    '''
+    1D FFT, see :py:func:`numpy.fft.fft`.
+    '''
+    return _transform('fft', a, axis=axis, **_keywords(n=n, norm=norm))
+
+
+def ifft(a, n=None, axis=-1, norm=None):
+    '''
+    1D inverse FFT, see :py:func:`numpy.fft.ifft`.
+    '''
+    return _transform('ifft', a, axis=axis, **_keywords(n=n, norm=norm))
+
+
+def rfft(a, n=None, axis=-1, norm=None):
+    '''
+    1D FFT of real input, see :py:func:`numpy.fft.rfft`.
+    '''
+    return _transform('rfft', a, axis=axis, **_keywords(n=n, norm=norm))
+
+
+def irfft(a, n=None, axis=-1, norm=None):
+    '''
+    Inverse of :py:func:`rfft`, see :py:func:`numpy.fft.irfft`.
+    '''
+    return _transform('irfft', a, axis=axis, **_keywords(n=n, norm=norm))
+
+
+def fft2(a, s=None, axes=(-2, -1), norm=None):
+    '''
+    2D FFT, see :py:func:`numpy.fft.fft2`.
+    '''
+    return _transform('fft2', a, **_keywords(s=s, axes=axes, norm=norm))
+
+
+def ifft2(a, s=None, axes=(-2, -1), norm=None):
+    '''
+    2D inverse FFT, see :py:func:`numpy.fft.ifft2`.
+    '''
+    return _transform('ifft2', a, **_keywords(s=s, axes=axes, norm=norm))
+
+
+def rfft2(a, s=None, axes=(-2, -1), norm=None):
+    '''
+    2D FFT of real input, see :py:func:`numpy.fft.rfft2`.
+    '''
+    return _transform('rfft2', a, **_keywords(s=s, axes=axes, norm=norm))
+
+
+def irfft2(a, s=None, axes=(-2, -1), norm=None):
+    '''
+    Inverse of :py:func:`rfft2`, see :py:func:`numpy.fft.irfft2`.
+    '''
+    return _transform('irfft2', a, **_keywords(s=s, axes=axes, norm=norm))
+
+
+def fftn(a, s=None, axes=None, norm=None):
+    '''
+    N-dimensional FFT, see :py:func:`numpy.fft.fftn`.
+    '''
+    return _transform('fftn', a, **_keywords(s=s, axes=axes, norm=norm))
+
+
+def ifftn(a, s=None, axes=None, norm=None):
+    '''
+    N-dimensional inverse FFT, see :py:func:`numpy.fft.ifftn`.
+    '''
+    return _transform('ifftn', a, **_keywords(s=s, axes=axes, norm=norm))
+
+
+set_backend(os.environ.get('WAVEPY_FFT_BACKEND', 'numpy'),
+            int(os.environ.get('WAVEPY_FFT_WORKERS', 1)))
@@ -72,10 +72,17 @@ case.
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import glob
+import hashlib
+import itertools
+import os
+
+import h5py
 import numpy as np
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 import wavepy.utils as wpu
+import wavepy.fft as wpfft
 import wavepy.surface_from_grad as wps
 from skimage.restoration import unwrap_phase
 
@@ -87,7 +94,13 @@ __docformat__ = "restructuredtext en"
 __all__ = ['exp_harm_period', 'extract_harmonic',
            'plot_harmonic_grid', 'plot_harmonic_peak',
            'single_grating_harmonic_images', 'single_2Dgrating_analyses',
-           'visib_1st_harmonics']
+           'single_2Dgrating_analyses_stack', 'visib_1st_harmonics',
+           'reference_cache_dir', 'clear_reference_cache']
+
+
+# default maximum total size (in bytes) of the cache of reference images,
+# see reference_cache_dir
+_REFERENCE_CACHE_SIZE = 2**30
 
 
 def _idxPeak_ij(harV, harH, nRows, nColumns, periodVert, periodHor):
@@ -98,29 +111,125 @@ def _idxPeak_ij(harV, harH, nRows, nColumns, periodVert, periodHor):
     return [nRows // 2 + harV * periodVert, nColumns // 2 + harH * periodHor]
 
 
-def _idxPeak_ij_exp(imgFFT, harV, harH, periodVert, periodHor, searchRegion):
+class _HalfSpectrum(object):
     """
-    Returns the index of the maximum intensity in a harmonic sub image.
+    FFT of a real image, stored as the half spectrum calculated with
+    :py:func:`wavepy.fft.rfft2` (``norm='ortho'``). Slicing returns the same
+    values of the shifted full FFT, ``fftshift(fft2(img, norm='ortho'))``,
+    using the Hermitian symmetry of the FFT of real data, so the full
+    spectrum (and its ``fftshift`` copy) is never calculated.
+    Only the requested sub arrays (the harmonics and the search regions of
+    the peaks) are assembled.
+    """
+
+    def __init__(self, img):
+
+        self.rfft = wpfft.rfft2(img, norm='ortho')
+        self.shape = np.shape(img)
+        self.dtype = self.rfft.dtype
+
+    @classmethod
+    def from_rfft(cls, rfft, shape):
+        """
+        Half spectrum from ``rfft``, the result of ``rfft2(img,
+        norm='ortho')`` for a real image with ``shape``. Used to extract the
+        harmonics of a stack of images transformed with a single (batched)
+        FFT.
+        """
+
+        half_spectrum = cls.__new__(cls)
+        half_spectrum.rfft = rfft
+        half_spectrum.shape = tuple(shape)
+        half_spectrum.dtype = rfft.dtype
+
+        return half_spectrum
+
+    def __getitem__(self, key):
+
+        (nRows, nColumns) = self.shape
+
+        idx_i = np.arange(nRows)[key[0]]
+        idx_j = np.arange(nColumns)[key[1]]
+
+        # indexes in the unshifted FFT
+        k = (np.atleast_1d(idx_i) - nRows // 2) % nRows
+        el = (np.atleast_1d(idx_j) - nColumns // 2) % nColumns
+
+        # negative frequencies: F[k, l] = conj(F[-k, -l])
+        negative = el > nColumns // 2
+
+        block = np.empty((k.size, el.size), dtype=self.dtype)
+        block[:, ~negative] = self.rfft[np.ix_(k, el[~negative])]
+        block[:, negative] = np.conj(self.rfft[np.ix_(-k % nRows,
+                                                      nColumns -
+                                                      el[negative])])
+
+        return block.reshape(np.shape(idx_i) + np.shape(idx_j))
+
+    def __array__(self, dtype=None, copy=None):
+
+        return np.asarray(self[:, :], dtype=dtype)
+
+
+def _idxPeak_ij_exp(imgFFT, harV, harH, periodVert, periodHor, searchRegion,
+                    subpixel=False):
     """
+    Returns the index of the maximum intensity in a harmonic sub image.
 
-    intensity = (np.abs(imgFFT))
+    Only the ``2*searchRegion x 2*searchRegion`` box around the theoretical
+    position of the harmonic peak is used, so the cost does not depend on the
+    size of ``imgFFT``. If ``subpixel`` is ``True``, the position of the
+    maximum is refined with the maximum and its two neighbours in each
+    direction (see :py:func:`_peak_offset`), and the (float) indexes are
+    returned.
+    """
 
     (nRows, nColumns) = imgFFT.shape
 
     idxPeak_ij = _idxPeak_ij(harV, harH, nRows, nColumns,
                              periodVert, periodHor)
 
-    maskSearchRegion = np.zeros((nRows, nColumns))
+    i0 = min(max(idxPeak_ij[0] - searchRegion, 0), nRows)
+    j0 = min(max(idxPeak_ij[1] - searchRegion, 0), nColumns)
+
+    intensity = np.abs(imgFFT[i0:idxPeak_ij[0] + searchRegion,
+                              j0:idxPeak_ij[1] + searchRegion])
+
+    (i, j) = np.unravel_index(np.argmax(intensity), intensity.shape)
+
+    idxPeak_ij_exp = [i0 + i, j0 + j]
+
+    if subpixel:
+
+        (i, j) = idxPeak_ij_exp
 
-    maskSearchRegion[idxPeak_ij[0] - searchRegion:
-                     idxPeak_ij[0] + searchRegion,
-                     idxPeak_ij[1] - searchRegion:
-                     idxPeak_ij[1] + searchRegion] = 1.0
+        if 0 < i < nRows - 1:
+            idxPeak_ij_exp[0] = i + _peak_offset(
+                np.abs(imgFFT[i - 1:i + 2, j]))
+
+        if 0 < j < nColumns - 1:
+            idxPeak_ij_exp[1] = j + _peak_offset(
+                np.abs(imgFFT[i, j - 1:j + 2]))
+
+    return idxPeak_ij_exp
+
+
+def _peak_offset(values):
+    """
+    Position, relative to the central point, of the maximum of the peak
+    sampled by the three equally spaced ``values``, from the ratio of the
+    central value and its largest neighbour. This is exact for the modulus of
+    the FFT of a pure harmonic (a sinc peak). Returns zero if the central
+    point is not a maximum.
+    """
 
-    idxPeak_ij_exp = np.where(intensity * maskSearchRegion ==
-                              np.max(intensity * maskSearchRegion))
+    if values[1] < values[0] or values[1] < values[2] or values[1] <= 0:
+        return 0.0
 
-    return [idxPeak_ij_exp[0][0], idxPeak_ij_exp[1][0]]
+    if values[2] > values[0]:
+        return float(values[2] / (values[1] + values[2]))
+    else:
+        return -float(values[0] / (values[1] + values[0]))
 
 
 def _check_harmonic_inside_image(harV, harH, nRows, nColumns,
@@ -150,10 +259,12 @@ def _check_harmonic_inside_image(harV, harH, nRows, nColumns,
 
 
 def _error_harmonic_peak(imgFFT, harV, harH,
-                         periodVert, periodHor, searchRegion=10):
+                         periodVert, periodHor, searchRegion=10,
+                         subpixel=False):
     """
     Error in pixels (in the reciprocal space) between the harmonic peak and
-    the provided theoretical value
+    the provided theoretical value. See :py:func:`_idxPeak_ij_exp` for
+    ``subpixel``.
     """
 
     (nRows, nColumns) = imgFFT.shape
@@ -164,7 +275,8 @@ def _error_harmonic_peak(imgFFT, harV, harH,
                              periodVert, periodHor)
 
     idxPeak_ij_exp = _idxPeak_ij_exp(imgFFT, harV, harH,
-                                     periodVert, periodHor, searchRegion)
+                                     periodVert, periodHor, searchRegion,
+                                     subpixel=subpixel)
 
     del_i = idxPeak_ij_exp[0] - idxPeak_ij[0]
     del_j = idxPeak_ij_exp[1] - idxPeak_ij[1]
@@ -174,10 +286,14 @@ def _error_harmonic_peak(imgFFT, harV, harH,
 
 def exp_harm_period(img, harmonicPeriod,
                     harmonic_ij='00', searchRegion=10,
-                    isFFT=False, verbose=True):
+                    isFFT=False, subpixel=False, verbose=True):
     """
     Function to obtain the position (in pixels) in the reciprocal space
     of the first harmonic ().
+
+    If ``subpixel`` is ``True``, the position of the harmonic peak is refined
+    with its neighbours, and the (float) period is returned with subpixel
+    resolution.
     """
 
     (nRows, nColumns) = img.shape
@@ -205,17 +321,18 @@ def exp_harm_period(img, harmonicPeriod,
     if isFFT:
         imgFFT = img
     else:
-        imgFFT = np.fft.fftshift(np.fft.fft2(img, norm='ortho'))
+        imgFFT = _HalfSpectrum(img)
 
     del_i, del_j = _error_harmonic_peak(imgFFT, harV, harH,
                                         periodVert, periodHor,
-                                        searchRegion)
+                                        searchRegion, subpixel=subpixel)
 
     if verbose:
+        fmt = '{:.2f}' if subpixel else '{:d}'
         wpu.print_blue("MESSAGE: error experimental harmonics " +
-                       "vertical: {:d}".format(del_i))
+                       "vertical: " + fmt.format(del_i))
         wpu.print_blue("MESSAGE: error experimental harmonics " +
-                       "horizontal: {:d}".format(del_j))
+                       "horizontal: " + fmt.format(del_j))
 
     return periodVert + del_i, periodHor + del_j
 
@@ -343,9 +460,7 @@ def extract_harmonic(img, harmonicPeriod,
     if isFFT:
         imgFFT = img
     else:
-        imgFFT = np.fft.fftshift(np.fft.fft2(img, norm='ortho'))
-
-    intensity = (np.abs(imgFFT))
+        imgFFT = _HalfSpectrum(img)
 
     #  Estimate harmonic positions
     idxPeak_ij = _idxPeak_ij(harV, harH, nRows, nColumns,
@@ -377,7 +492,7 @@ def extract_harmonic(img, harmonicPeriod,
 
         from matplotlib.patches import Rectangle
         plt.figure(figsize=(8, 7))
-        plt.imshow(np.log10(intensity), cmap='inferno')
+        plt.imshow(np.log10(np.abs(imgFFT)), cmap='inferno')
 
         plt.gca().add_patch(Rectangle((idxPeak_ij[1] - periodHor//2,
                                       idxPeak_ij[0] - periodVert//2),
@@ -423,7 +538,7 @@ def plot_harmonic_grid(img, harmonicPeriod=None, isFFT=False):
     """
 
     if not isFFT:
-        imgFFT = np.fft.fftshift(np.fft.fft2(np.fft.fftshift(img),
+        imgFFT = wpfft.fftshift(wpfft.fft2(wpfft.fftshift(img),
                                              norm='ortho'))
     else:
         imgFFT = img
@@ -506,7 +621,7 @@ def plot_harmonic_peak(img, harmonicPeriod=None, isFFT=False, fname=None):
     """
 
     if not isFFT:
-        imgFFT = np.fft.fftshift(np.fft.fft2(np.fft.fftshift(img),
+        imgFFT = wpfft.fftshift(wpfft.fft2(wpfft.fftshift(img),
                                              norm='ortho'))
     else:
         imgFFT = img
@@ -571,6 +686,10 @@ def single_grating_harmonic_images(img, harmonicPeriod,
     Auxiliary function to process the data of single 2D grating Talbot imaging.
     It obtain the (real space) harmonic images  00, 01 and 10.
 
+    Since ``img`` is real, only half of its FFT is calculated (with
+    :py:func:`wavepy.fft.rfft2`), and the harmonics are extracted from it using
+    the Hermitian symmetry of the spectrum.
+
     Parameters
     ----------
     img : 	ndarray – Data (data_exchange format)
@@ -603,10 +722,28 @@ def single_grating_harmonic_images(img, harmonicPeriod,
 
     """
 
-    imgFFT = np.fft.fftshift(np.fft.fft2(img, norm='ortho'))
+    imgFFT = _HalfSpectrum(img)
+
+    (imgFFT00,
+     imgFFT01,
+     imgFFT10) = _extract_harmonics(imgFFT, harmonicPeriod, searchRegion,
+                                    plotFlag=plotFlag, verbose=verbose)
+
+    return (_harmonic_images(imgFFT00),
+            _harmonic_images(imgFFT01),
+            _harmonic_images(imgFFT10))
+
+
+def _extract_harmonics(imgFFT, harmonicPeriod, searchRegion=10,
+                       plotFlag=False, verbose=False):
+    """
+    Harmonics 00, 01 and 10 (in the reciprocal space) of the FFT
+    ``imgFFT``. See :py:func:`single_grating_harmonic_images`.
+    """
 
     if plotFlag:
-        plot_harmonic_grid(imgFFT, harmonicPeriod=harmonicPeriod, isFFT=True)
+        plot_harmonic_grid(np.asarray(imgFFT), harmonicPeriod=harmonicPeriod,
+                           isFFT=True)
         plt.show(block=False)
 
     imgFFT00 = extract_harmonic(imgFFT,
@@ -659,28 +796,48 @@ def single_grating_harmonic_images(img, harmonicPeriod,
         plt.suptitle('FFT subsets - Intensity', fontsize=18, weight='bold')
         plt.show(block=True)
 
-    img00 = np.fft.ifft2(np.fft.ifftshift(imgFFT00), norm='ortho')
+    return imgFFT00, imgFFT01, imgFFT10
+
+
+def _harmonic_images(imgFFT_harm):
+    """
+    Real space image of the harmonic ``imgFFT_harm`` obtained with
+    :py:func:`extract_harmonic`, or of a stack of harmonics with shape
+    ``(n, rows, cols)`` (calculated with a single FFT).
+    """
 
     # non existing harmonics will return NAN, so here we check NAN
-    if np.all(np.isfinite(imgFFT01)):
-        img01 = np.fft.ifft2(np.fft.ifftshift(imgFFT01), norm='ortho')
-    else:
-        img01 = imgFFT01
+    finite = np.all(np.isfinite(imgFFT_harm), axis=(-2, -1))
 
-    if np.all(np.isfinite(imgFFT10)):
-        img10 = np.fft.ifft2(np.fft.ifftshift(imgFFT10), norm='ortho')
-    else:
-        img10 = imgFFT10
+    if not np.any(finite):
+        return imgFFT_harm
+
+    img_harm = wpfft.ifft2(wpfft.ifftshift(imgFFT_harm, axes=(-2, -1)),
+                           norm='ortho')
+
+    if not np.all(finite):  # stack with some non existing harmonics
+        img_harm[~finite] = imgFFT_harm[~finite]
 
-    return (img00, img01, img10)
+    return img_harm
 
 
 def single_2Dgrating_analyses(img, img_ref=None, harmonicPeriod=None,
-                              unwrapFlag=True, plotFlag=True, verbose=False):
+                              unwrapFlag=True, plotFlag=True, cache=False,
+                              verbose=False):
     """
     Function to process the data of single 2D grating Talbot imaging. It
     wraps other functions in order to make all the process transparent
 
+    With ``cache=True``, the harmonic images of the reference ``img_ref``
+    and their unwrapped phases are stored in an on-disk cache (see
+    :py:func:`reference_cache_dir`), and reused when the same reference is
+    analysed again with the same ``harmonicPeriod``. The cache is limited to
+    ``WAVEPY_REFERENCE_CACHE_SIZE`` bytes (default 1 GiB), and the least
+    recently used references are removed when it is full. By default
+    (``cache=False``) the cache is neither read nor written. With
+    ``plotFlag=True``, the reference is always analysed again, to plot its
+    harmonics.
+
     """
 
     # Obtain Harmonic images
@@ -690,39 +847,246 @@ def single_2Dgrating_analyses(img, img_ref=None, harmonicPeriod=None,
 
     if img_ref is not None:  # relative wavefront
 
+        reference = _reference(img_ref, harmonicPeriod, 10, unwrapFlag,
+                               cache=cache, plotFlag=plotFlag,
+                               verbose=verbose)
+
+    else:  # absolute wavefront
+        reference = None
+
+    return _grating_analyses(h_img, reference, unwrapFlag)
+
+
+def _reference_harmonics(h_img_ref, unwrapFlag=True, phases=None):
+    """
+    Amplitudes of the harmonics 00, 01 and 10 of the reference image, and
+    the (unwrapped, if ``unwrapFlag``) phases of the harmonics 01 and 10,
+    used by :py:func:`_grating_analyses`. ``phases`` are the unwrapped
+    phases, if already known.
+    """
+
+    if unwrapFlag is True and phases is not None:
+        (arg01, arg10) = phases
+    elif unwrapFlag is True:
+        arg01 = unwrap_phase(np.angle(h_img_ref[1]), seed=72673)
+        arg10 = unwrap_phase(np.angle(h_img_ref[2]), seed=72673)
+    else:
+        arg01 = np.angle(h_img_ref[1])
+        arg10 = np.angle(h_img_ref[2])
+
+    return (np.abs(h_img_ref[0]), np.abs(h_img_ref[1]), np.abs(h_img_ref[2]),
+            arg01, arg10)
+
+
+def reference_cache_dir():
+    """
+    Directory of the cache of the harmonic images of the reference images
+    used by :py:func:`single_2Dgrating_analyses` and
+    :py:func:`single_2Dgrating_analyses_stack`. It is the directory
+    ``grating_references`` in the directory given by the environment
+    variable ``WAVEPY_CACHE_DIR``, or in ``~/.cache/wavepy``.
+
+    Each reference is stored in a HDF5 file, with the complex harmonic
+    images 00, 01 and 10 and the unwrapped phases of the harmonics 01 and
+    10. The files are named by a hash of the content of the reference image
+    (as given, that is, after any crop), of the exact values of
+    ``harmonicPeriod`` and of ``searchRegion``.
+
+    The cache is only used when these functions are called with
+    ``cache=True``. Its total size is limited by the environment variable
+    ``WAVEPY_REFERENCE_CACHE_SIZE`` (in bytes, default 1 GiB), which is read
+    each time a reference is saved, so it can be changed after the import
+    of wavepy. After a new reference is saved, the least recently used files
+    (by modification time, which is updated when a file is read) are
+    removed until the cache fits in the limit. The new file is never
+    removed, even if it is larger than the limit. Use
+    :py:func:`clear_reference_cache` to remove all files.
+    """
+
+    cache_dir = os.environ.get('WAVEPY_CACHE_DIR',
+                               os.path.join(os.path.expanduser('~'),
+                                            '.cache', 'wavepy'))
+
+    return os.path.join(cache_dir, 'grating_references')
+
+
+def _reference_cache_size():
+    """
+    Maximum total size (in bytes) of the cache of reference images, given by
+    the environment variable ``WAVEPY_REFERENCE_CACHE_SIZE`` when the
+    function is called, or ``_REFERENCE_CACHE_SIZE``.
+    """
+
+    return int(float(os.environ.get('WAVEPY_REFERENCE_CACHE_SIZE',
+                                    _REFERENCE_CACHE_SIZE)))
+
+
+def clear_reference_cache():
+    """
+    Remove all files of the cache of reference images, see
+    :py:func:`reference_cache_dir`.
+    """
+
+    for fname in glob.glob(os.path.join(reference_cache_dir(), '*.h5')):
+        os.remove(fname)
+
+
+def _reference_key(img_ref, harmonicPeriod, searchRegion):
+    """
+    Hash of the content of the reference image and of the parameters of the
+    harmonic extraction, used as name of the file in the cache.
+    """
+
+    img_ref = np.ascontiguousarray(img_ref)
+
+    sha = hashlib.sha1()
+    sha.update('{}{}'.format(img_ref.shape, img_ref.dtype).encode())
+    sha.update(img_ref.tobytes())
+    sha.update(np.asarray(harmonicPeriod, dtype=np.float64).tobytes())
+    sha.update('searchRegion={}'.format(searchRegion).encode())
+
+    return sha.hexdigest()
+
+
+def _load_reference(fname):
+    """
+    Harmonic images and unwrapped phases (or ``None``) of the reference
+    stored in the cache file ``fname``, or ``None`` if the file does not
+    exist (or cannot be read). The modification time of the file is
+    updated, for the least recently used eviction.
+    """
+
+    try:
+        with h5py.File(fname, 'r') as f:
+            h_img_ref = (f['h00'][()], f['h01'][()], f['h10'][()])
+            if 'arg01' in f:
+                phases = (f['arg01'][()], f['arg10'][()])
+            else:
+                phases = None
+        os.utime(fname, None)
+    except (IOError, OSError, KeyError):
+        return None
+
+    return h_img_ref, phases
+
+
+def _save_reference(fname, h_img_ref, phases):
+    """
+    Save the harmonic images and the unwrapped phases (if not ``None``) of
+    a reference in the cache file ``fname``, and remove the least recently
+    used files if the cache is larger than :py:func:`_reference_cache_size`.
+    The
+    file is written with a temporary name, so it is never partially written.
+    """
+
+    cache_dir = os.path.dirname(fname)
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    tmp_fname = fname + '.{}.tmp'.format(os.getpid())
+
+    with h5py.File(tmp_fname, 'w') as f:
+        for name, data in zip(['h00', 'h01', 'h10'], h_img_ref):
+            f.create_dataset(name, data=data)
+        if phases is not None:
+            f.create_dataset('arg01', data=phases[0])
+            f.create_dataset('arg10', data=phases[1])
+
+    os.replace(tmp_fname, fname)
+
+    files = sorted((os.path.getmtime(name), os.path.getsize(name), name)
+                   for name in glob.glob(os.path.join(cache_dir, '*.h5')))
+
+    total = sum(size for (_, size, _) in files)
+    max_size = _reference_cache_size()
+
+    for (_, size, name) in files:
+        if total <= max_size or name == fname:
+            break
+        os.remove(name)
+        total -= size
+
+
+def _reference(img_ref, harmonicPeriod, searchRegion, unwrapFlag,
+               cache=False, plotFlag=False, verbose=False):
+    """
+    Result of :py:func:`_reference_harmonics` for the reference image
+    ``img_ref``, read from the cache (see :py:func:`reference_cache_dir`)
+    if possible. Otherwise the harmonics are calculated and, if ``cache``,
+    saved in the cache.
+    """
+
+    if not cache:
         h_img_ref = single_grating_harmonic_images(img_ref, harmonicPeriod,
+                                                   searchRegion=searchRegion,
                                                    plotFlag=plotFlag,
                                                    verbose=verbose)
 
-        int00 = np.abs(h_img[0])/np.abs(h_img_ref[0])
-        int01 = np.abs(h_img[1])/np.abs(h_img_ref[1])
-        int10 = np.abs(h_img[2])/np.abs(h_img_ref[2])
+        return _reference_harmonics(h_img_ref, unwrapFlag)
 
-        if unwrapFlag is True:
+    fname = os.path.join(reference_cache_dir(),
+                         _reference_key(img_ref, harmonicPeriod,
+                                        searchRegion) + '.h5')
 
-            arg01 = unwrap_phase(np.angle(h_img[1]), seed=72673) - \
-                    unwrap_phase(np.angle(h_img_ref[1]), seed=72673)
+    cached = None if plotFlag else _load_reference(fname)
 
-            arg10 = unwrap_phase(np.angle(h_img[2]), seed=72673) - \
-                    unwrap_phase(np.angle(h_img_ref[2]), seed=72673)
+    if cached is not None:
+        (h_img_ref, phases) = cached
 
-        else:
-            arg01 = np.angle(h_img[1]) - np.angle(h_img_ref[1])
-            arg10 = np.angle(h_img[2]) - np.angle(h_img_ref[2])
+        if verbose:
+            print('MESSAGE: reference harmonics from cache ' + fname)
 
-    else:  # absolute wavefront
+        if phases is not None or unwrapFlag is not True:
+            return _reference_harmonics(h_img_ref, unwrapFlag, phases)
+
+    else:
+        h_img_ref = single_grating_harmonic_images(img_ref, harmonicPeriod,
+                                                   searchRegion=searchRegion,
+                                                   plotFlag=plotFlag,
+                                                   verbose=verbose)
+
+    reference = _reference_harmonics(h_img_ref, unwrapFlag)
+
+    if cached is None or unwrapFlag is True:
+        try:
+            _save_reference(fname, h_img_ref,
+                            reference[3:] if unwrapFlag is True else None)
+        except (IOError, OSError):
+            wpu.print_red('WARNING: reference harmonics could not be ' +
+                          'saved in the cache ' + fname)
+
+    return reference
 
-        int00 = np.abs(h_img[0])
-        int01 = np.abs(h_img[1])
-        int10 = np.abs(h_img[2])
 
-        if unwrapFlag is True:
+def _grating_analyses(h_img, reference=None, unwrapFlag=True):
+    """
+    Intensities, dark field and phases of the harmonic images ``h_img`` (see
+    :py:func:`single_grating_harmonic_images`), relative to the
+    ``reference`` obtained with :py:func:`_reference_harmonics`, or absolute
+    if ``reference`` is ``None``. See
+    :py:func:`single_2Dgrating_analyses`.
+    """
+
+    int00 = np.abs(h_img[0])
+    int01 = np.abs(h_img[1])
+    int10 = np.abs(h_img[2])
+
+    if unwrapFlag is True:
+        arg01 = unwrap_phase(np.angle(h_img[1]), seed=72673)
+        arg10 = unwrap_phase(np.angle(h_img[2]), seed=72673)
+    else:
+        arg01 = np.angle(h_img[1])
+        arg10 = np.angle(h_img[2])
+
+    if reference is not None:  # relative wavefront
 
-            arg01 = unwrap_phase(np.angle(h_img[1]), seed=72673)
-            arg10 = unwrap_phase(np.angle(h_img[2]), seed=72673)
-        else:
-            arg01 = np.angle(h_img[1])
-            arg10 = np.angle(h_img[2])
+        int00 = int00/reference[0]
+        int01 = int01/reference[1]
+        int10 = int10/reference[2]
+
+        arg01 = arg01 - reference[3]
+        arg10 = arg10 - reference[4]
 
     darkField01 = int01/int00
     darkField10 = int10/int00
@@ -732,6 +1096,135 @@ def single_2Dgrating_analyses(img, img_ref=None, harmonicPeriod=None,
             arg01, arg10]
 
 
+def single_2Dgrating_analyses_stack(imgs, img_ref=None, harmonicPeriod=None,
+                                    searchRegion=10, unwrapFlag=True,
+                                    batchSize=16, stream=False,
+                                    cache=False, verbose=False):
+    """
+    Same as :py:func:`single_2Dgrating_analyses` for a stack of images (for
+    instance a time series) with the same reference image. The harmonics and
+    the (unwrapped) phases of the reference are calculated only once, and
+    the FFT of the images and the inverse FFT of their harmonics are
+    calculated for ``batchSize`` images at a time.
+
+    Parameters
+    ----------
+    imgs : iterable of 2D ndarray
+        images to analyse. It can be a 3D ndarray with shape
+        ``(n, rows, cols)`` or an iterator (the images are read
+        ``batchSize`` at a time).
+
+    img_ref : 2D ndarray
+        reference image. If ``None``, the absolute values are calculated.
+
+    harmonicPeriod, searchRegion :
+        see :py:func:`single_grating_harmonic_images`.
+
+    unwrapFlag : Boolean
+        if ``True``, the phases are unwrapped.
+
+    batchSize : int
+        number of images transformed with a single FFT.
+
+    stream : Boolean
+        if ``True``, returns a generator with the results of each image, in
+        the same order of ``imgs``, calculated as they are requested.
+
+    cache : Boolean
+        if ``True``, the harmonics of the reference are read from (or saved
+        in) the on-disk cache, limited to ``WAVEPY_REFERENCE_CACHE_SIZE``
+        bytes (default 1 GiB) with least recently used eviction, see
+        :py:func:`reference_cache_dir`. Disabled by default.
+
+    verbose : Boolean
+        verbose flag.
+
+    Returns
+    -------
+    list of 3D ndarray or generator
+        ``[int00, int01, int10, darkField01, darkField10, arg01, arg10]``,
+        with the results of all images stacked along the first axis. With
+        ``stream=True``, a generator of the same list (of 2D ndarrays) for
+        each image, see :py:func:`single_2Dgrating_analyses`.
+
+    Example
+    -------
+
+    >>> for (int00, int01, int10, darkField01, darkField10,
+    ...      arg01, arg10) in single_2Dgrating_analyses_stack(
+    ...         frames, img_ref, harmonicPeriod=[40, 40], stream=True):
+    ...     dpc01.append(arg01)
+
+    """
+
+    if batchSize < 1:
+        raise ValueError('wavepy: batchSize must be at least 1.')
+
+    if img_ref is not None:  # relative wavefront
+        reference = _reference(img_ref, harmonicPeriod, searchRegion,
+                               unwrapFlag, cache=cache, verbose=verbose)
+
+    else:  # absolute wavefront
+        reference = None
+
+    results = _grating_analyses_stack(imgs, reference, harmonicPeriod,
+                                      searchRegion, unwrapFlag, batchSize,
+                                      verbose)
+
+    if stream:
+        return results
+
+    results = [np.array(res) for res in zip(*results)]
+
+    if len(results) == 0:
+        raise ValueError('wavepy: imgs must have at least one image.')
+
+    return results
+
+
+def _grating_analyses_stack(imgs, reference, harmonicPeriod, searchRegion,
+                            unwrapFlag, batchSize, verbose):
+    """
+    Generator with the results of :py:func:`_grating_analyses` for each
+    image of ``imgs``. See :py:func:`single_2Dgrating_analyses_stack`.
+    """
+
+    imgs = iter(imgs)
+
+    while True:
+
+        batch = list(itertools.islice(imgs, batchSize))
+
+        if len(batch) == 0:
+            return
+
+        batch = np.asarray(batch)
+        shape = batch.shape[1:]
+
+        if verbose:
+            print('MESSAGE: single_2Dgrating_analyses_stack: ' +
+                  '{:d} images'.format(batch.shape[0]))
+
+        # FFT of all images of the batch
+        rfft = wpfft.rfft2(batch, norm='ortho')
+
+        harmonics = [_extract_harmonics(_HalfSpectrum.from_rfft(rfft_k,
+                                                                shape),
+                                        harmonicPeriod, searchRegion,
+                                        verbose=verbose)
+                     for rfft_k in rfft]
+
+        del rfft
+
+        # inverse FFT of each harmonic of all images
+        h_imgs = [_harmonic_images(np.array(imgFFT_harm))
+                  for imgFFT_harm in zip(*harmonics)]
+
+        for k in range(batch.shape[0]):
+            yield _grating_analyses([h_img[k] for h_img in h_imgs],
+                                    reference, unwrapFlag)
+
+
 def visib_1st_harmonics(img, harmonicPeriod, searchRegion=20, verbose=False):
     """
     This function obtain the visibility in a grating imaging experiment by the
@@ -775,7 +1268,7 @@ def visib_1st_harmonics(img, harmonicPeriod, searchRegion=20, verbose=False):
 
     """
 
-    imgFFT = np.fft.fftshift(np.fft.fft2(img, norm='ortho'))
+    imgFFT = _HalfSpectrum(img)
 
     _idxPeak_ij_exp00 = _idxPeak_ij_exp(imgFFT, 0, 0,
                                         harmonicPeriod[0], harmonicPeriod[1],
@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# #########################################################################
+# Copyright (c) 2015, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2015. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+
+"""
+Benchmark of the speckle tracking functions.
+
+Synthetic speckle images with a known displacement field are tracked with
+:py:func:`wavepy.speckletracking.speckleDisplacement` for all combinations of
+the given parameters. For each combination the throughput (windows per
+second), the peak memory and the RMS error of the displacement are reported
+as a table (list of dictionaries), that can be saved as ``csv`` or ``json``
+files. It is used to choose the parameters for the experimental data and to
+detect speed regressions.
+
+Example
+-------
+
+>>> import wavepy.speckle_benchmark as wpsb
+>>> results = wpsb.benchmark_speckleDisplacement(shape=(512, 512),
+...                                              halfsubwidth=[8, 12],
+...                                              stride=[1, 4])
+>>> wpsb.save_benchmark(results, 'speckle_benchmark.csv')
+
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import csv
+import itertools
+import json
+import platform
+import time
+import tracemalloc
+
+import numpy as np
+from scipy import ndimage
+
+import wavepy.utils as wpu
+import wavepy.speckletracking as wpst
+
+
+__authors__ = "Walan Grizolli"
+__copyright__ = "Copyright (c) 2016-2017, Argonne National Laboratory"
+__version__ = "0.1.0"
+__docformat__ = "restructuredtext en"
+__all__ = ['synthetic_speckle', 'benchmark_speckleDisplacement',
+           'save_benchmark']
+
+
+_METHODS = ('register_translation', 'match_template')
+
+_FIELDS = ['method', 'shape', 'halfsubwidth', 'halfTemplateSize',
+           'subpixelResolution', 'stride', 'ncores', 'taskPerCore',
+           'backend', 'windows', 'time', 'windows_per_s', 'peak_memory',
+           'rms_error', 'valid_fraction']
+
+
+def synthetic_speckle(shape=(512, 512), speckleSize=2.0, maxDisplacement=2.0,
+                      noise=0.0, seed=None):
+    '''
+    Synthetic pair of speckle images with a known displacement field.
+
+    The reference image is white noise filtered by a gaussian of width
+    ``speckleSize``. The image with sample is the reference image displaced
+    by the field of a paraboloidal lens (the displacement increases linearly
+    from the center of the image), which has values up to
+    ``maxDisplacement`` at the borders.
+
+    Parameters
+    ----------
+    shape : tuple
+        shape of the images.
+
+    speckleSize : float
+        standard deviation, in pixels, of the gaussian filter of the noise,
+        that is, the size of the speckle grains.
+
+    maxDisplacement : float
+        maximum displacement in pixels, at the borders of the images.
+
+    noise : float
+        standard deviation of the gaussian noise added to both images,
+        relative to the standard deviation of the speckle pattern.
+
+    seed : int
+        seed of the random number generator.
+
+    Returns
+    -------
+    image, image_ref : 2D ndarray
+        image with sample and reference image.
+
+    dx, dy : 2D ndarray
+        displacement field in pixels, in the same convention of the ``sx``
+        and ``sy`` returned by
+        :py:func:`wavepy.speckletracking.speckleDisplacement`, that is,
+        ``image[i, j] = image_ref[i - dy[i, j], j - dx[i, j]]``.
+
+    '''
+
+    rng = np.random.RandomState(seed)
+
+    image_ref = ndimage.gaussian_filter(rng.rand(*shape), speckleSize)
+    image_ref = (image_ref - image_ref.mean()) / image_ref.std()
+
+    yy, xx = np.mgrid[0:shape[0], 0:shape[1]].astype(float)
+
+    dx = maxDisplacement * (xx - (shape[1] - 1) / 2) / ((shape[1] - 1) / 2)
+    dy = maxDisplacement * (yy - (shape[0] - 1) / 2) / ((shape[0] - 1) / 2)
+
+    image = ndimage.map_coordinates(image_ref, [yy - dy, xx - dx],
+                                    order=3, mode='reflect')
+
+    if noise > 0:
+        image = image + noise * rng.randn(*shape)
+        image_ref = image_ref + noise * rng.randn(*shape)
+
+    # positive values, as in the detector images
+    offset = 1.0 - min(image.min(), image_ref.min())
+
+    return image + offset, image_ref + offset, dx, dy
+
+
+def _as_tuple(values):
+    """
+    Parameters of the benchmark can be given as a single value or as a list
+    of values.
+    """
+
+    if isinstance(values, (list, tuple, np.ndarray)):
+        return tuple(values)
+    else:
+        return (values,)
+
+
+def _displacement_error(sx, sy, dx, dy, stride, halfsubwidth):
+    """
+    RMS error of the displacement and fraction of valid (finite) windows,
+    using the true displacement at the centers of the windows.
+    """
+
+    irange, jrange = wpst._speckle_grid(dx.shape, halfsubwidth, stride)
+
+    ex = sx - dx[np.ix_(irange, jrange)][:sx.shape[0], :sx.shape[1]]
+    ey = sy - dy[np.ix_(irange, jrange)][:sy.shape[0], :sy.shape[1]]
+
+    valid = np.isfinite(ex) & np.isfinite(ey)
+
+    if not np.any(valid):
+        return np.nan, 0.0
+
+    rms_error = np.sqrt(np.mean(ex[valid]**2 + ey[valid]**2))
+
+    return float(rms_error), float(np.mean(valid))
+
+
+def benchmark_speckleDisplacement(shape=(512, 512), speckleSize=2.0,
+                                  maxDisplacement=2.0, noise=0.0,
+                                  methods=_METHODS,
+                                  halfsubwidth=10, halfTemplateSize=5,
+                                  subpixelResolution=10,
+                                  stride=1, ncores=1/2, taskPerCore=100,
+                                  backend='shared_memory', repeat=1,
+                                  memory=True, seed=0, verbose=True,
+                                  **kwargs):
+    '''
+    Benchmark of :py:func:`wavepy.speckletracking.speckleDisplacement` with
+    synthetic speckle images (see :py:func:`synthetic_speckle`).
+
+    All combinations of the values of ``methods``, ``halfsubwidth``,
+    ``stride``, ``ncores`` and ``taskPerCore`` are tracked, and the
+    performance of each combination is a row of the returned table.
+    Each of these parameters can be a single value or a list of values.
+
+    Parameters
+    ----------
+    shape, speckleSize, maxDisplacement, noise, seed :
+        parameters of the synthetic images, see
+        :py:func:`synthetic_speckle`.
+
+    methods : list of str
+        ``'register_translation'`` and/or ``'match_template'``.
+
+    halfsubwidth : int or list of int
+        half size of the sub images.
+
+    halfTemplateSize : int
+        half size of the template for the ``match_template`` method.
+
+    subpixelResolution : int
+        upsample factor for the ``register_translation`` method.
+
+    stride : int or list of int
+        distance in pixels between the centers of two neighbour windows.
+
+    ncores : float or list of float
+        fraction of the available cpu's to be used.
+
+    taskPerCore : int or list of int
+        number of tasks sent to each process.
+
+    backend : str
+        parallel backend, see
+        :py:func:`wavepy.speckletracking.speckleDisplacement`.
+
+    repeat : int
+        number of times each combination is tracked. The time is the
+        minimum of all runs.
+
+    memory : bool
+        if ``True``, the peak memory is measured with :py:mod:`tracemalloc`
+        in one extra run (not timed, as tracing the allocations slows down
+        the run). Note that only the memory allocated by the calling process
+        is traced, and not the memory of the worker processes or of
+        :py:mod:`multiprocessing.shared_memory`.
+
+    verbose : bool
+        print the results of each combination.
+
+    kwargs :
+        other parameters passed to
+        :py:func:`wavepy.speckletracking.speckleDisplacement`, like
+        ``subpixelFit`` or ``pyramidLevels``.
+
+    Returns
+    -------
+    list of dict
+        table with one row for each combination, with the parameters and:
+        ``windows`` (number of windows), ``time`` (seconds),
+        ``windows_per_s``, ``peak_memory`` (bytes, ``None`` if ``memory`` is
+        ``False``), ``rms_error`` (RMS of the modulus of the displacement
+        error, in pixels, over the valid windows) and ``valid_fraction``
+        (fraction of windows with finite result).
+
+    '''
+
+    for method in _as_tuple(methods):
+        if method not in _METHODS:
+            raise ValueError('ERROR: method must be one of ' +
+                             ', '.join(_METHODS))
+
+    image, image_ref, dx, dy = synthetic_speckle(shape=shape,
+                                                 speckleSize=speckleSize,
+                                                 maxDisplacement=maxDisplacement,
+                                                 noise=noise, seed=seed)
+
+    results = []
+
+    for (method, hsw, stride_i,
+         ncores_i, tpc) in itertools.product(_as_tuple(methods),
+                                             _as_tuple(halfsubwidth),
+                                             _as_tuple(stride),
+                                             _as_tuple(ncores),
+                                             _as_tuple(taskPerCore)):
+
+        if method == 'match_template':
+            parameters = {'halfTemplateSize': halfTemplateSize,
+                          'subpixelResolution': None}
+        else:
+            parameters = {'halfTemplateSize': None,
+                          'subpixelResolution': subpixelResolution}
+
+        parameters.update(halfsubwidth=hsw, stride=stride_i,
+                          ncores=ncores_i, taskPerCore=tpc,
+                          backend=backend)
+
+        def _run():
+            return wpst.speckleDisplacement(image, image_ref,
+                                            verbose=False,
+                                            **dict(parameters, **kwargs))
+
+        elapsed = np.inf
+        for _ in range(max(repeat, 1)):
+            t0 = time.perf_counter()
+            sx, sy, error, stride_out = _run()
+            elapsed = min(elapsed, time.perf_counter() - t0)
+
+        peak_memory = None
+        if memory:
+            tracing = tracemalloc.is_tracing()
+            if not tracing:
+                tracemalloc.start()
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+            else:  # python < 3.9, restarting the tracing resets the peak
+                tracemalloc.stop()
+                tracemalloc.start()
+            base_memory = tracemalloc.get_traced_memory()[0]
+            _run()
+            peak_memory = tracemalloc.get_traced_memory()[1] - base_memory
+            if not tracing:
+                tracemalloc.stop()
+
+        rms_error, valid_fraction = _displacement_error(sx, sy, dx, dy,
+                                                        stride_out, hsw)
+
+        row = dict(parameters, method=method, shape='x'.join(map(str, shape)),
+                   stride=stride_out, windows=sx.size, time=elapsed,
+                   windows_per_s=sx.size / elapsed,
+                   peak_memory=peak_memory, rms_error=rms_error,
+                   valid_fraction=valid_fraction)
+
+        results.append({key: row[key] for key in _FIELDS})
+
+        if verbose:
+            wpu.print_blue('MESSAGE: ' + method +
+                           ', halfsubwidth={}, stride={}'.format(hsw,
+                                                                 stride_out) +
+                           ', ncores={}, taskPerCore={}: '.format(ncores_i,
+                                                                  tpc) +
+                           '{:.4g} windows/s, '.format(row['windows_per_s']) +
+                           'rms error {:.3g} px'.format(rms_error))
+
+    return results
+
+
+def save_benchmark(results, fname, fmt=None):
+    '''
+    Save the table returned by :py:func:`benchmark_speckleDisplacement`.
+
+    Parameters
+    ----------
+    results : list of dict
+        table of results.
+
+    fname : str
+        file name.
+
+    fmt : str
+        ``'csv'`` or ``'json'``. By default it is obtained from the extension
+        of ``fname``. The ``json`` file also contains information about the
+        machine (processor, python and numpy versions), to make it possible
+        to compare runs on different machines.
+
+    '''
+
+    if fmt is None:
+        fmt = 'json' if fname.lower().endswith('.json') else 'csv'
+
+    if fmt == 'csv':
+        with open(fname, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=_FIELDS)
+            writer.writeheader()
+            writer.writerows(results)
+
+    elif fmt == 'json':
+        machine = {'processor': platform.processor() or platform.machine(),
+                   'cpu_count': wpst.cpu_count(),
+                   'python': platform.python_version(),
+                   'numpy': np.__version__,
+                   'date': wpu.datetime_now_str()}
+
+        with open(fname, 'w') as f:
+            json.dump({'machine': machine, 'results': results}, f, indent=1)
+
+    else:
+        raise ValueError('ERROR: fmt must be csv or json')
+
+    wpu.print_blue('MESSAGE: benchmark saved at ' + fname)
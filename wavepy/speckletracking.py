@@ -52,151 +52,1365 @@ Functions for speckle tracking analises
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import hashlib
 import itertools
+import os
+import threading
+from collections import OrderedDict
+import h5py
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from scipy.ndimage import median_filter
 import matplotlib.pyplot as plt
 from tqdm import tqdm
 
 from skimage.feature import register_translation
 
-from multiprocessing import Pool, cpu_count
+from multiprocessing import Pool, cpu_count, current_process
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:  # python < 3.8
+    shared_memory = None
+
+try:
+    import numba
+except ImportError:  # optional, compiled kernel of the match_template method
+    numba = None
 
 import wavepy.utils as wpu
+import wavepy.fft as wpfft
 
 
 __authors__ = "Walan Grizolli"
 __copyright__ = "Copyright (c) 2016-2017, Argonne National Laboratory"
 __version__ = "0.1.0"
 __docformat__ = "restructuredtext en"
-__all__ = ['speckleDisplacement']
+__all__ = ['SpeckleReference', 'SpeckleTracker', 'speckleDisplacement',
+           'speckleDisplacementSequence']
 
 
-def _speckleDisplacementSingleCore_method1(image, image_ref, halfsubwidth,
-                                           subpixelResolution, stride, verbose):
-    '''
-    see http://scikit-image.org/docs/dev/auto_examples/transform/plot_register_translation.html
-    '''
+# ==============================================================================
+# % Batched FFT cross-correlation engine
+# ==============================================================================
 
-    irange = np.arange(halfsubwidth,
-                       image.shape[0] - halfsubwidth + 1,
-                       stride)
-    jrange = np.arange(halfsubwidth,
-                       image.shape[1] - halfsubwidth + 1,
-                       stride)
+# Number of pixels (summed over all windows) processed at once by the batched
+# engine. It sets the size of the temporary complex arrays of each block.
+_BLOCK_NPIXELS = 2**22
 
-    pbar = tqdm(total=np.size(irange))  # progress bar
 
-    sx = np.ones(image.shape) * NAN
-    sy = np.ones(image.shape) * NAN
-    error = np.ones(image.shape) * NAN
+def _speckle_grid(shape, halfsubwidth, stride):
+    """
+    Indexes of the centers of the interrogation windows. Only windows that
+    are fully inside of the image are used.
+    """
 
-    for (i, j) in itertools.product(irange, jrange):
+    irange = np.arange(halfsubwidth, shape[0] - halfsubwidth, stride)
+    jrange = np.arange(halfsubwidth, shape[1] - halfsubwidth, stride)
 
-        interrogation_window = image_ref[i - halfsubwidth:i + halfsubwidth + 1,
-                               j - halfsubwidth:j + halfsubwidth + 1]
+    return irange, jrange
 
-        sub_image = image[i - halfsubwidth:i + halfsubwidth + 1,
-                    j - halfsubwidth:j + halfsubwidth + 1]
 
-        shift, error_ij, _ = register_translation(sub_image,
-                                                  interrogation_window,
-                                                  subpixelResolution)
+def _grid_mask(mask, grid, halfsubwidth, maskFraction=None):
+    """
+    Boolean array with the shape of ``grid``, ``True`` for the windows to be
+    calculated according to ``mask``, a boolean array with the shape of the
+    image. If ``maskFraction`` is ``None``, the windows with center inside
+    of ``mask`` are used. Otherwise, the windows where the fraction of
+    pixels inside of ``mask`` is at least ``maskFraction`` are used (the
+    fraction is obtained from the summed-area table of ``mask``).
+    """
 
-        sx[i, j] = shift[1]
-        sy[i, j] = shift[0]
-        error[i, j] = error_ij
+    mask = np.asarray(mask, dtype=bool)
+    irange, jrange = grid
 
-        if j == jrange[-1]: pbar.update()  # update progress bar
+    if maskFraction is None:
+        return mask[np.ix_(irange, jrange)]
 
-    print(" ")
+    width = 2 * halfsubwidth + 1
 
-    return (sx[halfsubwidth:-halfsubwidth:stride,
-            halfsubwidth:-halfsubwidth:stride],
-            sy[halfsubwidth:-halfsubwidth:stride,
-            halfsubwidth:-halfsubwidth:stride],
-            error[halfsubwidth:-halfsubwidth:stride,
-            halfsubwidth:-halfsubwidth:stride],
-            stride)
+    fraction = _window_sums(mask.astype(np.float64),
+                            width)[np.ix_(irange - halfsubwidth,
+                                          jrange - halfsubwidth)]
 
-def _speckleDisplacementSingleCore_method2(image, image_ref, halfsubwidth,
-                                           halfTemplateSize, stride, verbose):
-    '''
-    see http://scikit-image.org/docs/dev/auto_examples/plot_template.html
-    '''
+    return fraction >= maskFraction * width**2
 
-    from skimage.feature import match_template
 
-    irange = np.arange(halfsubwidth,
-                       image.shape[0] - halfsubwidth + 1,
-                       stride)
-    jrange = np.arange(halfsubwidth,
-                       image.shape[1] - halfsubwidth + 1,
-                       stride)
+def _sliding_windows(array, halfwidth):
+    """
+    Read-only view of all square sub arrays of size ``2*halfwidth + 1``
+    of ``array``. The element ``[i, j]`` of the view is the window with upper
+    left corner at ``array[i, j]``, that is, the window centered at
+    ``array[i + halfwidth, j + halfwidth]``. No data is copied.
+    """
 
-    pbar = tqdm(total=np.size(irange))  # progress bar
+    width = 2 * halfwidth + 1
 
-    sx = np.ones(image.shape) * NAN
-    sy = np.ones(image.shape) * NAN
-    error = np.ones(image.shape) * NAN
+    shape = (array.shape[0] - width + 1, array.shape[1] - width + 1,
+             width, width)
 
-    for (i, j) in itertools.product(irange, jrange):
+    return as_strided(array, shape=shape, strides=array.strides * 2,
+                      writeable=False)
 
-        interrogation_window = image_ref[i - halfTemplateSize: \
-                                         i + halfTemplateSize+ 1,
-                                         j - halfTemplateSize: \
-                                         j + halfTemplateSize + 1]
 
-        sub_image = image[i - halfsubwidth:i + halfsubwidth + 1,
-                    j - halfsubwidth:j + halfsubwidth + 1]
+def _rows_per_block(ncolumns, halfwidth):
+    """
+    Number of rows of the grid of windows processed at once by the batched
+    engine.
+    """
 
-        result = match_template(sub_image, interrogation_window)
+    return max(1, _BLOCK_NPIXELS // (ncolumns * (2 * halfwidth + 1)**2))
 
 
-        shift_y, shift_x = np.unravel_index(np.argmax(result), result.shape)
+def _upsampled_dft_batch(data, upsampled_region_size,
+                         upsample_factor, axis_offsets):
+    """
+    Vectorized version of ``skimage.feature.register_translation._upsampled_dft``
+    for a stack of 2D arrays ``data`` with shape ``(n, rows, cols)``.
+    ``axis_offsets`` has shape ``(n, 2)``.
+    """
 
-        shift_x -= halfsubwidth - halfTemplateSize
-        shift_y -= halfsubwidth - halfTemplateSize
-        error_ij = 1.0 - np.max(result)
+    (_, nRows, nColumns) = data.shape
 
-        sx[i, j] = shift_x
-        sy[i, j] = shift_y
-        error[i, j] = error_ij
+    col_freq = wpfft.ifftshift(np.arange(nColumns)) - np.floor(nColumns / 2)
+    row_freq = wpfft.ifftshift(np.arange(nRows)) - np.floor(nRows / 2)
+    region = np.arange(upsampled_region_size)
 
-        if j == jrange[-1]: pbar.update()  # update progress bar
+    col_kernel = np.exp((-1j * 2 * np.pi / (nColumns * upsample_factor)) *
+                        col_freq[None, :, None] *
+                        (region[None, None, :] -
+                         axis_offsets[:, 1, None, None]))
+
+    row_kernel = np.exp((-1j * 2 * np.pi / (nRows * upsample_factor)) *
+                        (region[None, :, None] -
+                         axis_offsets[:, 0, None, None]) *
+                        row_freq[None, None, :])
+
+    return np.matmul(np.matmul(row_kernel, data), col_kernel)
+
+
+def _target_spectra(target_image, upsample_factor=1):
+    """
+    Quantities of the stack of (reference) images ``target_image`` used by
+    :py:func:`_register_translation_batch`: their FFT (real FFT for
+    ``upsample_factor == 1``) and their energy.
+    """
+
+    target_image = target_image.astype(np.float64, copy=False)
+
+    if upsample_factor > 1:
+        target_freq = wpfft.fft2(target_image)
+    else:
+        target_freq = wpfft.rfft2(target_image)
+
+    return target_freq, np.sum(target_image**2, axis=(1, 2))
+
+
+def _register_translation_batch(src_image, target_image, upsample_factor=1,
+                                target_spectra=None, maxShift=None,
+                                src_spectra=None):
+    """
+    Vectorized version of :py:func:`skimage.feature.register_translation`.
+    It register all pairs of images of the stacks ``src_image`` and
+    ``target_image``, both with shape ``(n, rows, cols)``, with one batched
+    FFT. If ``target_spectra`` (see :py:func:`_target_spectra`) is provided,
+    ``target_image`` is not used. In the same way, if ``src_spectra`` is
+    provided, ``src_image`` is only used for its shape. If ``maxShift`` is given, the maximum of
+    the cross correlation is searched only for shifts up to ``maxShift``
+    pixels (the upsampled refinement can add up to one pixel).
+
+    Returns
+    -------
+    ndarray, ndarray
+        shifts, with shape ``(n, 2)``, and translation invariant normalized
+        RMS errors, with shape ``(n, )``.
+
+    Note
+    ----
+    For ``upsample_factor > 1``, the cross correlation used in the error is
+    the one at the position of the maximum of its absolute value, as in the
+    recent versions of scikit-image.
+    """
+
+    if target_spectra is None:
+        target_spectra = _target_spectra(target_image, upsample_factor)
+
+    if src_spectra is None:
+        src_spectra = _target_spectra(src_image, upsample_factor)
+
+    (target_freq, target_amp) = target_spectra
+    (src_freq, src_amp) = src_spectra
+
+    (nRows, nColumns) = src_image.shape[-2:]
+    nImages = src_freq.shape[0]
+    size = nRows * nColumns
+
+    if upsample_factor > 1:
+        image_product = src_freq * target_freq.conj()
+        cross_correlation = wpfft.ifft2(image_product)
+
+    else:
+        # for real images the cross correlation is real, and the real FFT
+        # does half of the work
+        cross_correlation = wpfft.irfft2(src_freq * target_freq.conj(),
+                                          s=(nRows, nColumns))
+
+    cross_correlation = cross_correlation.reshape(nImages, size)
+
+    midpoints = np.array([np.fix(nRows / 2), np.fix(nColumns / 2)])
+
+    if maxShift is None:
+        idx_max = np.argmax(np.abs(cross_correlation), axis=1)
+    else:
+        # shifts of each element of the (not shifted) cross correlation
+        allowed = [np.abs(np.where(idx > mid, idx - n, idx)) <= maxShift
+                   for idx, mid, n in zip((np.arange(nRows),
+                                           np.arange(nColumns)),
+                                          midpoints, (nRows, nColumns))]
+        allowed = (allowed[0][:, None] & allowed[1][None, :]).ravel()
+        idx_max = np.argmax(np.where(allowed, np.abs(cross_correlation), -1),
+                            axis=1)
+
+    cc_max = cross_correlation[np.arange(nImages), idx_max]
+
+    shifts = np.array(np.unravel_index(idx_max, (nRows, nColumns)),
+                      dtype=np.float64).T
+
+    shifts = np.where(shifts > midpoints,
+                      shifts - np.array([nRows, nColumns]), shifts)
+
+    if upsample_factor > 1:
+
+        upsample_factor = float(upsample_factor)
+
+        shifts = np.round(shifts * upsample_factor) / upsample_factor
+        upsampled_region_size = int(np.ceil(upsample_factor * 1.5))
+        dftshift = np.fix(upsampled_region_size / 2.0)
+        normalization = size * upsample_factor**2
+
+        sample_region_offset = dftshift - shifts * upsample_factor
+
+        cross_correlation = _upsampled_dft_batch(image_product.conj(),
+                                                 upsampled_region_size,
+                                                 upsample_factor,
+                                                 sample_region_offset).conj()
+        cross_correlation = cross_correlation.reshape(nImages, -1)
+        cross_correlation /= normalization
+
+        idx_max = np.argmax(np.abs(cross_correlation), axis=1)
+        cc_max = cross_correlation[np.arange(nImages), idx_max]
+
+        maxima = np.array(np.unravel_index(idx_max, (upsampled_region_size,
+                                                     upsampled_region_size)),
+                          dtype=np.float64).T
+        maxima -= dftshift
+        shifts = shifts + maxima / upsample_factor
+
+        src_amp = src_amp / upsample_factor**2
+        target_amp = target_amp / upsample_factor**2
+
+    if nRows == 1:
+        shifts[:, 0] = 0
+    if nColumns == 1:
+        shifts[:, 1] = 0
+
+    error = 1.0 - np.abs(cc_max)**2 / (src_amp * target_amp)
+
+    return shifts, np.sqrt(np.abs(error))
+
+
+def _window_block(ii, jj):
+    """
+    Returns ``(ii[0, 0], jj[0, 0])`` if the 2D arrays ``ii`` and ``jj`` are
+    the indexes of a block of consecutive rows and columns (stride 1),
+    otherwise ``None``.
+    """
+
+    if np.ndim(ii) != 2 or np.size(ii) == 0:
+        return None
+
+    if (np.all(np.diff(ii[:, 0]) == 1) and np.all(np.diff(jj[0]) == 1) and
+            np.all(ii == ii[:, :1]) and np.all(jj == jj[:1])):
+        return ii[0, 0], jj[0, 0]
+
+    return None
+
+
+def _block_spectra(image, corner, shape, halfsubwidth, upsample_factor=1):
+    """
+    Same result of :py:func:`_target_spectra` for the ``shape[0] x shape[1]``
+    windows of size ``2*halfsubwidth + 1`` centered at consecutive rows and
+    columns (stride 1), starting at ``image[corner]``.
+
+    The 2D FFT of a window is the FFT along its columns of the FFT of its
+    rows. As neighbour windows share most of their rows, the FFT of each row
+    segment of the image is calculated only once and reused by all the
+    ``2*halfsubwidth + 1`` windows that contain it, and only the FFT along the
+    columns is calculated for each window. This gives the same spectra with
+    about half of the operations of the FFT of each window.
+    """
+
+    width = 2 * halfsubwidth + 1
+    (nRows, nColumns) = shape
+    i0 = corner[0] - halfsubwidth
+    j0 = corner[1] - halfsubwidth
+
+    strip = np.asarray(image[i0:i0 + nRows + width - 1,
+                             j0:j0 + nColumns + width - 1], dtype=np.float64)
+
+    # row segments of size width starting at each column of the block
+    segments = as_strided(strip, shape=(strip.shape[0], nColumns, width),
+                          strides=(strip.strides[0], strip.strides[1],
+                                   strip.strides[1]),
+                          writeable=False)
+
+    if upsample_factor > 1:
+        rows_freq = wpfft.fft(segments, axis=2)
+    else:
+        rows_freq = wpfft.rfft(segments, axis=2)
+
+    # spectra of the rows of each window, without copy
+    windows_freq = as_strided(rows_freq,
+                              shape=(nRows, nColumns, width,
+                                     rows_freq.shape[2]),
+                              strides=(rows_freq.strides[0],
+                                       rows_freq.strides[1],
+                                       rows_freq.strides[0],
+                                       rows_freq.strides[2]),
+                              writeable=False)
+
+    freq = wpfft.fft(windows_freq, axis=2)
+
+    return (freq.reshape(-1, width, rows_freq.shape[2]),
+            _window_sums(strip**2, width).ravel())
+
+
+def _reference_method1(image_ref, ii, jj, halfsubwidth, subpixelResolution):
+    """
+    Quantities of the reference windows centered at ``ii`` and ``jj`` used by
+    :py:func:`_displacement_method1`. See :py:func:`_target_spectra` and, for
+    stride 1, :py:func:`_block_spectra`.
+    """
+
+    corner = _window_block(ii, jj)
+
+    if corner is not None:
+        return _block_spectra(image_ref, corner, ii.shape, halfsubwidth,
+                              subpixelResolution)
+
+    width = 2 * halfsubwidth + 1
+
+    interrogation_window = _sliding_windows(image_ref,
+                                            halfsubwidth)[ii - halfsubwidth,
+                                                          jj - halfsubwidth]
+
+    return _target_spectra(interrogation_window.reshape(-1, width, width),
+                           subpixelResolution)
 
-    print(" ")
 
-    return (sx[halfsubwidth:-halfsubwidth:stride,
-            halfsubwidth:-halfsubwidth:stride],
-            sy[halfsubwidth:-halfsubwidth:stride,
-            halfsubwidth:-halfsubwidth:stride],
-            error[halfsubwidth:-halfsubwidth:stride,
-            halfsubwidth:-halfsubwidth:stride],
-            stride)
+def _displacement_method1(image, image_ref, ii, jj,
+                          halfsubwidth, subpixelResolution,
+                          offset_i=0, offset_j=0, reference=None,
+                          maxShift=None):
+    """
+    Displacement of the speckles in the windows centered at the indexes
+    ``ii`` and ``jj`` (arrays of same shape), obtained with
+    :py:func:`_register_translation_batch`.
+
+    The sub images of ``image`` are centered at ``ii + offset_i`` and
+    ``jj + offset_j``, and the offsets are added to the result.
+
+    ``reference`` is the result of :py:func:`_reference_method1` for the same
+    windows. If ``None``, it is calculated from ``image_ref``.
+
+    ``maxShift`` limits the search of the maximum of the cross correlation,
+    see :py:func:`_register_translation_batch`. The FFT of the full window
+    is still calculated, as the window size sets the precision of the
+    method.
+
+    For windows in consecutive rows and columns without offsets (stride 1),
+    the spectra of the sub images are obtained with
+    :py:func:`_block_spectra`.
+
+    Returns
+    -------
+    sx, sy, error
+        arrays with the same shape of ``ii``
+    """
+
+    if reference is None:
+        reference = _reference_method1(image_ref, ii, jj,
+                                       halfsubwidth, subpixelResolution)
+
+    width = 2 * halfsubwidth + 1
+
+    corner = _window_block(ii, jj)
+
+    if corner is not None and not np.any(offset_i) and not np.any(offset_j):
+        # view of the windows of the block, only used for its shape
+        sub_image = _sliding_windows(image, halfsubwidth)[
+                        corner[0] - halfsubwidth:ii[-1, 0] - halfsubwidth + 1,
+                        corner[1] - halfsubwidth:jj[0, -1] - halfsubwidth + 1]
+
+        src_spectra = _block_spectra(image, corner, ii.shape, halfsubwidth,
+                                     subpixelResolution)
+    else:
+        sub_image = _sliding_windows(image, halfsubwidth)[ii + offset_i -
+                                                          halfsubwidth,
+                                                          jj + offset_j -
+                                                          halfsubwidth]
+        sub_image = sub_image.reshape(-1, width, width)
+        src_spectra = None
+
+    shift, error = _register_translation_batch(
+                        sub_image, None, subpixelResolution,
+                        target_spectra=reference, maxShift=maxShift,
+                        src_spectra=src_spectra)
+
+    return (shift[:, 1].reshape(ii.shape) + offset_j,
+            shift[:, 0].reshape(ii.shape) + offset_i,
+            error.reshape(ii.shape))
+
+
+def _window_sums(array, width):
+    """
+    Sum of ``array`` over all its ``width x width`` sub arrays, obtained from
+    the summed-area table (integral image) of ``array``. The element
+    ``[i, j]`` of the result is ``np.sum(array[i:i + width, j:j + width])``.
+    """
+
+    sat = np.zeros((array.shape[0] + 1, array.shape[1] + 1))
+    np.cumsum(np.cumsum(array, axis=0), axis=1, out=sat[1:, 1:])
+
+    return (sat[width:, width:] - sat[:-width, width:] -
+            sat[width:, :-width] + sat[:-width, :-width])
+
+
+def _ncc_image_stats(image, halfTemplateSize):
+    """
+    Quantities of ``image`` used by the normalized cross correlation (NCC)
+    in :py:func:`_displacement_method2`. They are calculated only once for
+    the whole image, from the summed-area tables of the image and of its
+    square.
+
+    Returns
+    -------
+    2D ndarray, 2D ndarray
+        image with zero mean and the (not normalized) variance of each sub
+        image with the size of the template, that is,
+        ``sum(sub**2) - sum(sub)**2/size``.
+    """
+
+    image = np.asarray(image, dtype=np.float64)
+    image = image - np.mean(image)  # better numerical precision of the sums
+
+    width = 2 * halfTemplateSize + 1
+
+    sum1 = _window_sums(image, width)
+    sum2 = _window_sums(image**2, width)
+
+    return image, sum2 - sum1**2 / width**2
+
+
+def _subpixel_peak(response, idx_y, idx_x, subpixelFit):
+    """
+    Subpixel position of the maxima at ``(idx_y, idx_x)`` of the stack of
+    correlation maps ``response``, with shape ``(n, rows, cols)``, obtained
+    by fitting a 2D quadratic function to the 3x3 neighbourhood of the
+    maximum (least squares). For ``subpixelFit='gaussian'`` the fit is done
+    with the logarithm of the correlation, which is exact for gaussian
+    peaks. Maxima at the border of the maps, or neighbourhoods without a
+    maximum, are not refined.
+
+    Returns
+    -------
+    dy, dx
+        correction (in the interval [-1, 1]) of the position of the maxima
+    """
+
+    (nImages, nRows, nColumns) = response.shape
+
+    inside = ((idx_y > 0) & (idx_y < nRows - 1) &
+              (idx_x > 0) & (idx_x < nColumns - 1))
+
+    iy = np.clip(idx_y, 1, nRows - 2)
+    ix = np.clip(idx_x, 1, nColumns - 2)
+
+    d = np.arange(-1, 2)
+    neighbourhood = response[np.arange(nImages)[:, None, None],
+                             iy[:, None, None] + d[None, :, None],
+                             ix[:, None, None] + d[None, None, :]]
+
+    if subpixelFit == 'gaussian':
+        neighbourhood = np.log(np.maximum(neighbourhood,
+                                          np.finfo(np.float64).tiny))
+
+    # f(y, x) = c0 + cy*y + cx*x + cyy*y**2 + cxy*x*y + cxx*x**2
+    rows = neighbourhood.sum(axis=2)
+    columns = neighbourhood.sum(axis=1)
+
+    cy = (rows[:, 2] - rows[:, 0]) / 6
+    cx = (columns[:, 2] - columns[:, 0]) / 6
+    cyy = (rows[:, 2] + rows[:, 0] - 2 * rows[:, 1]) / 6
+    cxx = (columns[:, 2] + columns[:, 0] - 2 * columns[:, 1]) / 6
+    cxy = (neighbourhood[:, 2, 2] - neighbourhood[:, 2, 0] -
+           neighbourhood[:, 0, 2] + neighbourhood[:, 0, 0]) / 4
+
+    # maximum: gradient equal to zero
+    det = 4 * cyy * cxx - cxy**2
+    valid = inside & (det > 0) & (cyy < 0) & np.isfinite(det)
+    det[~valid] = 1.0
+
+    dy = np.where(valid, (cxy * cx - 2 * cxx * cy) / det, 0.0)
+    dx = np.where(valid, (cxy * cy - 2 * cyy * cx) / det, 0.0)
+
+    return np.clip(dy, -1, 1), np.clip(dx, -1, 1)
+
+
+def _ncc_response_window(image_centered, image_var, templates,
+                         corner_i, corner_j, response, n):
+    """
+    Normalized cross correlation of the template ``templates[n]`` with the
+    sub image of ``image_centered`` with upper left corner at
+    ``corner_i[n]`` and ``corner_j[n]``, calculated directly (without FFT)
+    for all template positions and written to ``response[n]``. Compiled with
+    numba, see :py:func:`_ncc_response`.
+    """
+
+    template_width = templates.shape[1]
+    nshifts = response.shape[1]
+    eps = np.finfo(np.float64).eps
+
+    template = templates[n] - np.mean(templates[n])
+    template_ssd = np.sum(template**2)
+
+    for sy in range(nshifts):
+        for sx in range(nshifts):
+
+            i0 = corner_i[n] + sy
+            j0 = corner_j[n] + sx
+
+            xcorr = 0.0
+            for a in range(template_width):
+                for b in range(template_width):
+                    xcorr += image_centered[i0 + a, j0 + b] * template[a, b]
+
+            denominator = np.sqrt(max(image_var[i0, j0] * template_ssd, 0.0))
+
+            if denominator > eps:
+                response[n, sy, sx] = xcorr / denominator
+            else:
+                response[n, sy, sx] = 0.0
+
+
+def _ncc_response_serial(image_centered, image_var, templates,
+                         corner_i, corner_j, response):
+    """
+    :py:func:`_ncc_response_window` for all windows.
+    """
+
+    for n in range(templates.shape[0]):
+        _ncc_response_window(image_centered, image_var, templates,
+                             corner_i, corner_j, response, n)
+
+
+def _ncc_response_parallel(image_centered, image_var, templates,
+                           corner_i, corner_j, response):
+    """
+    :py:func:`_ncc_response_window` for all windows, in parallel.
+    """
+
+    for n in numba.prange(templates.shape[0]):
+        _ncc_response_window(image_centered, image_var, templates,
+                             corner_i, corner_j, response, n)
+
+
+if numba is not None:
+    # compiled at the first call, and cached on disk, so the workers of the
+    # process backends do not compile them again
+    _ncc_response_window = numba.njit(nogil=True,
+                                      cache=True)(_ncc_response_window)
+    _ncc_response_serial = numba.njit(nogil=True,
+                                      cache=True)(_ncc_response_serial)
+    _ncc_response_parallel = numba.njit(parallel=True, nogil=True,
+                                        cache=True)(_ncc_response_parallel)
+
+
+_NCC_KERNELS = ('fft', 'numba')
+
+
+def _ncc_kernel():
+    """
+    Kernel of the correlation of the match_template method, given by the
+    environment variable ``WAVEPY_NCC_KERNEL``: ``'fft'`` (default) or
+    ``'numba'``. The environment variable is also seen by the workers of the
+    process backends.
+    """
+
+    kernel = os.environ.get('WAVEPY_NCC_KERNEL', 'fft')
+
+    if kernel not in _NCC_KERNELS:
+        raise ValueError('wavepy: WAVEPY_NCC_KERNEL must be one of ' +
+                         ', '.join(_NCC_KERNELS) + '.')
+
+    if kernel == 'numba' and numba is None:
+        raise ImportError('wavepy: WAVEPY_NCC_KERNEL=numba requires numba.')
+
+    return kernel
+
+
+def _ncc_response(image_stats, image_ref, ii, jj, corner_i, corner_j,
+                  halfsubwidth, halfTemplateSize):
+    """
+    Compiled (numba) alternative to the FFT cross correlation of
+    :py:func:`_displacement_method2`, used with ``WAVEPY_NCC_KERNEL=numba``
+    (see :py:func:`_ncc_kernel`) when no precomputed reference is given. The
+    search and the normalization of all windows run in a single compiled
+    loop. The cost is proportional to the number of shifts times the area of
+    the template, so it is faster than the FFT only for small templates or
+    with ``maxShift``.
+
+    The loop over the windows is parallel (``prange``) only in the main
+    thread of the main process, and only if the numba threading layer was
+    set by the user to ``'workqueue'`` or ``'omp'`` (for instance with the
+    environment variable ``NUMBA_THREADING_LAYER``), since the default
+    (tbb) layer can hang the process backends forked after it is used.
+    Otherwise, and in the workers of the thread and process backends, the
+    serial loop is used.
+
+    Returns
+    -------
+    3D ndarray
+        correlation maps with shape ``(ii.size, nshifts, nshifts)``, the same
+        of the FFT path
+    """
+
+    (image_centered, image_var) = image_stats
+
+    template_width = 2 * halfTemplateSize + 1
+    nshifts = 2 * (halfsubwidth - halfTemplateSize) + 1
+
+    templates = _sliding_windows(image_ref,
+                                 halfTemplateSize)[ii - halfTemplateSize,
+                                                   jj - halfTemplateSize]
+    templates = np.ascontiguousarray(templates.reshape(-1, template_width,
+                                                       template_width),
+                                     dtype=np.float64)
+
+    response = np.empty((templates.shape[0], nshifts, nshifts))
+
+    if (threading.current_thread() is threading.main_thread() and
+            current_process().name == 'MainProcess' and
+            numba.config.THREADING_LAYER in ('workqueue', 'omp')):
+        kernel = _ncc_response_parallel
+    else:
+        kernel = _ncc_response_serial
+
+    kernel(np.ascontiguousarray(image_centered, dtype=np.float64),
+           np.ascontiguousarray(image_var, dtype=np.float64),
+           templates,
+           np.ascontiguousarray(corner_i.ravel(), dtype=np.intp),
+           np.ascontiguousarray(corner_j.ravel(), dtype=np.intp),
+           response)
+
+    return response
+
+
+def _reference_method2(image_ref, ii, jj, halfsubwidth, halfTemplateSize):
+    """
+    Quantities of the templates centered at ``ii`` and ``jj`` used by
+    :py:func:`_displacement_method2`: the conjugate of the FFT of the zero
+    mean templates (with the size of the sub images) and their sum of
+    squares.
+    """
+
+    width = 2 * halfsubwidth + 1
+    template_width = 2 * halfTemplateSize + 1
+
+    template = _sliding_windows(image_ref,
+                                halfTemplateSize)[ii - halfTemplateSize,
+                                                  jj - halfTemplateSize]
+    template = template.reshape(-1, template_width, template_width)
+    template = template - np.mean(template, axis=(1, 2), keepdims=True)
+
+    return (wpfft.rfft2(template, s=(width, width)).conj(),
+            np.sum(template**2, axis=(1, 2)))
+
+
+def _ncc_response_fft(image_stats, image_ref, ii, jj, corner_i, corner_j,
+                      halfsubwidth, halfTemplateSize, reference=None):
+    """
+    Normalized cross correlation of the templates centered at ``ii`` and
+    ``jj`` of ``image_ref`` with the sub images of ``image`` with upper left
+    corner at ``corner_i`` and ``corner_j``, for all template positions. The
+    numerator is calculated with one batched FFT and the denominator from
+    the summed-area tables in ``image_stats``. See
+    :py:func:`_displacement_method2`.
+
+    Returns
+    -------
+    3D ndarray
+        correlation maps with shape ``(ii.size, nshifts, nshifts)``
+    """
+
+    if reference is None:
+        reference = _reference_method2(image_ref, ii, jj,
+                                       halfsubwidth, halfTemplateSize)
+
+    (image_centered, image_var) = image_stats
+    (template_freq_conj, template_ssd) = reference
+
+    width = 2 * halfsubwidth + 1
+    template_width = 2 * halfTemplateSize + 1
+    nshifts = width - template_width + 1
+
+    sub_image = _sliding_windows(image_centered,
+                                 halfsubwidth)[corner_i, corner_j]
+    sub_image = sub_image.reshape(-1, width, width)
+
+    # numerator: cross correlation with the zero mean template
+    xcorr = wpfft.irfft2(wpfft.rfft2(sub_image) * template_freq_conj,
+                          s=(width, width))[:, :nshifts, :nshifts]
+
+    # denominator: local variance of the image at all template positions
+    denominator = _sliding_windows(image_var,
+                                   halfsubwidth -
+                                   halfTemplateSize)[corner_i, corner_j]
+    denominator = denominator.reshape(-1, nshifts, nshifts)
+    denominator = denominator * template_ssd[:, None, None]
+    np.maximum(denominator, 0, out=denominator)
+    np.sqrt(denominator, out=denominator)
+
+    response = np.zeros_like(xcorr)
+    mask = denominator > np.finfo(np.float64).eps
+    response[mask] = xcorr[mask] / denominator[mask]
+
+    return response
+
+
+def _displacement_method2(image, image_ref, ii, jj,
+                          halfsubwidth, halfTemplateSize, image_stats=None,
+                          offset_i=0, offset_j=0, reference=None,
+                          subpixelFit=None):
+    """
+    Displacement of the speckles in the windows centered at the indexes
+    ``ii`` and ``jj`` (arrays of same shape), obtained with the normalized
+    cross correlation of the template (from ``image_ref``) and the sub image
+    (from ``image``).
+
+    The result is the same of :py:func:`skimage.feature.match_template`, but
+    the local sums of the image (normalization) are obtained from the
+    summed-area tables in ``image_stats``, with cost O(1) for each position of
+    the template, and the cross correlation of all windows is calculated
+    with one batched FFT (:py:func:`_ncc_response_fft`). With the
+    environment variable ``WAVEPY_NCC_KERNEL=numba`` and ``reference`` equal
+    to ``None``, the correlation maps are calculated instead by the compiled
+    kernel of :py:func:`_ncc_response`, with the same result.
+
+    The sub images of ``image`` are centered at ``ii + offset_i`` and
+    ``jj + offset_j``, and the offsets are added to the result.
+
+    Parameters
+    ----------
+    image_stats : tuple
+        result of :py:func:`_ncc_image_stats`. If ``None``, it is calculated
+        from ``image``.
+
+    reference : tuple
+        result of :py:func:`_reference_method2` for the same windows. If
+        ``None``, it is calculated from ``image_ref``.
+
+    subpixelFit : str
+        if ``'parabolic'`` or ``'gaussian'``, the position of the maximum of
+        the correlation is refined with :py:func:`_subpixel_peak`.
+
+    Returns
+    -------
+    sx, sy, error
+        arrays with the same shape of ``ii``
+    """
+
+    if image_stats is None:
+        image_stats = _ncc_image_stats(image, halfTemplateSize)
+
+    width = 2 * halfsubwidth + 1
+    template_width = 2 * halfTemplateSize + 1
+    nshifts = width - template_width + 1
+
+    if reference is None and _ncc_kernel() == 'numba':
+        response = _ncc_response(image_stats, image_ref, ii, jj,
+                                 ii + offset_i - halfsubwidth,
+                                 jj + offset_j - halfsubwidth,
+                                 halfsubwidth, halfTemplateSize)
+    else:
+        response = _ncc_response_fft(image_stats, image_ref, ii, jj,
+                                     ii + offset_i - halfsubwidth,
+                                     jj + offset_j - halfsubwidth,
+                                     halfsubwidth, halfTemplateSize,
+                                     reference=reference)
+
+    response = response.reshape(-1, nshifts**2)
+    idx_max = np.argmax(response, axis=1)
+
+    shift_y, shift_x = np.unravel_index(idx_max, (nshifts, nshifts))
+    error = 1.0 - response[np.arange(response.shape[0]), idx_max]
+
+    sx = shift_x - (halfsubwidth - halfTemplateSize)
+    sy = shift_y - (halfsubwidth - halfTemplateSize)
+
+    if subpixelFit is not None:
+        dy, dx = _subpixel_peak(response.reshape(-1, nshifts, nshifts),
+                                shift_y, shift_x, subpixelFit)
+        sx = sx + dx
+        sy = sy + dy
+
+    sx = (sx.reshape(ii.shape) + offset_j).astype(np.float64)
+    sy = (sy.reshape(ii.shape) + offset_i).astype(np.float64)
+
+    return sx, sy, error.reshape(ii.shape)
+
+
+def _search_halfwidth(halfsubwidth, halfTemplateSize, maxShift):
+    """
+    Half size of the sub images actually used by the match_template method
+    to search displacements up to ``maxShift`` pixels. The correlation is
+    calculated only for these shifts, with cost that scales with
+    ``maxShift`` instead of ``halfsubwidth``. The register_translation method
+    (``halfTemplateSize`` is ``None``) always uses the full sub image.
+    """
+
+    if maxShift is None or halfTemplateSize is None:
+        return halfsubwidth
+
+    return min(halfsubwidth, halfTemplateSize + maxShift)
+
+
+def _reference_windows(image_ref, ii, jj, halfsubwidth,
+                       halfTemplateSize, subpixelResolution):
+    """
+    Precomputed quantities of the reference windows centered at the indexes
+    ``ii`` and ``jj``, for the method defined by ``subpixelResolution`` or
+    ``halfTemplateSize``. See :py:func:`_reference_method1` and
+    :py:func:`_reference_method2`.
+    """
+
+    if subpixelResolution is not None:
+        return _reference_method1(image_ref, ii, jj,
+                                  halfsubwidth, subpixelResolution)
+    else:
+        return _reference_method2(image_ref, ii, jj,
+                                  halfsubwidth, halfTemplateSize)
+
+
+def _displacement(image, image_ref, ii, jj, halfsubwidth,
+                  halfTemplateSize, subpixelResolution, image_stats=None,
+                  offsets=None, reference=None, subpixelFit=None,
+                  maxShift=None):
+    """
+    Displacement of the speckles in the windows centered at the indexes
+    ``ii`` and ``jj``, with the method defined by which of
+    ``subpixelResolution`` (register_translation) or ``halfTemplateSize``
+    (match_template) is not ``None``. ``image_stats`` is only used by the
+    match_template method, see :py:func:`_displacement_method2`.
+    ``reference`` are the precomputed quantities of the reference windows,
+    see :py:func:`_reference_windows`, calculated with the same
+    ``maxShift``. ``subpixelFit`` is only used by the match_template method.
+
+    ``maxShift`` is the maximum displacement (in pixels, relative to the
+    ``offsets``) searched, see :py:func:`_search_halfwidth` and
+    :py:func:`_displacement_method1`.
+
+    ``offsets`` is a tuple of two integer arrays with the shape of ``ii``,
+    with the (estimated) displacement where the search is centered. They are
+    limited to keep the sub images inside of ``image``.
+    """
+
+    halfsubwidth = _search_halfwidth(halfsubwidth, halfTemplateSize, maxShift)
+
+    if offsets is None:
+        offset_i = np.zeros(ii.shape, dtype=int)
+        offset_j = np.zeros(ii.shape, dtype=int)
+    else:
+        offset_i = np.clip(ii + offsets[0], halfsubwidth,
+                           image.shape[0] - halfsubwidth - 1) - ii
+        offset_j = np.clip(jj + offsets[1], halfsubwidth,
+                           image.shape[1] - halfsubwidth - 1) - jj
+
+    if subpixelResolution is not None:
+        return _displacement_method1(image, image_ref, ii, jj,
+                                     halfsubwidth, subpixelResolution,
+                                     offset_i=offset_i, offset_j=offset_j,
+                                     reference=reference,
+                                     maxShift=maxShift)
+    else:
+        return _displacement_method2(image, image_ref, ii, jj,
+                                     halfsubwidth, halfTemplateSize,
+                                     image_stats=image_stats,
+                                     offset_i=offset_i, offset_j=offset_j,
+                                     reference=reference,
+                                     subpixelFit=subpixelFit)
+
+
+def _cancelled(progress, done, total):
+    """
+    Report the progress to ``progress``, a
+    :py:class:`wavepy.utils.ProgressCallback` (or ``None``). Returns ``True``
+    if the calculation was cancelled.
+    """
+
+    if progress is None or progress(done, total):
+        return False
+
+    print('MESSAGE: calculation cancelled, returning partial results.')
+
+    return True
+
+
+def _progress_imap(res, total, progress=None):
+    """
+    Yield the results of ``res``, the iterator returned by
+    :py:func:`multiprocessing.Pool.imap_unordered`, as they are completed,
+    with a progress bar and reporting the number of results to
+    ``progress`` (see :py:func:`_cancelled`). Stops if the calculation is
+    cancelled, and then the pool should be terminated by the caller.
+    """
+
+    pbar = tqdm(total=total)  # progress bar
+
+    try:
+        for result in res:
+            pbar.update(1)
+            yield result
+
+            if _cancelled(progress, pbar.n, total):
+                return
+    finally:
+        pbar.close()
+        print('')
+
+
+def _displacement_rows(image, image_ref, grid, rows,
+                       halfsubwidth, halfTemplateSize, subpixelResolution,
+                       out, image_stats=None, offsets=None, reference=None,
+                       subpixelFit=None, mask=None, maxShift=None):
+    """
+    Calculate the displacement of the windows in the rows
+    ``rows[0]:rows[1]`` of ``grid`` and write the result in the arrays
+    ``out = (sx, sy, error)``, with the shape of the grid. ``offsets`` and
+    ``mask`` have the shape of the grid, see
+    :py:func:`_speckleDisplacementSingleCore`. Returns the number of rows.
+    """
+
+    (k0, k1) = rows
+    (sx, sy, error) = out
+
+    ii, jj = np.meshgrid(grid[0][k0:k1], grid[1], indexing='ij')
+
+    if mask is None:
+        block_mask = Ellipsis  # all windows of the block
+    else:
+        block_mask = mask[k0:k1]
+
+        if not np.any(block_mask):
+            return k1 - k0
+
+    ii, jj = ii[block_mask], jj[block_mask]
+
+    if offsets is not None:
+        block_offsets = (offsets[0][k0:k1][block_mask],
+                         offsets[1][k0:k1][block_mask])
+    else:
+        block_offsets = None
+
+    if reference is not None:
+        block_reference = reference._block(k0, k1 - k0)
+        if mask is not None:
+            block_reference = tuple(value[block_mask.ravel()]
+                                    for value in block_reference)
+    else:
+        block_reference = None
+
+    res = _displacement(image, image_ref, ii, jj,
+                        halfsubwidth, halfTemplateSize,
+                        subpixelResolution,
+                        image_stats=image_stats,
+                        offsets=block_offsets,
+                        reference=block_reference,
+                        subpixelFit=subpixelFit,
+                        maxShift=maxShift)
+
+    (sx[k0:k1][block_mask],
+     sy[k0:k1][block_mask],
+     error[k0:k1][block_mask]) = res
+
+    return k1 - k0
+
 
 def _speckleDisplacementSingleCore(image, image_ref,
                                    stride,
                                    halfsubwidth,
                                    halfTemplateSize,
                                    subpixelResolution,
-                                   verbose):
+                                   verbose, grid=None, offsets=None,
+                                   reference=None, subpixelFit=None,
+                                   mask=None, progress=None, maxShift=None,
+                                   checkpoint=None):
+    '''
+    see http://scikit-image.org/docs/dev/auto_examples/transform/plot_register_translation.html
+
+    see http://scikit-image.org/docs/dev/auto_examples/plot_template.html
+
+    The windows are processed in blocks of rows, see
+    :py:func:`_displacement_method1` and :py:func:`_displacement_method2`.
+
+    ``grid`` is a tuple with the row and column indexes of the centers of the
+    windows (default given by ``stride``), and ``offsets`` a tuple of integer
+    arrays with the shape of the grid, see :py:func:`_displacement`.
+
+    ``reference`` is a :py:class:`SpeckleReference` for ``image_ref``, used
+    when its grid is the grid of the calculation. See
+    :py:func:`_displacement_method2` for ``subpixelFit``.
+
+    ``mask`` is a boolean array with the shape of the grid, and only the
+    windows where it is ``True`` are calculated (``NaN`` elsewhere).
+
+    ``progress`` is a :py:class:`wavepy.utils.ProgressCallback`, called
+    after each block with the number of rows done. If it cancels the
+    calculation, the windows not calculated are ``NaN``.
+
+    ``maxShift`` is the maximum displacement searched, see
+    :py:func:`_displacement`.
+
+    ``checkpoint`` is a :py:class:`_Checkpoint`, where each block of rows is
+    saved when it is done.
+    '''
 
     print('MESSAGE: _speckleDisplacementSingleCore:')
     print("MESSAGE: Usind 1 core")
 
     if subpixelResolution is not None:
         if verbose: print('MESSAGE: register_translation method.')
-        return _speckleDisplacementSingleCore_method2(image, image_ref,
-                                                      halfsubwidth,
-                                                      subpixelResolution,
-                                                      stride, verbose)
+        image_stats = None
 
     elif halfTemplateSize is not None:
         if verbose: print('MESSAGE: match_template method.')
-        return _speckleDisplacementSingleCore_method2(image, image_ref,
-                                                      halfsubwidth,
-                                                      halfTemplateSize,
-                                                      stride, verbose)
+        image_stats = _ncc_image_stats(image, halfTemplateSize)
+
+    if grid is None:
+        grid = _speckle_grid(image.shape, halfsubwidth, stride)
+
+    irange, jrange = grid
+
+    if reference is not None and not reference._same_grid(grid, maxShift):
+        reference = None
+
+    pbar = tqdm(total=np.size(irange))  # progress bar
+
+    sx = np.full((np.size(irange), np.size(jrange)), np.nan)
+    sy = np.full((np.size(irange), np.size(jrange)), np.nan)
+    error = np.full((np.size(irange), np.size(jrange)), np.nan)
+
+    nrows = _rows_per_block(np.size(jrange), halfsubwidth)
+
+    for k in range(0, np.size(irange), nrows):
+
+        nrows_done = _displacement_rows(image, image_ref, grid,
+                                        (k, min(k + nrows, np.size(irange))),
+                                        halfsubwidth, halfTemplateSize,
+                                        subpixelResolution, (sx, sy, error),
+                                        image_stats=image_stats,
+                                        offsets=offsets,
+                                        reference=reference,
+                                        subpixelFit=subpixelFit,
+                                        mask=mask, maxShift=maxShift)
+
+        pbar.update(nrows_done)  # update progress bar
+
+        if checkpoint is not None:
+            checkpoint.save((sx, sy, error),
+                            np.s_[k:min(k + nrows, np.size(irange))])
+
+        if _cancelled(progress, min(k + nrows, np.size(irange)),
+                      np.size(irange)):
+            break
+
+    pbar.close()
+    print(" ")
+
+    return (sx, sy, error, stride)
+
+
+# ==============================================================================
+# % Reusable reference image
+# ==============================================================================
+
+
+class SpeckleReference(object):
+    """
+    Reference image with the precomputed quantities of its windows (FFT of
+    the interrogation windows for the register_translation method, FFT and
+    sum of squares of the zero mean templates for the match_template method).
+
+    When many images are tracked against the same reference (time series,
+    scans), an instance of this class can be given to
+    :py:func:`speckleDisplacement` in place of ``image_ref``, and the
+    quantities of the reference are calculated only once. They are stored by
+    blocks of rows of the grid in a cache limited to ``maxMemory`` bytes,
+    where the least recently used blocks are discarded when the limit is
+    reached (and calculated again when needed).
+
+    Parameters
+    ----------
+    image_ref : 2D ndarray
+        reference image (whith no sample).
+
+    halfsubwidth, stride, halfTemplateSize, subpixelResolution, maxShift :
+        parameters of the tracking, see :py:func:`speckleDisplacement`.
+
+    maxMemory : int
+        maximum size in bytes of the cache. Use ``0`` to disable the cache.
+
+    Example
+    -------
+
+    >>> reference = SpeckleReference(image_ref, halfsubwidth=10, stride=2,
+    ...                              halfTemplateSize=4)
+    >>> for image in images:
+    ...     sx, sy, error, stride = speckleDisplacement(image, reference)
+
+    Notes
+    -----
+    The cache is only used by the calculation in a single core and by the
+    ``'threads'`` backend. With the multiprocess backends, only the
+    reference image ``image_ref`` is used.
+    """
+
+    def __init__(self, image_ref, halfsubwidth=10, stride=1,
+                 halfTemplateSize=None, subpixelResolution=None,
+                 maxShift=None, maxMemory=2**30):
+
+        if halfTemplateSize is None and subpixelResolution is None:
+            raise SyntaxError('Either value of halfTemplateSize or' + \
+                               ' subpixelResolution must be provided.')
+
+        if halfTemplateSize is not None and subpixelResolution is not None:
+            raise SyntaxError('wavepy: Either halfTemplateSize or' + \
+                               ' subpixelResolution must be provided, but not both.')
+
+        self.image_ref = np.asarray(image_ref)
+        self.halfsubwidth = halfsubwidth
+        self.stride = stride
+        self.halfTemplateSize = halfTemplateSize
+        self.subpixelResolution = subpixelResolution
+        self.maxShift = maxShift
+        self.maxMemory = maxMemory
+
+        self.grid = _speckle_grid(self.image_ref.shape, halfsubwidth, stride)
+
+        self.hits = 0
+        self.misses = 0
+
+        self._cache = OrderedDict()
+        self._cache_nbytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def shape(self):
+        return self.image_ref.shape
+
+    @property
+    def nbytes(self):
+        """Memory in bytes used by the cache."""
+        return self._cache_nbytes
+
+    def clear(self):
+        """Discard all the precomputed quantities."""
+
+        with self._lock:
+            self._cache.clear()
+            self._cache_nbytes = 0
+
+    def precompute(self):
+        """
+        Calculate the quantities of all windows of the grid (as long as they
+        fit in ``maxMemory``).
+        """
+
+        nrows = _rows_per_block(np.size(self.grid[1]), self.halfsubwidth)
+
+        for k in range(0, np.size(self.grid[0]), nrows):
+            self._block(k, nrows)
+
+    def _same_grid(self, grid, maxShift=None):
+
+        return (np.array_equal(grid[0], self.grid[0]) and
+                np.array_equal(grid[1], self.grid[1]) and
+                maxShift == self.maxShift)
+
+    def _block(self, k, nrows):
+        """
+        Quantities of the windows in the rows ``k:k + nrows`` of the grid,
+        see :py:func:`_reference_windows`.
+        """
+
+        key = (k, nrows)
+
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self._cache[key]
+
+        ii, jj = np.meshgrid(self.grid[0][k:k + nrows], self.grid[1],
+                             indexing='ij')
+
+        block = _reference_windows(self.image_ref, ii, jj,
+                                   _search_halfwidth(self.halfsubwidth,
+                                                     self.halfTemplateSize,
+                                                     self.maxShift),
+                                   self.halfTemplateSize,
+                                   self.subpixelResolution)
+
+        nbytes = sum(value.nbytes for value in block)
+
+        with self._lock:
+            self.misses += 1
+
+            if nbytes > self.maxMemory or key in self._cache:
+                return block
+
+            while self._cache_nbytes + nbytes > self.maxMemory:
+                _, discarded = self._cache.popitem(last=False)
+                self._cache_nbytes -= sum(value.nbytes
+                                          for value in discarded)
+
+            self._cache[key] = block
+            self._cache_nbytes += nbytes
+
+        return block
+
+
+# ==============================================================================
+# % Checkpoint
+# ==============================================================================
+
+
+def _checkpoint_key(image, image_ref, mask, parameters):
+    """
+    Hash of the images, of the mask (with the shape of the grid) and of the
+    parameters of the tracking, identifying the calculation saved in a
+    checkpoint file. The images are read in blocks of rows, so they can be
+    out-of-core arrays.
+    """
+
+    sha = hashlib.sha1()
+
+    for array in (image, image_ref):
+        sha.update('{}{}'.format(array.shape, array.dtype).encode())
+        for i in range(0, array.shape[0], 256):
+            sha.update(np.ascontiguousarray(array[i:i + 256]).tobytes())
+
+    if mask is not None:
+        sha.update(np.packbits(mask).tobytes())
+
+    sha.update(repr(parameters).encode())
+
+    return sha.hexdigest()
+
+
+class _Checkpoint(object):
+    """
+    HDF5 file with the results of the speckle tracking, where each block of
+    windows is written as soon as it is calculated. The file has the
+    datasets ``sx``, ``sy``, ``error`` and ``done`` (windows already
+    calculated), with the shape of the grid, and the attribute ``key`` (see
+    :py:func:`_checkpoint_key`).
+
+    If the file already exists with the same ``key``, its results are
+    loaded: ``done`` marks the windows that do not need to be calculated
+    again, and :py:meth:`merge` adds their values to the new result.
+    Otherwise, a new file is created.
+
+    The file stays open (and is flushed after each block) until
+    :py:meth:`close`. Use it as a context manager, so it is also closed if
+    the tracking is interrupted.
+    """
+
+    def __init__(self, fname, key, grid_shape):
+
+        self.fname = fname
+        self.done = np.zeros(grid_shape, dtype=bool)
+        self.results = None
+
+        if os.path.exists(fname):
+            try:
+                with h5py.File(fname, 'r') as f:
+                    if (f.attrs['key'] == key and
+                            f['done'].shape == tuple(grid_shape)):
+                        self.done = f['done'][()]
+                        self.results = (f['sx'][()], f['sy'][()],
+                                        f['error'][()])
+                    else:
+                        print('MESSAGE: checkpoint ' + fname + ' is from ' +
+                              'a different calculation, starting again.')
+            except (OSError, KeyError):
+                print('MESSAGE: checkpoint ' + fname + ' can not be ' +
+                      'read, starting again.')
+
+        if self.results is None:
+            with h5py.File(fname, 'w') as f:
+                f.attrs['key'] = key
+                f.create_dataset('done', data=self.done)
+                for name in ('sx', 'sy', 'error'):
+                    f.create_dataset(name, shape=grid_shape, dtype='f8',
+                                     fillvalue=np.nan)
+
+        else:
+            print('MESSAGE: resuming from checkpoint ' + fname +
+                  ': %d of %d windows done' % (np.sum(self.done),
+                                               self.done.size))
+
+        self._file = h5py.File(fname, 'r+')
+
+    def save(self, out, index):
+        """
+        Write the windows ``index`` (rows or tuple of slices of the grid) of
+        ``out = (sx, sy, error)`` in the file.
+        """
+
+        for name, array in zip(('sx', 'sy', 'error'), out):
+            self._file[name][index] = array[index]
+
+        self._file['done'][index] = True
+        self._file.flush()
+
+    def close(self):
+        """
+        Flush and close the file. It can be called more than once.
+        """
+
+        if self._file.id.valid:
+            self._file.flush()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def merge(self, res):
+        """
+        Copy the windows loaded from the file to the result
+        ``(sx, sy, error, stride)`` of the tracking.
+        """
+
+        if self.results is not None:
+            for array, saved in zip(res[:3], self.results):
+                array[self.done] = saved[self.done]
+
+        return res
 
 
 # ==============================================================================
@@ -205,6 +1419,36 @@ def _speckleDisplacementSingleCore(image, image_ref,
 
 
 
+# function, points and parameters of the worker processes of the starmap
+# backend
+_pmap_worker = {}
+
+
+def _init_pmap_worker(func, points, parList):
+    """
+    Initializer of the worker processes of
+    :py:func:`_speckleDisplacementMulticore`.
+    """
+
+    _pmap_worker['func'] = func
+    _pmap_worker['points'] = points
+    _pmap_worker['parList'] = parList
+
+
+def _func_4_pmap_chunk(chunk):
+    """
+    Apply the function of the worker to the points ``k0:k1`` of the chunk
+    ``(k0, k1)``. Returns ``k0`` and the list of results.
+    """
+
+    k0, k1 = chunk
+    func = _pmap_worker['func']
+    parList = _pmap_worker['parList']
+
+    return k0, [func(point, parList)
+                for point in _pmap_worker['points'][k0:k1]]
+
+
 def _func_4_starmap_async_method1(args, parList):
     '''
     see http://scikit-image.org/docs/dev/auto_examples/transform/plot_register_translation.html
@@ -215,6 +1459,7 @@ def _func_4_starmap_async_method1(args, parList):
     image_ref = parList[1]
     halfsubwidth = parList[2]
     subpixelResolution = parList[3]
+    maxShift = parList[4]
 
 
     interrogation_window = image_ref[i - halfsubwidth:i + halfsubwidth + 1,
@@ -223,19 +1468,26 @@ def _func_4_starmap_async_method1(args, parList):
     sub_image = image[i - halfsubwidth:i + halfsubwidth + 1,
                 j - halfsubwidth:j + halfsubwidth + 1]
 
+    if maxShift is not None:
+        shift, error_ij = _register_translation_batch(
+                                sub_image[None], interrogation_window[None],
+                                subpixelResolution, maxShift=maxShift)
+        return shift[0, 1], shift[0, 0], error_ij[0]
+
     shift, error_ij, _ = register_translation(sub_image,
                                               interrogation_window,
                                               subpixelResolution)
 
     return shift[1], shift[0], error_ij
 
+
 def _func_4_starmap_async_method2(args, parList):
     '''
     see http://scikit-image.org/docs/dev/auto_examples/plot_template.html
-    '''
-
-    from skimage.feature import match_template
 
+    Since each task has a single window, the summed-area tables are
+    calculated only for the sub image. See :py:func:`_displacement_method2`.
+    '''
 
     i = args[0]
     j = args[1]
@@ -243,94 +1495,1723 @@ def _func_4_starmap_async_method2(args, parList):
     image_ref = parList[1]
     halfsubwidth = parList[2]
     halfTempSize = parList[3]
+    subpixelFit = parList[4]
+    maxShift = parList[5]
 
-
-    #    halfTempSize = halfsubwidth // 4
-
-
-    interrogation_window = image_ref[i - halfTempSize:i + halfTempSize + 1,
-                           j - halfTempSize:j + halfTempSize + 1]
+    halfsubwidth = _search_halfwidth(halfsubwidth, halfTempSize, maxShift)
 
     sub_image = image[i - halfsubwidth:i + halfsubwidth + 1,
-                j - halfsubwidth:j + halfsubwidth + 1]
-
-    result = match_template(sub_image, interrogation_window)
-
-
-    shift_y, shift_x = np.unravel_index(np.argmax(result), result.shape)
+                      j - halfsubwidth:j + halfsubwidth + 1]
 
-    shift_x -= halfsubwidth - halfTempSize
-    shift_y -= halfsubwidth - halfTempSize
+    sub_image_ref = image_ref[i - halfsubwidth:i + halfsubwidth + 1,
+                              j - halfsubwidth:j + halfsubwidth + 1]
 
+    center = np.array([halfsubwidth])
 
-#    sub_image_at_interrogation = image_ref[i - halfTempSize:i + halfTempSize + 1,
-#                                           j - halfTempSize:j + halfTempSize + 1]
-     #    error_ij = 1 -  np.max(result)**2 /np.sum(interrogation_window**2)/np.sum(sub_image_at_interrogation**2)
+    shift_x, shift_y, error_ij = _displacement_method2(sub_image,
+                                                       sub_image_ref,
+                                                       center, center,
+                                                       halfsubwidth,
+                                                       halfTempSize,
+                                                       subpixelFit=subpixelFit)
 
-    error_ij = 1.0 - np.max(result)
+    return shift_x[0], shift_y[0], error_ij[0]
 
-    return shift_x, shift_y, error_ij
 
 def _speckleDisplacementMulticore(image, image_ref, stride,
                                   halfsubwidth, halfTemplateSize,
                                   subpixelResolution,
-                                  ncores, taskPerCore, verbose):
+                                  ncores, taskPerCore, verbose,
+                                  subpixelFit=None, progress=None,
+                                  maxShift=None, mask=None):
+    '''
+    Multicore speckle tracking where each window is a task, and the tasks
+    are sent to the workers in chunks with
+    :py:func:`multiprocessing.Pool.imap_unordered`. Only the windows where
+    ``mask`` (with the shape of the grid) is ``True`` are sent to the
+    workers, and the other windows are ``NaN``. The results are collected
+    chunk by chunk, so a cancellation returns the finished windows.
+    '''
 
     print('MESSAGE: _speckleDisplacementMulticore:')
     print("MESSAGE: %d cpu's available" % cpu_count())
     nprocesses = int(cpu_count() * ncores)
-    p = Pool(processes=nprocesses)
-    print("MESSAGE: Using %d cpu's" % p._processes)
-
-    irange = np.arange(halfsubwidth, image.shape[0] - halfsubwidth + 1, stride)
-    jrange = np.arange(halfsubwidth,image.shape[1] - halfsubwidth + 1, stride)
 
+    irange, jrange = _speckle_grid(image.shape, halfsubwidth, stride)
 
+    if mask is None:
+        mask = np.ones((np.size(irange), np.size(jrange)), dtype=bool)
 
-    ntasks = np.size(irange) * np.size(jrange)
-
-    chunksize = ntasks // p._processes // taskPerCore + 1
+    idx_i, idx_j = np.nonzero(mask)
 
+    ntasks = np.size(idx_i)
 
     if subpixelResolution is not None:
         if verbose: print('MESSAGE: register_translation method.')
-        parList = [image, image_ref, halfsubwidth, subpixelResolution]
+        parList = [image, image_ref, halfsubwidth, subpixelResolution,
+                   maxShift]
         func_4_starmap_async = _func_4_starmap_async_method1
 
     elif halfTemplateSize is not None:
         if verbose: print('MESSAGE: match_template method.')
-        parList = [image, image_ref, halfsubwidth, halfTemplateSize]
+        parList = [image, image_ref, halfsubwidth, halfTemplateSize,
+                   subpixelFit, maxShift]
         func_4_starmap_async = _func_4_starmap_async_method2
 
-    res = p.starmap_async(func_4_starmap_async,
-                          zip(itertools.product(irange, jrange),
-                              itertools.repeat(parList)),
-                          chunksize=chunksize)
+    # the images are sent to each worker only once, and the tasks are only
+    # the ranges of points. Large tasks would block the pool on terminate
+    p = Pool(processes=nprocesses, initializer=_init_pmap_worker,
+             initargs=(func_4_starmap_async,
+                       list(zip(irange[idx_i], jrange[idx_j])), parList))
+    print("MESSAGE: Using %d cpu's" % p._processes)
+
+    chunksize = ntasks // p._processes // taskPerCore + 1
+
+    chunks = [(k0, min(k0 + chunksize, ntasks))
+              for k0 in range(0, ntasks, chunksize)]
+
+    sx = np.full((len(irange), len(jrange)), np.nan)
+    sy = np.full((len(irange), len(jrange)), np.nan)
+    error = np.full((len(irange), len(jrange)), np.nan)
+
+    try:
+        res = p.imap_unordered(_func_4_pmap_chunk, chunks)
+        p.close()  # No more work
+
+        for k0, result in _progress_imap(res, len(chunks), progress):
+            result = np.array(result, dtype=np.float64).reshape(-1, 3)
+            k = slice(k0, k0 + result.shape[0])
+            sx[idx_i[k], idx_j[k]] = result[:, 0]
+            sy[idx_i[k], idx_j[k]] = result[:, 1]
+            error[idx_i[k], idx_j[k]] = result[:, 2]
+    finally:
+        p.terminate()
+        p.join()
+
+    return (sx, sy, error, stride)
+
+
+# ==============================================================================
+# % Data Analysis Multicore, shared memory
+# ==============================================================================
+
+# arrays and parameters of the worker processes of the shared memory backend
+_shared_memory_worker = {}
+
+
+def _ndarray_to_shared_memory(array):
+    """
+    Copy ``array`` to a new block of shared memory. Returns the
+    :py:class:`multiprocessing.shared_memory.SharedMemory` object and the
+    ndarray using it as buffer.
+    """
+
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared_array = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+    shared_array[:] = array
+
+    return shm, shared_array
+
+
+def _init_shared_memory_worker(descriptors, parameters):
+    """
+    Initializer of the worker processes: attach to the shared memory blocks
+    described by ``descriptors``, a dictionary of
+    ``(name, shape, dtype)``.
+    """
+
+    for key, (name, shape, dtype) in descriptors.items():
+        shm = shared_memory.SharedMemory(name=name)
+        _shared_memory_worker[key] = np.ndarray(shape, dtype=dtype,
+                                                buffer=shm.buf)
+        # keep a reference, otherwise the buffer is released
+        _shared_memory_worker['shm_' + key] = shm
+
+    _shared_memory_worker['parameters'] = parameters
+
+
+def _release_shared_memory_worker():
+    """
+    Detach the worker process from the shared memory blocks attached by
+    :py:func:`_init_shared_memory_worker`.
+    """
+
+    shms = [_shared_memory_worker[key] for key in _shared_memory_worker
+            if key.startswith('shm_')]
+
+    # the ndarrays must be released before closing the shared memory
+    _shared_memory_worker.clear()
+
+    for shm in shms:
+        shm.close()
+
+
+def _release_shared_memory(shared):
+    """
+    Close and remove the shared memory blocks in the dictionary ``shared``
+    of ``(SharedMemory, ndarray)`` created with
+    :py:func:`_ndarray_to_shared_memory`.
+    """
+
+    # the ndarrays must be released before closing the shared memory
+    for key in list(shared.keys()):
+        shm = shared.pop(key)[0]
+        shm.close()
+        shm.unlink()
+
+
+def _shared_memory_arrays(image, image_ref, grid_shape, halfTemplateSize,
+                          subpixelResolution, offsets=None, mask=None):
+    """
+    List of ``(key, ndarray)`` to be copied to shared memory for the workers
+    of :py:func:`_func_4_shared_memory`, including the output arrays.
+    """
+
+    if subpixelResolution is not None:
+        arrays = [('image', image)]
+    else:
+        # the NCC only needs the statistics of the image, see
+        # _displacement_method2
+        image_centered, image_var = _ncc_image_stats(image, halfTemplateSize)
+        arrays = [('image', image_centered), ('image_var', image_var)]
+
+    if offsets is not None:
+        arrays += [('offset_i', offsets[0]), ('offset_j', offsets[1])]
+
+    if mask is not None:
+        arrays += [('mask', np.asarray(mask, dtype=bool))]
+
+    arrays += [('image_ref', image_ref),
+               ('sx', np.full(grid_shape, np.nan)),
+               ('sy', np.full(grid_shape, np.nan)),
+               ('error', np.full(grid_shape, np.nan))]
+
+    return arrays
+
+
+def _row_blocks(nrows_grid, nrows, mask=None):
+    """
+    Blocks ``(first row, last row + 1)`` of ``nrows`` rows of a grid with
+    ``nrows_grid`` rows, without the blocks where ``mask`` is all ``False``.
+    """
+
+    blocks = [(k, min(k + nrows, nrows_grid))
+              for k in range(0, nrows_grid, nrows)]
+
+    if mask is not None:
+        blocks = [(k0, k1) for (k0, k1) in blocks if np.any(mask[k0:k1])]
+
+    return blocks
+
+
+def _func_4_shared_memory(rows):
+    """
+    Task of the worker processes: calculate the displacement for the rows
+    ``rows[0]:rows[1]`` of the grid of windows and write the result directly
+    in the shared output arrays. Returns ``rows``, so the main process knows
+    which block is done.
+    """
+
+    (irange, jrange, halfsubwidth, halfTemplateSize,
+     subpixelResolution, subpixelFit,
+     maxShift) = _shared_memory_worker['parameters']
+
+    if 'image_var' in _shared_memory_worker:
+        image_stats = (_shared_memory_worker['image'],
+                       _shared_memory_worker['image_var'])
+    else:
+        image_stats = None
+
+    if 'offset_i' in _shared_memory_worker:
+        offsets = (_shared_memory_worker['offset_i'],
+                   _shared_memory_worker['offset_j'])
+    else:
+        offsets = None
+
+    _displacement_rows(_shared_memory_worker['image'],
+                       _shared_memory_worker['image_ref'],
+                       (irange, jrange), rows,
+                       halfsubwidth, halfTemplateSize,
+                       subpixelResolution,
+                       (_shared_memory_worker['sx'],
+                        _shared_memory_worker['sy'],
+                        _shared_memory_worker['error']),
+                       image_stats=image_stats, offsets=offsets,
+                       subpixelFit=subpixelFit,
+                       mask=_shared_memory_worker.get('mask'),
+                       maxShift=maxShift)
+
+    return rows
+
+
+def _speckleDisplacementSharedMemory(image, image_ref, stride,
+                                     halfsubwidth, halfTemplateSize,
+                                     subpixelResolution,
+                                     ncores, taskPerCore, verbose,
+                                     grid=None, offsets=None,
+                                     subpixelFit=None, mask=None,
+                                     progress=None, maxShift=None,
+                                     checkpoint=None):
+    """
+    Multicore speckle tracking where ``image`` and ``image_ref`` are copied
+    only once to shared memory. Each task is a block of rows of the grid of
+    windows, and the workers write the results directly in shared output
+    arrays, so neither the images nor the results are pickled.
+
+    See :py:func:`_speckleDisplacementSingleCore` for ``grid``, ``offsets``,
+    ``subpixelFit``, ``mask``, ``progress``, ``maxShift`` and
+    ``checkpoint``. Blocks of rows without
+    windows to be calculated in ``mask`` are not sent to the workers.
+    """
+
+    print('MESSAGE: _speckleDisplacementSharedMemory:')
+    print("MESSAGE: %d cpu's available" % cpu_count())
+    nprocesses = int(cpu_count() * ncores)
+
+    if grid is None:
+        grid = _speckle_grid(image.shape, halfsubwidth, stride)
+
+    irange, jrange = grid
+
+    if verbose:
+        if subpixelResolution is not None:
+            print('MESSAGE: register_translation method.')
+        else:
+            print('MESSAGE: match_template method.')
+
+    nrows = min(np.size(irange) // (nprocesses * taskPerCore) + 1,
+                _rows_per_block(np.size(jrange), halfsubwidth))
+
+    blocks = _row_blocks(np.size(irange), nrows, mask)
+
+    arrays = _shared_memory_arrays(image, image_ref,
+                                   (np.size(irange), np.size(jrange)),
+                                   halfTemplateSize, subpixelResolution,
+                                   offsets=offsets, mask=mask)
+
+    shared = {}
+    try:
+        for key, value in arrays:
+            shared[key] = _ndarray_to_shared_memory(np.asarray(value))
+
+        del arrays
+
+        descriptors = {key: (shm.name, array.shape, array.dtype.str)
+                       for key, (shm, array) in shared.items()}
+
+        parameters = (irange, jrange, halfsubwidth, halfTemplateSize,
+                      subpixelResolution, subpixelFit, maxShift)
+
+        p = Pool(processes=nprocesses,
+                 initializer=_init_shared_memory_worker,
+                 initargs=(descriptors, parameters))
+        print("MESSAGE: Using %d cpu's" % p._processes)
+
+        try:
+            total = sum(k1 - k0 for (k0, k1) in blocks)
+            pbar = tqdm(total=total)  # progress bar
+            for (k0, k1) in p.imap_unordered(_func_4_shared_memory, blocks):
+                pbar.update(k1 - k0)
+                if checkpoint is not None:
+                    checkpoint.save((shared['sx'][1], shared['sy'][1],
+                                     shared['error'][1]), np.s_[k0:k1])
+                if _cancelled(progress, pbar.n, total):
+                    break
+            pbar.close()
+            print('')
+        finally:
+            p.terminate()
+            p.join()
+
+        sx = shared['sx'][1].copy()
+        sy = shared['sy'][1].copy()
+        error = shared['error'][1].copy()
+
+    finally:
+        _release_shared_memory(shared)
+
+    return (sx, sy, error, stride)
+
+
+# ==============================================================================
+# % Data Analysis Multicore, threads
+# ==============================================================================
+
+
+def _speckleDisplacementThreads(image, image_ref, stride,
+                                halfsubwidth, halfTemplateSize,
+                                subpixelResolution,
+                                ncores, taskPerCore, verbose,
+                                grid=None, offsets=None, reference=None,
+                                subpixelFit=None, mask=None, progress=None,
+                                maxShift=None, checkpoint=None):
+    """
+    Multicore speckle tracking with a pool of threads. The FFTs of numpy
+    release the GIL, so the threads run in parallel without copying the
+    images or the results between processes. Each task is a block of rows
+    of the grid of windows, see :py:func:`_displacement_rows`.
+
+    See :py:func:`_speckleDisplacementSingleCore` for ``grid``, ``offsets``,
+    ``reference``, ``subpixelFit``, ``mask``, ``progress``, ``maxShift``
+    and ``checkpoint``.
+    """
+
+    print('MESSAGE: _speckleDisplacementThreads:')
+    print("MESSAGE: %d cpu's available" % cpu_count())
+    nthreads = max(int(cpu_count() * ncores), 1)
+    print("MESSAGE: Using %d threads" % nthreads)
+
+    if grid is None:
+        grid = _speckle_grid(image.shape, halfsubwidth, stride)
+
+    irange, jrange = grid
+
+    if subpixelResolution is not None:
+        if verbose: print('MESSAGE: register_translation method.')
+        image_stats = None
+
+    else:
+        if verbose: print('MESSAGE: match_template method.')
+        image_stats = _ncc_image_stats(image, halfTemplateSize)
+
+    if reference is not None and not reference._same_grid(grid, maxShift):
+        reference = None
+
+    nrows = min(np.size(irange) // (nthreads * taskPerCore) + 1,
+                _rows_per_block(np.size(jrange), halfsubwidth))
+
+    blocks = _row_blocks(np.size(irange), nrows, mask)
+
+    grid_shape = (np.size(irange), np.size(jrange))
+
+    sx = np.full(grid_shape, np.nan)
+    sy = np.full(grid_shape, np.nan)
+    error = np.full(grid_shape, np.nan)
+
+    def func_4_threads(rows):
+        return _displacement_rows(image, image_ref, grid, rows,
+                                  halfsubwidth, halfTemplateSize,
+                                  subpixelResolution, (sx, sy, error),
+                                  image_stats=image_stats,
+                                  offsets=offsets,
+                                  reference=reference,
+                                  subpixelFit=subpixelFit,
+                                  mask=mask, maxShift=maxShift)
+
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        futures = {executor.submit(func_4_threads, rows): rows
+                   for rows in blocks}
+
+        total = sum(k1 - k0 for (k0, k1) in blocks)
+        pbar = tqdm(total=total)  # progress bar
+        for future in as_completed(futures):
+            pbar.update(future.result())
+            if checkpoint is not None:
+                checkpoint.save((sx, sy, error), np.s_[slice(*futures[future])])
+            if _cancelled(progress, pbar.n, total):
+                for pending in futures:
+                    pending.cancel()
+                break
+        pbar.close()
+        print('')
+
+    return (sx, sy, error, stride)
+
+
+def _speckleDisplacementBackend(image, image_ref, stride,
+                                halfsubwidth, halfTemplateSize,
+                                subpixelResolution,
+                                ncores, taskPerCore, backend, verbose,
+                                grid=None, offsets=None, reference=None,
+                                subpixelFit=None, mask=None, progress=None,
+                                maxShift=None, checkpoint=None):
+    """
+    Run the speckle tracking with the single core or the multicore
+    ``backend``, according to ``ncores``. See
+    :py:func:`_speckleDisplacementSingleCore` for ``grid``, ``offsets``,
+    ``reference``, ``subpixelFit``, ``mask``, ``progress``, ``maxShift``
+    and ``checkpoint``.
+    """
+
+    if backend not in ('shared_memory', 'starmap', 'threads'):
+        raise ValueError('wavepy: Unknown backend: ' + str(backend))
+
+    if int(cpu_count() * ncores) <= 1:
+
+        return _speckleDisplacementSingleCore(image, image_ref,
+                                              stride=stride,
+                                              halfsubwidth=halfsubwidth,
+                                              halfTemplateSize=halfTemplateSize,
+                                              subpixelResolution=subpixelResolution,
+                                              verbose=verbose,
+                                              grid=grid, offsets=offsets,
+                                              reference=reference,
+                                              subpixelFit=subpixelFit,
+                                              mask=mask,
+                                              progress=progress,
+                                              maxShift=maxShift,
+                                              checkpoint=checkpoint)
+
+    elif backend == 'threads':
+
+        return _speckleDisplacementThreads(image, image_ref,
+                                           stride=stride,
+                                           halfsubwidth=halfsubwidth,
+                                           halfTemplateSize=halfTemplateSize,
+                                           subpixelResolution=subpixelResolution,
+                                           ncores=ncores,
+                                           taskPerCore=taskPerCore,
+                                           verbose=verbose,
+                                           grid=grid, offsets=offsets,
+                                           reference=reference,
+                                           subpixelFit=subpixelFit,
+                                           mask=mask,
+                                           progress=progress,
+                                           maxShift=maxShift,
+                                           checkpoint=checkpoint)
+
+    elif backend == 'shared_memory' and shared_memory is not None:
+
+        return _speckleDisplacementSharedMemory(image, image_ref,
+                                                stride=stride,
+                                                halfsubwidth=halfsubwidth,
+                                                halfTemplateSize=halfTemplateSize,
+                                                subpixelResolution=subpixelResolution,
+                                                ncores=ncores,
+                                                taskPerCore=taskPerCore,
+                                                verbose=verbose,
+                                                grid=grid, offsets=offsets,
+                                                subpixelFit=subpixelFit,
+                                                mask=mask,
+                                                progress=progress,
+                                                maxShift=maxShift,
+                                                checkpoint=checkpoint)
+
+    elif grid is not None or offsets is not None or checkpoint is not None:
+
+        print('MESSAGE: starmap backend does not support custom grid, ' +
+              'offsets or checkpoint, using 1 core.')
+
+        return _speckleDisplacementSingleCore(image, image_ref,
+                                              stride=stride,
+                                              halfsubwidth=halfsubwidth,
+                                              halfTemplateSize=halfTemplateSize,
+                                              subpixelResolution=subpixelResolution,
+                                              verbose=verbose,
+                                              grid=grid, offsets=offsets,
+                                              reference=reference,
+                                              subpixelFit=subpixelFit,
+                                              mask=mask,
+                                              progress=progress,
+                                              maxShift=maxShift,
+                                              checkpoint=checkpoint)
+
+    else:
+
+        return _speckleDisplacementMulticore(image, image_ref,
+                                             stride=stride,
+                                             halfsubwidth=halfsubwidth,
+                                             halfTemplateSize=halfTemplateSize,
+                                             subpixelResolution=subpixelResolution,
+                                             ncores=ncores,
+                                             taskPerCore=taskPerCore,
+                                             verbose=verbose,
+                                             subpixelFit=subpixelFit,
+                                             progress=progress,
+                                             maxShift=maxShift,
+                                             mask=mask)
+
+
+# ==============================================================================
+# % Persistent worker pool
+# ==============================================================================
+
+
+def _func_4_tracker(task):
+    """
+    Task of the worker processes of :py:class:`SpeckleTracker`. As the pool
+    is used for many pairs of images, the shared memory of each pair is
+    attached (and released) by each task, see
+    :py:func:`_func_4_shared_memory`.
+    """
+
+    (descriptors, parameters, rows) = task
+
+    _init_shared_memory_worker(descriptors, parameters)
+
+    try:
+        return _func_4_shared_memory(rows)
+    finally:
+        _release_shared_memory_worker()
+
+
+class SpeckleTracker(object):
+    """
+    Session for the speckle tracking of many pairs of images with the same
+    parameters. The pool of worker processes is created only once, when
+    entering the context, and it is closed when leaving it.
+
+    The pairs of images given to :py:meth:`track` are processed as in the
+    ``'shared_memory'`` backend of :py:func:`speckleDisplacement`. The next
+    pair is copied to shared memory and submitted to the pool before the
+    result of the current pair is collected, so the workers are never idle
+    waiting for the main process.
+
+    Parameters
+    ----------
+    halfsubwidth, stride, halfTemplateSize, subpixelResolution, subpixelFit,
+    maxShift, ncores, verbose :
+        see :py:func:`speckleDisplacement`. If ``ncores`` corresponds to a
+        single cpu, the images are processed in the main process, without
+        pool.
+
+    taskPerCore : int
+        number of tasks (blocks of rows) of each pair sent to each process.
+
+    Example
+    -------
+
+    >>> with SpeckleTracker(halfsubwidth=10, stride=2,
+    ...                     halfTemplateSize=4, ncores=1) as tracker:
+    ...     for sx, sy, error, stride in tracker.track(zip(images,
+    ...                                                    images_ref)):
+    ...         results.append((sx, sy))
+
+    """
+
+    def __init__(self, halfsubwidth=10, stride=1,
+                 halfTemplateSize=None, subpixelResolution=None,
+                 subpixelFit=None, maxShift=None, ncores=1/2,
+                 taskPerCore=4, verbose=False):
+
+        if halfTemplateSize is None and subpixelResolution is None:
+            raise SyntaxError('Either value of halfTemplateSize or' + \
+                               ' subpixelResolution must be provided.')
+
+        if halfTemplateSize is not None and subpixelResolution is not None:
+            raise SyntaxError('wavepy: Either halfTemplateSize or' + \
+                               ' subpixelResolution must be provided, but not both.')
+
+        if ncores < 0 or ncores > 1: ncores = 1
+
+        self.halfsubwidth = halfsubwidth
+        self.stride = stride
+        self.halfTemplateSize = halfTemplateSize
+        self.subpixelResolution = subpixelResolution
+        self.subpixelFit = subpixelFit
+        self.maxShift = maxShift
+        self.taskPerCore = taskPerCore
+        self.verbose = verbose
+
+        self.nprocesses = int(cpu_count() * ncores)
+
+        self._pool = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        """Create the pool of worker processes."""
+
+        if (self._pool is None and self.nprocesses > 1 and
+                shared_memory is not None):
+            # the workers must share the resource tracker of this process,
+            # which registers the shared memory blocks created later
+            resource_tracker.ensure_running()
+            self._pool = Pool(processes=self.nprocesses)
+            print("MESSAGE: SpeckleTracker: Using %d cpu's" %
+                  self._pool._processes)
+
+    def close(self):
+        """Terminate the pool of worker processes."""
+
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def _submit(self, image, image_ref):
+        """
+        Copy the pair of images to shared memory and send the tasks to the
+        pool. Returns the shared memory blocks and the
+        :py:class:`multiprocessing.pool.AsyncResult`.
+        """
+
+        irange, jrange = _speckle_grid(np.shape(image), self.halfsubwidth,
+                                       self.stride)
+
+        nrows = min(np.size(irange) // (self.nprocesses *
+                                        self.taskPerCore) + 1,
+                    _rows_per_block(np.size(jrange), self.halfsubwidth))
+
+        arrays = _shared_memory_arrays(image, image_ref,
+                                       (np.size(irange), np.size(jrange)),
+                                       self.halfTemplateSize,
+                                       self.subpixelResolution)
+
+        shared = {}
+        try:
+            for key, value in arrays:
+                shared[key] = _ndarray_to_shared_memory(np.asarray(value))
+
+            del arrays
+
+            descriptors = {key: (shm.name, array.shape, array.dtype.str)
+                           for key, (shm, array) in shared.items()}
+
+            parameters = (irange, jrange, self.halfsubwidth,
+                          self.halfTemplateSize, self.subpixelResolution,
+                          self.subpixelFit, self.maxShift)
+
+            tasks = [(descriptors, parameters, rows)
+                     for rows in _row_blocks(np.size(irange), nrows)]
+
+            result = self._pool.map_async(_func_4_tracker, tasks,
+                                          chunksize=1)
+
+        except BaseException:
+            _release_shared_memory(shared)
+            raise
+
+        return shared, result
+
+    def _collect(self, job):
+        """
+        Wait for the result of a job created by :py:meth:`_submit`.
+        """
+
+        (shared, result) = job
+
+        try:
+            result.get()
+
+            return (shared['sx'][1].copy(), shared['sy'][1].copy(),
+                    shared['error'][1].copy(), self.stride)
+        finally:
+            _release_shared_memory(shared)
+
+    def track(self, pairs):
+        """
+        Speckle tracking of the pairs of images ``(image, image_ref)`` of the
+        iterable ``pairs`` (a list or a generator).
+
+        Yields
+        ------
+        sx, sy, error, stride
+            results of each pair, in the same order of ``pairs``. See
+            :py:func:`speckleDisplacement`.
+        """
+
+        self.open()
+
+        if self._pool is None:
+            for image, image_ref in pairs:
+                yield _speckleDisplacementSingleCore(
+                        image, image_ref,
+                        stride=self.stride,
+                        halfsubwidth=self.halfsubwidth,
+                        halfTemplateSize=self.halfTemplateSize,
+                        subpixelResolution=self.subpixelResolution,
+                        verbose=self.verbose,
+                        subpixelFit=self.subpixelFit,
+                        maxShift=self.maxShift)
+            return
+
+        pending = []
+        try:
+            for image, image_ref in pairs:
+                pending.append(self._submit(image, image_ref))
+
+                # the next pair is already submitted
+                if len(pending) > 1:
+                    yield self._collect(pending.pop(0))
+
+            while pending:
+                yield self._collect(pending.pop(0))
+
+        finally:
+            for (shared, result) in pending:
+                result.wait()
+                _release_shared_memory(shared)
+
+
+# ==============================================================================
+# % Coarse-to-fine (pyramid) tracking
+# ==============================================================================
+
+
+def _downsample2(image):
+    """
+    Downsample ``image`` by a factor 2 in both directions, by averaging
+    blocks of 2x2 pixels. The last row (column) is ignored for odd number of
+    rows (columns).
+    """
+
+    nRows = image.shape[0] // 2
+    nColumns = image.shape[1] // 2
+
+    return np.mean(np.asarray(image[:2 * nRows, :2 * nColumns],
+                              dtype=np.float64).reshape(nRows, 2,
+                                                        nColumns, 2),
+                   axis=(1, 3))
+
+
+def _pyramid_grid(grid, level, shape, halfsubwidth):
+    """
+    Indexes at the pyramid ``level`` (image ``shape``) of the pixels that
+    contain the points of the full resolution ``grid``, limited to windows
+    of size ``halfsubwidth`` inside of the image. Returns the (unique)
+    indexes at the pyramid level and the position of each point of
+    ``grid`` on them.
+    """
+
+    level_grid = []
+    position = []
+
+    for idx, size in zip(grid, shape):
+        idx_level = np.clip(idx >> level, halfsubwidth,
+                            size - halfsubwidth - 1)
+        unique, inverse = np.unique(idx_level, return_inverse=True)
+        level_grid.append(unique)
+        position.append(inverse)
+
+    return level_grid, position
+
+
+def _nearest_index(sorted_array, values):
+    """
+    Index of the element of ``sorted_array`` nearest to each of ``values``.
+    """
+
+    idx = np.clip(np.searchsorted(sorted_array, values),
+                  1, max(np.size(sorted_array) - 1, 1))
+    idx = np.minimum(idx, np.size(sorted_array) - 1)
+    left = sorted_array[idx - 1]
+    right = sorted_array[idx]
+
+    return np.where(np.abs(values - left) <= np.abs(right - values),
+                    idx - 1, idx)
+
+
+def _speckleDisplacementPyramid(image, image_ref, stride,
+                                halfsubwidth, halfTemplateSize,
+                                subpixelResolution,
+                                pyramidLevels, halfsubwidthRefine,
+                                ncores, taskPerCore, backend, verbose,
+                                subpixelFit=None, progress=None,
+                                maxShift=None, mask=None):
+    """
+    Coarse-to-fine speckle tracking. The displacement is first obtained
+    (with the full ``halfsubwidth`` range, in pixels of that level) at the
+    coarsest level of a pyramid of images downsampled by ``2**pyramidLevels``.
+    At each finer level, up to the full resolution, the result of the
+    previous level is (median filtered and) upsampled and used as the center
+    of a search with the small sub images of size ``halfsubwidthRefine``. The
+    result has the same grid of :py:func:`speckleDisplacement` with the same
+    ``stride``. The ``subpixelFit`` is only applied at the finest level,
+    and ``maxShift`` (in pixels of the full resolution) only limits the full
+    search at the coarsest level. ``mask``, with the shape of the grid, is
+    only used at the finest level, as the coarse levels are needed to
+    estimate the displacement of all windows.
+
+    If ``progress`` cancels the calculation, the (partial) result of the
+    current level, scaled to the full resolution, is returned.
+    """
+
+    images = [image]
+    images_ref = [image_ref]
+    for level in range(pyramidLevels):
+        images.append(_downsample2(images[-1]))
+        images_ref.append(_downsample2(images_ref[-1]))
+
+    grid = _speckle_grid(image.shape, halfsubwidth, stride)
+
+    offsets = None
+
+    for level in range(pyramidLevels, -1, -1):
+
+        if halfTemplateSize is not None:
+            templ_level = max(halfTemplateSize >> level, 2)
+        else:
+            templ_level = None
+
+        if level == pyramidLevels:  # coarsest level, full search
+            half_level = max(halfsubwidth >> level, 1)
+            if templ_level is not None:
+                half_level = max(half_level, templ_level + 1)
+        elif halfTemplateSize is not None:
+            half_level = templ_level + max(halfsubwidthRefine -
+                                           halfTemplateSize, 1)
+        else:
+            half_level = halfsubwidthRefine
+
+        if subpixelResolution is not None and level > 0:
+            subpixel_level = 1
+        else:
+            subpixel_level = subpixelResolution
+
+        fit_level = subpixelFit if level == 0 else None
+
+        if maxShift is not None and level == pyramidLevels:
+            shift_level = -(-maxShift >> level)  # rounded up
+        else:
+            shift_level = None
+
+        level_mask = None
+
+        if verbose:
+            print('MESSAGE: pyramid level %d: ' % level +
+                  'halfsubwidth = %d' % half_level)
+
+        level_grid, position = _pyramid_grid(grid, level,
+                                             images[level].shape,
+                                             half_level)
+
+        if level < pyramidLevels:
+            # upsample the result of the previous (coarser) level. The median
+            # filter avoids the propagation of outliers.
+            near = np.ix_(_nearest_index(2 * prev_grid[0], level_grid[0]),
+                          _nearest_index(2 * prev_grid[1], level_grid[1]))
+
+            offsets = (np.round(2 * median_filter(sy, 3)[near]).astype(int),
+                       np.round(2 * median_filter(sx, 3)[near]).astype(int))
+
+        if mask is not None and level == 0:
+            level_mask = np.zeros((np.size(level_grid[0]),
+                                   np.size(level_grid[1])), dtype=bool)
+            np.logical_or.at(level_mask, np.ix_(position[0], position[1]),
+                             mask)
+
+        sx, sy, error, _ = _speckleDisplacementBackend(
+                                images[level], images_ref[level],
+                                stride=stride,
+                                halfsubwidth=half_level,
+                                halfTemplateSize=templ_level,
+                                subpixelResolution=subpixel_level,
+                                ncores=ncores,
+                                taskPerCore=taskPerCore,
+                                backend=backend,
+                                verbose=verbose,
+                                grid=level_grid, offsets=offsets,
+                                subpixelFit=fit_level,
+                                progress=progress,
+                                maxShift=shift_level,
+                                mask=level_mask)
+
+        if progress is not None and progress.cancelled:
+            break
+
+        prev_grid = level_grid
+
+    full_grid = np.ix_(position[0], position[1])
+
+    sx = sx[full_grid] * 2**level
+    sy = sy[full_grid] * 2**level
+    error = error[full_grid]
+
+    if mask is not None:
+        sx[~mask] = sy[~mask] = error[~mask] = np.nan
+
+    return (sx, sy, error, stride)
+
+
+# ==============================================================================
+# % Adaptive stride
+# ==============================================================================
+
+
+def _linear_weights(nodes, npoints):
+    """
+    Indexes and weights for the linear interpolation of values at the
+    (sorted) integer positions ``nodes`` to the positions ``0..npoints-1``.
+    """
+
+    x = np.arange(npoints)
+    k = np.clip(np.searchsorted(nodes, x, side='right') - 1,
+                0, np.size(nodes) - 2)
+    weight = (x - nodes[k]) / (nodes[k + 1] - nodes[k])
+
+    return k, weight
+
+
+def _interpolate_coarse(values, nodes_i, nodes_j, shape):
+    """
+    Bilinear interpolation of ``values``, defined at the rows ``nodes_i``
+    and columns ``nodes_j`` of the fine grid, to all the fine grid (with
+    shape ``shape``).
+    """
+
+    ki, wi = _linear_weights(nodes_i, shape[0])
+    kj, wj = _linear_weights(nodes_j, shape[1])
+
+    values = (values[ki] * (1 - wi)[:, None] +
+              values[ki + 1] * wi[:, None])
+
+    return values[:, kj] * (1 - wj) + values[:, kj + 1] * wj
+
+
+def _adaptive_mask(sx, sy, error, nodes_i, nodes_j, shape,
+                   errorThreshold, gradientThreshold):
+    """
+    Points of the fine grid to be calculated again in the adaptive stride
+    mode. A cell of the coarse grid (four neighbour coarse points) is
+    refined if the error at any of its corners is larger than
+    ``errorThreshold``, if the displacement changes by more than
+    ``gradientThreshold`` pixels between its corners, or if any corner is
+    ``NaN``. The points of the coarse grid are not refined.
+    """
+
+    corners = [np.s_[:-1, :-1], np.s_[1:, :-1], np.s_[:-1, 1:], np.s_[1:, 1:]]
+
+    refine = np.zeros((np.size(nodes_i) - 1, np.size(nodes_j) - 1),
+                      dtype=bool)
+
+    for array in (sx, sy, error):
+        refine |= np.any([np.isnan(array[c]) for c in corners], axis=0)
+
+    if errorThreshold is not None:
+        refine |= np.any([error[c] > errorThreshold for c in corners], axis=0)
+
+    if gradientThreshold is not None:
+        for array in (sx, sy):
+            variation = (np.max([array[c] for c in corners], axis=0) -
+                         np.min([array[c] for c in corners], axis=0))
+            refine |= variation > gradientThreshold
+
+    # cells of each fine point. Points in the border of two cells belong to
+    # both of them
+    idx_i = [np.clip(np.searchsorted(nodes_i, np.arange(shape[0]), side) - d,
+                     0, np.size(nodes_i) - 2)
+             for side, d in (('left', 1), ('right', 1))]
+    idx_j = [np.clip(np.searchsorted(nodes_j, np.arange(shape[1]), side) - d,
+                     0, np.size(nodes_j) - 2)
+             for side, d in (('left', 1), ('right', 1))]
+
+    mask = np.zeros(shape, dtype=bool)
+    for cell_i, cell_j in itertools.product(idx_i, idx_j):
+        mask |= refine[np.ix_(cell_i, cell_j)]
+
+    mask[np.ix_(nodes_i, nodes_j)] = False
+
+    return mask
+
+
+def _speckleDisplacementAdaptive(image, image_ref, stride,
+                                 halfsubwidth, halfTemplateSize,
+                                 subpixelResolution, adaptiveStride,
+                                 errorThreshold, gradientThreshold,
+                                 ncores, taskPerCore, backend, verbose,
+                                 reference=None, subpixelFit=None,
+                                 progress=None, maxShift=None, mask=None):
+    """
+    Speckle tracking with adaptive stride. The displacement is first
+    obtained in a coarse grid, with ``adaptiveStride`` times the ``stride``,
+    and interpolated to the fine grid (given by ``stride``). The windows of
+    the fine grid are then calculated again only where the coarse result is
+    not reliable or not smooth, see :py:func:`_adaptive_mask`. Only the
+    windows where ``mask`` (with the shape of the fine grid) is ``True`` are
+    calculated, in both grids, and the others are ``NaN``.
+
+    If ``progress`` cancels the calculation, the points not calculated in
+    the fine grid keep the value interpolated from the coarse grid.
+    """
+
+    grid = _speckle_grid(image.shape, halfsubwidth, stride)
+    shape = (np.size(grid[0]), np.size(grid[1]))
+
+    # the last point is always included, so the coarse grid covers the
+    # fine grid
+    nodes_i = np.unique(np.r_[np.arange(0, shape[0], adaptiveStride),
+                              shape[0] - 1])
+    nodes_j = np.unique(np.r_[np.arange(0, shape[1], adaptiveStride),
+                              shape[1] - 1])
+
+    if np.size(nodes_i) < 2 or np.size(nodes_j) < 2:
+        refine = mask
+        sx = sy = error = None
+
+    else:
+        if verbose:
+            print('MESSAGE: adaptive stride: coarse grid')
+
+        (sx_coarse,
+         sy_coarse,
+         error_coarse, _) = _speckleDisplacementBackend(
+                                image, image_ref,
+                                stride=stride,
+                                halfsubwidth=halfsubwidth,
+                                halfTemplateSize=halfTemplateSize,
+                                subpixelResolution=subpixelResolution,
+                                ncores=ncores,
+                                taskPerCore=taskPerCore,
+                                backend=backend,
+                                verbose=verbose,
+                                grid=(grid[0][nodes_i], grid[1][nodes_j]),
+                                subpixelFit=subpixelFit,
+                                progress=progress,
+                                maxShift=maxShift,
+                                mask=(None if mask is None else
+                                      mask[np.ix_(nodes_i, nodes_j)]))
+
+        refine = _adaptive_mask(sx_coarse, sy_coarse, error_coarse,
+                                nodes_i, nodes_j, shape,
+                                errorThreshold, gradientThreshold)
+
+        sx = _interpolate_coarse(sx_coarse, nodes_i, nodes_j, shape)
+        sy = _interpolate_coarse(sy_coarse, nodes_i, nodes_j, shape)
+        error = _interpolate_coarse(error_coarse, nodes_i, nodes_j, shape)
+
+        coarse = np.ix_(nodes_i, nodes_j)
+        sx[coarse], sy[coarse], error[coarse] = (sx_coarse, sy_coarse,
+                                                 error_coarse)
+
+        if mask is not None:
+            # the interpolation also fills the windows outside of the mask
+            refine &= mask
+            sx[~mask] = sy[~mask] = error[~mask] = np.nan
+
+        if verbose:
+            print('MESSAGE: adaptive stride: refining ' +
+                  '%d of %d points' % (np.sum(refine), refine.size))
+
+        if not np.any(refine) or (progress is not None and
+                                  progress.cancelled):
+            return (sx, sy, error, stride)
+
+    (sx_fine,
+     sy_fine,
+     error_fine, _) = _speckleDisplacementBackend(
+                            image, image_ref,
+                            stride=stride,
+                            halfsubwidth=halfsubwidth,
+                            halfTemplateSize=halfTemplateSize,
+                            subpixelResolution=subpixelResolution,
+                            ncores=ncores,
+                            taskPerCore=taskPerCore,
+                            backend=backend,
+                            verbose=verbose,
+                            grid=grid,
+                            reference=reference,
+                            subpixelFit=subpixelFit,
+                            mask=refine,
+                            progress=progress,
+                            maxShift=maxShift)
+
+    if sx is None:
+        return (sx_fine, sy_fine, error_fine, stride)
+
+    refine &= ~np.isnan(error_fine)  # only the calculated points
+
+    sx[refine], sy[refine], error[refine] = (sx_fine[refine],
+                                             sy_fine[refine],
+                                             error_fine[refine])
+
+    return (sx, sy, error, stride)
+
+
+# ==============================================================================
+# % Multi-frame (speckle vector) tracking
+# ==============================================================================
+
+
+def _displacement_vectors(images, images_ref, rows, jrange,
+                          halfsubwidth, halfTemplateSize, subpixelFit=None,
+                          maxShift=None):
+    """
+    Displacement obtained from the normalized cross correlation of the
+    vectors formed by the pixels of the windows of size
+    ``2*halfTemplateSize + 1`` of all the ``N`` frames of the stacks
+    ``images`` and ``images_ref``. The windows are centered at the rows
+    ``rows`` and columns ``jrange`` of the reference stack, and all the
+    shifts up to ``halfsubwidth - halfTemplateSize`` pixels (or up to
+    ``maxShift``, if smaller) are tested.
+
+    ``images`` and ``images_ref`` have shape ``(N, nrows, ncols)``, and
+    ``rows`` are indexes of these arrays. The correlation of each shift is
+    calculated for all windows at once from summed-area tables, with cost
+    proportional to the number of pixels of the vectors.
+
+    Returns
+    -------
+    sx, sy, error
+        arrays with shape ``(len(rows), len(jrange))``
+    """
+
+    nframes = images.shape[0]
+    width = 2 * halfTemplateSize + 1
+    size = nframes * width**2
+    nshifts = halfsubwidth - halfTemplateSize
+    if maxShift is not None:
+        nshifts = min(nshifts, maxShift)
+
+    def box(array, ri, rj):
+        # sums over the windows centered at ri, rj
+        sums = _window_sums(array, width)
+        return sums[np.ix_(ri - halfTemplateSize, rj - halfTemplateSize)]
+
+    ref_sum1 = box(np.sum(images_ref, axis=0), rows, jrange)
+    ref_var = box(np.sum(images_ref**2, axis=0), rows, jrange)
+    ref_var -= ref_sum1**2 / size
+
+    image_sum1 = _window_sums(np.sum(images, axis=0), width)
+    image_sum2 = _window_sums(np.sum(images**2, axis=0), width)
+
+    # region of images_ref used by the windows, and the same region shifted
+    # in images
+    (nRows, nColumns) = images.shape[1:]
+    region_i = slice(nshifts, nRows - nshifts)
+    region_j = slice(nshifts, nColumns - nshifts)
+    ref_region = images_ref[:, region_i, region_j]
+
+    response = np.zeros((np.size(rows), np.size(jrange),
+                         2 * nshifts + 1, 2 * nshifts + 1))
+
+    for dy, dx in itertools.product(range(-nshifts, nshifts + 1), repeat=2):
+
+        shifted = images[:, nshifts + dy:nRows - nshifts + dy,
+                         nshifts + dx:nColumns - nshifts + dx]
+
+        product = np.einsum('kij,kij->ij', ref_region, shifted)
+        product = box(product, rows - nshifts, jrange - nshifts)
+
+        idx = np.ix_(rows + dy - halfTemplateSize,
+                     jrange + dx - halfTemplateSize)
+        image_var = image_sum2[idx] - image_sum1[idx]**2 / size
+
+        numerator = product - ref_sum1 * image_sum1[idx] / size
+        denominator = np.sqrt(np.maximum(ref_var * image_var, 0))
+
+        mask = denominator > np.finfo(np.float64).eps
+        response[..., dy + nshifts, dx + nshifts][mask] = (numerator[mask] /
+                                                          denominator[mask])
+
+    nwindows = np.size(rows) * np.size(jrange)
+    response = response.reshape(nwindows, 2 * nshifts + 1, 2 * nshifts + 1)
+    idx_max = np.argmax(response.reshape(nwindows, -1), axis=1)
+
+    shift_y, shift_x = np.unravel_index(idx_max, response.shape[1:])
+    error = 1.0 - response.reshape(nwindows, -1)[np.arange(nwindows), idx_max]
+
+    sx = (shift_x - nshifts).astype(np.float64)
+    sy = (shift_y - nshifts).astype(np.float64)
+
+    if subpixelFit is not None:
+        dy, dx = _subpixel_peak(response, shift_y, shift_x, subpixelFit)
+        sx += dx
+        sy += dy
+
+    shape = (np.size(rows), np.size(jrange))
+
+    return sx.reshape(shape), sy.reshape(shape), error.reshape(shape)
+
+
+def _speckleDisplacementVectors(images, images_ref, stride,
+                                halfsubwidth, halfTemplateSize, verbose,
+                                subpixelFit=None, progress=None,
+                                maxShift=None, mask=None):
+    """
+    Speckle vector tracking of the stacks of ``N`` images ``images`` and
+    ``images_ref`` (for instance for ``N`` positions of the diffuser), see
+    :py:func:`_displacement_vectors`. The calculation is done in blocks of
+    rows, and only the rows of the stacks required by each block are
+    converted to float. See :py:func:`_displacement_vectors` for
+    ``maxShift``. The blocks of rows without windows inside of ``mask``
+    (with the shape of the grid) are skipped, and the windows outside of
+    ``mask`` are ``NaN``.
+    """
+
+    print('MESSAGE: _speckleDisplacementVectors:')
+
+    (nframes, nRows, nColumns) = images.shape
+
+    if verbose:
+        print('MESSAGE: %d frames, ' % nframes +
+              'vectors of %d pixels' % (nframes *
+                                        (2 * halfTemplateSize + 1)**2))
+
+    irange, jrange = _speckle_grid((nRows, nColumns), halfsubwidth, stride)
+
+    sx = np.full((np.size(irange), np.size(jrange)), np.nan)
+    sy = np.full((np.size(irange), np.size(jrange)), np.nan)
+    error = np.full((np.size(irange), np.size(jrange)), np.nan)
+
+    # the mean of the stacks, for better numerical precision of the sums
+    mean = np.mean(images)
+    mean_ref = np.mean(images_ref)
+
+    nshifts = halfsubwidth - halfTemplateSize
+    if maxShift is not None:
+        nshifts = min(nshifts, maxShift)
+
+    # memory of the stacks and of the correlation of each row of the grid
+    npixels_row = max(nframes * nColumns * stride,
+                      np.size(jrange) * (2 * nshifts + 1)**2)
+    nrows = max(_BLOCK_NPIXELS // npixels_row, 1)
+
+    pbar = tqdm(total=np.size(irange))  # progress bar
+
+    for k in range(0, np.size(irange), nrows):
 
-    p.close()  # No more work
+        rows = irange[k:k + nrows]
+        i0, i1 = rows[0] - halfsubwidth, rows[-1] + halfsubwidth + 1
 
-    wpu.progress_bar4pmap(res)  # Holds the program in a loop waiting
-                                 # starmap_async to finish
+        if mask is not None and not np.any(mask[k:k + nrows]):
+            pbar.update(np.size(rows))
+            if _cancelled(progress, k + np.size(rows), np.size(irange)):
+                break
+            continue
 
-    sx = np.array(res.get())[:, 0].reshape(len(irange), len(jrange))
-    sy = np.array(res.get())[:, 1].reshape(len(irange), len(jrange))
-    error = np.array(res.get())[:, 2].reshape(len(irange), len(jrange))
+        (sx[k:k + nrows],
+         sy[k:k + nrows],
+         error[k:k + nrows]) = _displacement_vectors(
+                                    np.asarray(images[:, i0:i1],
+                                               dtype=np.float64) - mean,
+                                    np.asarray(images_ref[:, i0:i1],
+                                               dtype=np.float64) - mean_ref,
+                                    rows - i0, jrange,
+                                    halfsubwidth, halfTemplateSize,
+                                    subpixelFit=subpixelFit,
+                                    maxShift=maxShift)
+
+        pbar.update(np.size(rows))  # update progress bar
+
+        if _cancelled(progress, k + np.size(rows), np.size(irange)):
+            break
+
+    pbar.close()
+    print(" ")
+
+    if mask is not None:
+        sx[~mask] = sy[~mask] = error[~mask] = np.nan
 
     return (sx, sy, error, stride)
 
 
+# ==============================================================================
+# % Out-of-core (tiled) tracking
+# ==============================================================================
+
+
+def _is_out_of_core(array):
+    """
+    ``True`` if ``array`` is a :py:class:`numpy.memmap` or an array-like
+    object that is not a :py:class:`numpy.ndarray` (for instance a
+    :py:class:`h5py.Dataset`), which are read by tiles in
+    :py:func:`speckleDisplacement`.
+    """
+
+    return isinstance(array, np.memmap) or not isinstance(array, np.ndarray)
+
+
+def _speckleDisplacementTiled(image, image_ref, stride,
+                              halfsubwidth, halfTemplateSize,
+                              subpixelResolution, tileSize, verbose,
+                              subpixelFit=None, progress=None,
+                              maxShift=None, mask=None, checkpoint=None):
+    """
+    Speckle tracking of images that do not fit in memory, like
+    :py:class:`numpy.memmap` or :py:class:`h5py.Dataset`. The grid is divided
+    in tiles of (approximately) ``tileSize x tileSize`` pixels, and only one
+    tile of each image, plus the halo of ``halfsubwidth`` pixels required by
+    the windows at the border, is read at a time. The results are written in
+    output arrays with the shape of the grid. See
+    :py:func:`_displacement_method2` for ``subpixelFit`` and
+    :py:func:`_displacement` for ``maxShift``. ``progress`` is called after
+    each tile with the number of tiles done. Only the windows where ``mask``
+    (with the shape of the grid) is ``True`` are calculated, and the tiles
+    without such windows are not read. Each tile is saved in ``checkpoint``
+    (a :py:class:`_Checkpoint`) when it is done.
+    """
+
+    print('MESSAGE: _speckleDisplacementTiled:')
+
+    irange, jrange = _speckle_grid(image.shape, halfsubwidth, stride)
+
+    sx = np.full((np.size(irange), np.size(jrange)), np.nan)
+    sy = np.full((np.size(irange), np.size(jrange)), np.nan)
+    error = np.full((np.size(irange), np.size(jrange)), np.nan)
+
+    npoints_tile = max(tileSize // stride, 1)
+
+    tiles = list(itertools.product(range(0, np.size(irange), npoints_tile),
+                                   range(0, np.size(jrange), npoints_tile)))
+
+    if verbose:
+        print('MESSAGE: %d tiles of %d x %d points' %
+              (len(tiles), npoints_tile, npoints_tile))
+
+    for ntiles_done, (ti, tj) in enumerate(tqdm(tiles), start=1):
+
+        tile_i = irange[ti:ti + npoints_tile]
+        tile_j = jrange[tj:tj + npoints_tile]
+
+        if mask is not None:
+            tile_mask = mask[ti:ti + npoints_tile, tj:tj + npoints_tile]
+
+            if not np.any(tile_mask):
+                if _cancelled(progress, ntiles_done, len(tiles)):
+                    break
+                continue
+
+        i0, i1 = tile_i[0] - halfsubwidth, tile_i[-1] + halfsubwidth + 1
+        j0, j1 = tile_j[0] - halfsubwidth, tile_j[-1] + halfsubwidth + 1
+
+        image_tile = np.asarray(image[i0:i1, j0:j1])
+        image_ref_tile = np.asarray(image_ref[i0:i1, j0:j1])
+
+        if halfTemplateSize is not None:
+            image_stats = _ncc_image_stats(image_tile, halfTemplateSize)
+        else:
+            image_stats = None
+
+        nrows = _rows_per_block(np.size(tile_j), halfsubwidth)
+
+        for k in range(0, np.size(tile_i), nrows):
+
+            ii, jj = np.meshgrid(tile_i[k:k + nrows] - i0, tile_j - j0,
+                                 indexing='ij')
+
+            rows = slice(ti + k, ti + k + ii.shape[0])
+            columns = slice(tj, tj + ii.shape[1])
+
+            if mask is None:
+                block_mask = Ellipsis  # all windows of the block
+            else:
+                block_mask = tile_mask[k:k + ii.shape[0]]
+                if not np.any(block_mask):
+                    continue
+
+            (sx[rows, columns][block_mask],
+             sy[rows, columns][block_mask],
+             error[rows, columns][block_mask]) = _displacement(
+                                                   image_tile, image_ref_tile,
+                                                   ii[block_mask],
+                                                   jj[block_mask],
+                                                   halfsubwidth,
+                                                   halfTemplateSize,
+                                                   subpixelResolution,
+                                                   image_stats=image_stats,
+                                                   subpixelFit=subpixelFit,
+                                                   maxShift=maxShift)
+
+        if checkpoint is not None:
+            checkpoint.save((sx, sy, error),
+                            np.s_[ti:ti + npoints_tile, tj:tj + npoints_tile])
+
+        if _cancelled(progress, ntiles_done, len(tiles)):
+            break
+
+    print(" ")
+
+    return (sx, sy, error, stride)
+
+
+def _speckleDisplacementModes(image, image_ref, stride, halfsubwidth,
+                              halfTemplateSize, subpixelResolution,
+                              pyramidLevels, halfsubwidthRefine, tileSize,
+                              adaptiveStride, errorThreshold,
+                              gradientThreshold, ncores, taskPerCore,
+                              backend, verbose, reference, subpixelFit,
+                              progress, maxShift, mask, checkpoint=None):
+    """
+    Speckle tracking with the mode (speckle vectors, pyramid, tiled,
+    adaptive or the ``backend`` of the uniform grid) selected by the
+    parameters of :py:func:`speckleDisplacement`, already validated.
+    """
+
+    if len(image.shape) == 3:
+
+        res = _speckleDisplacementVectors(image, image_ref,
+                                          stride=stride,
+                                          halfsubwidth=halfsubwidth,
+                                          halfTemplateSize=halfTemplateSize,
+                                          verbose=verbose,
+                                          subpixelFit=subpixelFit,
+                                          progress=progress,
+                                          maxShift=maxShift,
+                                          mask=mask)
+
+    elif pyramidLevels > 0:
+
+        if halfsubwidthRefine is None:
+            if subpixelResolution is not None:
+                halfsubwidthRefine = max(halfsubwidth >> pyramidLevels, 2)
+            else:
+                halfsubwidthRefine = halfTemplateSize + 2
+
+        res = _speckleDisplacementPyramid(image, image_ref,
+                                          stride=stride,
+                                          halfsubwidth=halfsubwidth,
+                                          halfTemplateSize=halfTemplateSize,
+                                          subpixelResolution=subpixelResolution,
+                                          pyramidLevels=pyramidLevels,
+                                          halfsubwidthRefine=halfsubwidthRefine,
+                                          ncores=ncores,
+                                          taskPerCore=taskPerCore,
+                                          backend=backend,
+                                          verbose=verbose,
+                                          subpixelFit=subpixelFit,
+                                          progress=progress,
+                                          maxShift=maxShift,
+                                          mask=mask)
+
+    elif (tileSize is not None or _is_out_of_core(image) or
+          _is_out_of_core(image_ref)):
+
+        if tileSize is None:
+            tileSize = 1024
+
+        res = _speckleDisplacementTiled(image, image_ref,
+                                        stride=stride,
+                                        halfsubwidth=halfsubwidth,
+                                        halfTemplateSize=halfTemplateSize,
+                                        subpixelResolution=subpixelResolution,
+                                        tileSize=tileSize,
+                                        verbose=verbose,
+                                        subpixelFit=subpixelFit,
+                                        progress=progress,
+                                        maxShift=maxShift,
+                                        mask=mask,
+                                        checkpoint=checkpoint)
+
+    elif adaptiveStride is not None:
+
+        res = _speckleDisplacementAdaptive(image, image_ref,
+                                           stride=stride,
+                                           halfsubwidth=halfsubwidth,
+                                           halfTemplateSize=halfTemplateSize,
+                                           subpixelResolution=subpixelResolution,
+                                           adaptiveStride=adaptiveStride,
+                                           errorThreshold=errorThreshold,
+                                           gradientThreshold=gradientThreshold,
+                                           ncores=ncores,
+                                           taskPerCore=taskPerCore,
+                                           backend=backend,
+                                           verbose=verbose,
+                                           reference=reference,
+                                           subpixelFit=subpixelFit,
+                                           progress=progress,
+                                           maxShift=maxShift,
+                                           mask=mask)
+
+    else:
+
+        res = _speckleDisplacementBackend(image, image_ref,
+                                          stride=stride,
+                                          halfsubwidth=halfsubwidth,
+                                          halfTemplateSize=halfTemplateSize,
+                                          subpixelResolution=subpixelResolution,
+                                          ncores=ncores,
+                                          taskPerCore=taskPerCore,
+                                          backend=backend,
+                                          verbose=verbose,
+                                          reference=reference,
+                                          subpixelFit=subpixelFit,
+                                          progress=progress,
+                                          maxShift=maxShift,
+                                          mask=mask,
+                                          checkpoint=checkpoint)
+
+    return res
+
+
 def speckleDisplacement(image, image_ref,
                         stride=1, npointsmax=None,
                         halfsubwidth=10, halfTemplateSize=None,
                         subpixelResolution=None,
                         ncores=1/2, taskPerCore=100,
-                        verbose=False):
+                        backend='shared_memory',
+                        pyramidLevels=0, halfsubwidthRefine=None,
+                        tileSize=None, subpixelFit=None,
+                        adaptiveStride=None, errorThreshold=None,
+                        gradientThreshold=0.5, maxShift=None,
+                        mask=None, maskFraction=None, checkpoint=None,
+                        callback=None, verbose=False):
     '''
     This function track the movements of speckle in an image (with sample)
     related to a reference image (whith no sample). The function relies in two
     other functions that you are advised to check:  `register_translation <http://scikit-image.org/docs/dev/auto_examples/transform/plot_register_translation.html>`_ and
     see `match_template <http://scikit-image.org/docs/dev/auto_examples/plot_template.html>`_
 
+    Parameters
+    ----------
+    image, image_ref : 2D ndarray
+        image with sample and reference image. ``image_ref`` can also be a
+        :py:class:`SpeckleReference`, with the precomputed quantities of the
+        reference image. In this case the values of ``halfsubwidth``,
+        ``stride``, ``halfTemplateSize``, ``subpixelResolution`` and
+        ``maxShift`` are the ones of the :py:class:`SpeckleReference`, and
+        ``npointsmax`` is ignored.
+
+        ``image`` and ``image_ref`` can also be 3D ndarrays with shape
+        ``(N, rows, cols)``, with ``N`` pairs of speckle images (for instance
+        for ``N`` positions of the diffuser). In this speckle vector tracking
+        mode, the normalized cross correlation is calculated between the
+        vectors formed by the pixels of the templates of all the ``N``
+        frames. As the vectors are unique even for very small templates, it
+        is possible to use ``halfTemplateSize`` of 1 or even 0 (one pixel
+        per frame) and ``halfsubwidth`` just larger than the maximum
+        displacement. It requires ``halfTemplateSize``, and it uses only one
+        core.
+
+    stride : int
+        distance in pixels between the centers of two neighbour windows.
+        With ``stride=1``, the register_translation method calculates the
+        FFT of each row segment of the images only once, and reuses it for
+        all the (overlapping) windows that contain it.
+
+    npointsmax : int
+        maximum number of points in the vertical direction. If necessary,
+        ``stride`` is increased to respect this value.
+
+    halfsubwidth : int
+        half size of the (square) sub image where the speckle is searched.
+
+    halfTemplateSize : int
+        half size of the template for the ``match_template`` method. With
+        the environment variable ``WAVEPY_NCC_KERNEL=numba`` (requires
+        `numba <http://numba.pydata.org>`_), the correlation of all windows
+        is calculated by a compiled kernel instead of the FFT, with the same
+        result. It is faster only for small templates or small
+        ``maxShift``.
+
+    subpixelResolution : int
+        upsample factor for the ``register_translation`` method.
+
+    ncores : float
+        fraction of the available cpu's to be used.
+
+    taskPerCore : int
+        number of tasks sent to each process.
+
+    backend : str
+        parallel backend used when more than one core is used:
+        ``'shared_memory'`` (default) copies the images only once to shared
+        memory, and the workers process blocks of rows writing directly in
+        shared output arrays. ``'threads'`` processes the blocks of rows with
+        a :py:class:`concurrent.futures.ThreadPoolExecutor` (the FFTs
+        release the GIL), without starting processes or copying the images,
+        and it also uses the cache of a :py:class:`SpeckleReference`.
+        ``'starmap'`` gives the images to each worker process once (with
+        the initializer of the :py:class:`multiprocessing.Pool`), and sends
+        chunks of windows with
+        :py:func:`multiprocessing.Pool.imap_unordered`. If
+        :py:mod:`multiprocessing.shared_memory` is not available (python <
+        3.8), ``'starmap'`` is used.
+
+        ``ncores``, ``taskPerCore`` and ``backend`` can be ``'auto'``, to use
+        the fastest values for the shape of the images and the parameters of
+        the windows in this machine, measured by
+        :py:func:`wavepy.tune.tune_speckleDisplacement` and stored in its
+        cache. The tuning is done in the first call without cached values.
+
+    pyramidLevels : int
+        number of levels of the coarse-to-fine (pyramid) mode. The images are
+        downsampled by ``2**pyramidLevels`` and the displacement is first
+        obtained with sub images of size ``halfsubwidth/2**pyramidLevels``
+        (same field of view of ``halfsubwidth``). The result is then refined
+        at each finer level, up to the full resolution, with small sub images
+        centered at the upsampled displacement of the previous level. The
+        default ``0`` disables the pyramid mode.
+
+    halfsubwidthRefine : int
+        half size of the sub images at the refinement levels of the pyramid
+        mode. The default is ``max(halfsubwidth//2**pyramidLevels, 2)`` for
+        the register_translation method and ``halfTemplateSize + 2`` (search
+        of +- 2 pixels around the estimate of the previous level) for the
+        match_template method.
+
+    tileSize : int
+        size in pixels of the tiles of the out-of-core mode, where the images
+        are read (and processed) by tiles. This mode is used when
+        ``tileSize`` is given or when ``image`` or ``image_ref`` are not in
+        memory, like :py:class:`numpy.memmap` or :py:class:`h5py.Dataset`
+        (default ``tileSize`` of 1024 pixels). The out-of-core mode uses only
+        one core, and it is not available with the pyramid mode.
+
+    subpixelFit : str
+        subpixel refinement of the integer displacement of the
+        match_template method. With ``'parabolic'`` a 2D quadratic function
+        is fitted to the 3x3 neighbourhood of the maximum of the normalized
+        cross correlation, and with ``'gaussian'`` the same fit is done with
+        its logarithm (gaussian peak). The fit of all windows is vectorized,
+        with negligible cost compared to the correlation. The default
+        ``None`` gives integer displacements.
+
+    adaptiveStride : int
+        enable the adaptive stride mode. The displacement is first obtained
+        in a coarse grid with ``adaptiveStride * stride`` pixels between the
+        windows, and interpolated to the grid given by ``stride``. Only the
+        windows in the cells of the coarse grid where ``error`` is larger
+        than ``errorThreshold`` or where the displacement changes by more
+        than ``gradientThreshold`` pixels are then calculated again. The
+        default ``None`` disables the adaptive mode.
+
+    errorThreshold : float
+        maximum error of the coarse grid in the adaptive stride mode. The
+        default ``None`` does not use the error.
+
+    gradientThreshold : float
+        maximum variation of the displacement (in pixels) between
+        neighbour points of the coarse grid in the adaptive stride mode.
+
+    maxShift : int
+        maximum displacement, in pixels, searched in each direction. For the
+        match_template method, the correlation is calculated only for these
+        shifts (the sub image is reduced to ``halfTemplateSize + maxShift``),
+        with cost that scales with ``maxShift`` instead of ``halfsubwidth``.
+        For the register_translation method, the FFT of the full sub image
+        is still required, and only the search of the maximum is limited,
+        avoiding false peaks. The grid of windows is still given by
+        ``halfsubwidth``. The default ``None`` searches all the shifts
+        allowed by ``halfsubwidth``.
+
+    mask : 2D ndarray
+        boolean array with the shape of the images, ``True`` inside of the
+        sample aperture. Only the windows with center inside of ``mask`` (or
+        with at least ``maskFraction`` of their pixels inside of ``mask``)
+        are calculated, and the result of the other windows is ``NaN``. The
+        multicore backends only send the windows (or blocks of rows) inside
+        of the mask to the workers.
+
+    maskFraction : float
+        minimum fraction (between 0 and 1) of the pixels of the sub image
+        (``2*halfsubwidth + 1`` pixels wide) inside of ``mask`` to calculate
+        a window. The default ``None`` uses only the center of the window.
+
+    checkpoint : str
+        name of a (HDF5) file where the result of each block of rows (or
+        tile, in the out-of-core mode) is saved as soon as it is calculated.
+        If the calculation is interrupted, a new call with the same images
+        and parameters reads the file and calculates only the windows that
+        were not done. If the file is from a different calculation, it is
+        overwritten. The file is kept at the end of the calculation. It can
+        not be used with stacks of images or with the pyramid or adaptive
+        modes, and with the ``'starmap'`` backend only one core is used.
+
+    callback : callable
+        function ``callback(done, total)`` called during the calculation
+        with its progress (in blocks of rows or tiles, or chunks of windows
+        with the ``'starmap'`` backend, for each pass of the pyramid and
+        adaptive modes), or a
+        :py:class:`wavepy.utils.ProgressCallback`. If it returns ``False``
+        (or if :py:meth:`wavepy.utils.ProgressCallback.cancel` is called),
+        the calculation is stopped and the partial result is returned, with
+        ``NaN`` where the windows were not calculated.
+
+    verbose : Boolean
+        verbose flag.
+
+    Returns
+    -------
+    sx, sy, error, stride
+        horizontal and vertical displacements, error of each window and the
+        stride actually used.
+
     References
     ----------
 
@@ -339,6 +3220,27 @@ def speckleDisplacement(image, image_ref,
     see http://scikit-image.org/docs/dev/auto_examples/features_detection/plot_template.html
     '''
 
+    reference = None
+
+    if isinstance(image_ref, SpeckleReference):
+
+        reference = image_ref
+        image_ref = reference.image_ref
+
+        if image.shape != reference.shape:
+            raise ValueError('wavepy: image and reference must have the ' +
+                             'same shape.')
+
+        if pyramidLevels > 0:
+            raise ValueError('wavepy: SpeckleReference can not be used ' +
+                             'with the pyramid mode.')
+
+        halfsubwidth = reference.halfsubwidth
+        stride = reference.stride
+        halfTemplateSize = reference.halfTemplateSize
+        subpixelResolution = reference.subpixelResolution
+        maxShift = reference.maxShift
+        npointsmax = None
 
     if halfTemplateSize is None and subpixelResolution is None:
         raise SyntaxError('Either value of halfTemplateSize or' + \
@@ -348,11 +3250,36 @@ def speckleDisplacement(image, image_ref,
         raise SyntaxError('wavepy: Either halfTemplateSize or' + \
                            ' subpixelResolution must be provided, but not both.')
 
+    if subpixelFit not in (None, 'parabolic', 'gaussian'):
+        raise ValueError('wavepy: subpixelFit must be None, ' +
+                         "'parabolic' or 'gaussian'.")
+
+    if subpixelFit is not None and halfTemplateSize is None:
+        raise SyntaxError('wavepy: subpixelFit can only be used with ' +
+                          'halfTemplateSize (match_template method).')
+
+    if maxShift is not None and maxShift < 0:
+        raise ValueError('wavepy: maxShift must be a non-negative integer.')
+
+    if len(image.shape) == 3:
+        if subpixelResolution is not None:
+            raise SyntaxError('wavepy: stacks of images require ' +
+                              'halfTemplateSize (match_template method).')
+
+        if tuple(image.shape) != tuple(image_ref.shape):
+            raise ValueError('wavepy: image and image_ref stacks must have ' +
+                             'the same shape.')
+
+        if (pyramidLevels > 0 or tileSize is not None or
+                adaptiveStride is not None):
+            raise ValueError('wavepy: stacks of images can not be used with ' +
+                             'the pyramid, out-of-core or adaptive modes.')
+
     if npointsmax is not None:
-        npoints = int((image.shape[0] - 2 * halfsubwidth) / stride)
+        npoints = int((image.shape[-2] - 2 * halfsubwidth) / stride)
         # DEBUG_print_var("npoints", npoints)
         if npoints > npointsmax:
-            stride = int((image.shape[0] - 2 * halfsubwidth) / npointsmax)
+            stride = int((image.shape[-2] - 2 * halfsubwidth) / npointsmax)
             # DEBUG_print_var("stride", stride)
         if stride <= 0: stride = 1  # note that this is not very precise
 
@@ -360,30 +3287,320 @@ def speckleDisplacement(image, image_ref,
         print('MESSAGE: speckleDisplacement:')
         print("MESSAGE: stride =  %d" % stride)
         print("MESSAGE: npoints =  %d" %
-                int((image.shape[0] - 2 * halfsubwidth) / stride))
+                int((image.shape[-2] - 2 * halfsubwidth) / stride))
+
+    if 'auto' in (str(ncores), str(taskPerCore), str(backend)):
+
+        if (len(image.shape) == 3 or tileSize is not None or
+                _is_out_of_core(image)):
+            # the vector tracking and out-of-core modes use only one core
+            tuned = {'ncores': 1/2, 'taskPerCore': 100,
+                     'backend': 'shared_memory'}
+        else:
+            # imported here, as wavepy.tune uses this module
+            import wavepy.tune as wptune
+
+            tuned = wptune.tuned_parameters(image.shape, halfsubwidth,
+                                            halfTemplateSize,
+                                            subpixelResolution, stride)
+            if tuned is None:
+                tuned = wptune.tune_speckleDisplacement(
+                                image.shape, halfsubwidth=halfsubwidth,
+                                halfTemplateSize=halfTemplateSize,
+                                subpixelResolution=subpixelResolution,
+                                stride=stride)
+
+        if str(ncores) == 'auto': ncores = tuned['ncores']
+        if str(taskPerCore) == 'auto': taskPerCore = tuned['taskPerCore']
+        if str(backend) == 'auto': backend = tuned['backend']
+
+        if verbose:
+            print('MESSAGE: ncores = %.3g, ' % ncores +
+                  'taskPerCore = %d, ' % taskPerCore +
+                  'backend = ' + backend)
 
     if ncores < 0 or ncores > 1: ncores = 1
 
-    if int(cpu_count() * ncores) <= 1:
+    if callback is None or isinstance(callback, wpu.ProgressCallback):
+        progress = callback
+    else:
+        progress = wpu.ProgressCallback(callback)
+
+    if mask is not None:
+        if tuple(np.shape(mask)) != tuple(image.shape[-2:]):
+            raise ValueError('wavepy: mask must have the same shape of ' +
+                             'the images.')
+
+        mask = _grid_mask(mask, _speckle_grid(image.shape[-2:],
+                                              halfsubwidth, stride),
+                          halfsubwidth, maskFraction)
+
+        if verbose:
+            print('MESSAGE: %d of %d windows inside of the mask' %
+                  (np.sum(mask), mask.size))
+
+    if pyramidLevels > 0 and tileSize is not None:
+        raise ValueError('wavepy: tileSize can not be used with the ' +
+                         'pyramid mode.')
+
+    if adaptiveStride is not None and (pyramidLevels > 0 or
+                                       tileSize is not None):
+        raise ValueError('wavepy: adaptiveStride can not be used with the ' +
+                         'pyramid or the out-of-core modes.')
+
+    if checkpoint is not None:
+
+        if (len(image.shape) == 3 or pyramidLevels > 0 or
+                adaptiveStride is not None):
+            raise ValueError('wavepy: checkpoint can not be used with ' +
+                             'stacks of images or with the pyramid or ' +
+                             'adaptive modes.')
+
+        grid = _speckle_grid(image.shape, halfsubwidth, stride)
+
+        key = _checkpoint_key(image, image_ref, mask,
+                              (halfsubwidth, stride, halfTemplateSize,
+                               subpixelResolution, subpixelFit, maxShift))
+
+        checkpoint = _Checkpoint(checkpoint, key,
+                                 (np.size(grid[0]), np.size(grid[1])))
+
+        # only the windows that are not in the checkpoint file
+        if mask is None:
+            mask = ~checkpoint.done
+        else:
+            mask = mask & ~checkpoint.done
+
+    parameters = dict(stride=stride,
+                      halfsubwidth=halfsubwidth,
+                      halfTemplateSize=halfTemplateSize,
+                      subpixelResolution=subpixelResolution,
+                      pyramidLevels=pyramidLevels,
+                      halfsubwidthRefine=halfsubwidthRefine,
+                      tileSize=tileSize,
+                      adaptiveStride=adaptiveStride,
+                      errorThreshold=errorThreshold,
+                      gradientThreshold=gradientThreshold,
+                      ncores=ncores,
+                      taskPerCore=taskPerCore,
+                      backend=backend,
+                      verbose=verbose,
+                      reference=reference,
+                      subpixelFit=subpixelFit,
+                      progress=progress,
+                      maxShift=maxShift,
+                      mask=mask)
+
+    if checkpoint is None:
+        return _speckleDisplacementModes(image, image_ref, **parameters)
+
+    # the file is closed even if the tracking is interrupted
+    with checkpoint:
+        res = _speckleDisplacementModes(image, image_ref,
+                                        checkpoint=checkpoint, **parameters)
+
+        return checkpoint.merge(res)
+
+
+def speckleDisplacementSequence(images, image_ref,
+                                stride=1, halfsubwidth=10,
+                                halfTemplateSize=None,
+                                subpixelResolution=None,
+                                halfsubwidthWarm=None, maxShiftWarm=2,
+                                errorTolerance=0.05, ncores=1/2, taskPerCore=100,
+                                backend='shared_memory',
+                                subpixelFit=None, maxShift=None,
+                                mask=None, maskFraction=None,
+                                callback=None, verbose=False):
+    '''
+    Speckle tracking of a sequence of images (for instance time-resolved
+    measurements) related to the same reference image. The first image is
+    tracked with the full search of :py:func:`speckleDisplacement`. For the
+    next images, the search is centered at the displacement of the previous
+    image, and limited to a few pixels around it: the match_template method
+    uses a small sub image of size ``halfsubwidthWarm``, and the
+    register_translation method uses the full sub image (so the precision
+    is the same of the full search) but searches the maximum of the cross
+    correlation only up to ``maxShiftWarm``. The full search is done again
+    only for the windows where the error increases by more than
+    ``errorTolerance`` compared with the previous image (or where the result
+    is ``NaN``).
+
+    Parameters
+    ----------
+    images : iterable of 2D ndarray
+        sequence of images with sample. It can be a 3D ndarray or a
+        generator (the images are read one at a time).
+
+    image_ref : 2D ndarray or :py:class:`SpeckleReference`
+        reference image. With a :py:class:`SpeckleReference`, the values of
+        ``halfsubwidth``, ``stride``, ``halfTemplateSize``,
+        ``subpixelResolution`` and ``maxShift`` are the ones of the
+        reference, and its cache is used by the full searches.
+
+    stride, halfsubwidth, halfTemplateSize, subpixelResolution :
+        see :py:func:`speckleDisplacement`.
+
+    halfsubwidthWarm : int
+        half size of the sub images of the warm started search of the
+        match_template method. The default is ``halfTemplateSize + 2``
+        (search of +- 2 pixels around the displacement of the previous
+        image).
+
+    maxShiftWarm : int
+        maximum displacement (in pixels) searched around the displacement
+        of the previous image in the warm started search of the
+        register_translation method. It is also limited by ``maxShift``.
+
+    errorTolerance : float
+        maximum increase of the error of a window, compared with the
+        previous image, before the full search is used.
+
+    ncores, taskPerCore, backend, subpixelFit, maxShift, mask,
+    maskFraction, verbose :
+        see :py:func:`speckleDisplacement`. ``maxShift`` is relative to the
+        center of the search, that is, to the displacement of the previous
+        image for the warm started searches. The same ``mask`` is used for
+        all images.
+
+    callback : callable
+        function ``callback(done, total)`` called after each image, with
+        ``total`` equal to ``len(images)`` (or ``None``), or a
+        :py:class:`wavepy.utils.ProgressCallback`. If it returns ``False``,
+        the sequence stops.
+
+    Yields
+    ------
+    sx, sy, error, stride
+        result of each image, see :py:func:`speckleDisplacement`.
+
+    Example
+    -------
+
+    >>> for sx, sy, error, stride in speckleDisplacementSequence(
+    ...         images, image_ref, stride=2, halfsubwidth=20,
+    ...         halfTemplateSize=5):
+    ...     results.append((sx, sy))
 
-        res = _speckleDisplacementSingleCore(image, image_ref,
-                                             stride=stride,
-                                             halfsubwidth=halfsubwidth,
-                                             halfTemplateSize=halfTemplateSize,
-                                             subpixelResolution=subpixelResolution,
-                                             verbose=verbose)
+    '''
+
+    reference = None
+
+    if isinstance(image_ref, SpeckleReference):
+        reference = image_ref
+        image_ref = reference.image_ref
+        halfsubwidth = reference.halfsubwidth
+        stride = reference.stride
+        halfTemplateSize = reference.halfTemplateSize
+        subpixelResolution = reference.subpixelResolution
+        maxShift = reference.maxShift
+
+    if halfTemplateSize is None and subpixelResolution is None:
+        raise SyntaxError('Either value of halfTemplateSize or' + \
+                           ' subpixelResolution must be provided.')
 
+    if halfTemplateSize is not None and subpixelResolution is not None:
+        raise SyntaxError('wavepy: Either halfTemplateSize or' + \
+                           ' subpixelResolution must be provided, but not both.')
 
+    if halfsubwidthWarm is None and halfTemplateSize is not None:
+        halfsubwidthWarm = halfTemplateSize + 2
 
+    if ncores < 0 or ncores > 1: ncores = 1
 
+    if callback is None or isinstance(callback, wpu.ProgressCallback):
+        progress = callback
     else:
+        progress = wpu.ProgressCallback(callback)
+
+    try:
+        nimages = len(images)
+    except TypeError:  # generators
+        nimages = None
+
+    grid = _speckle_grid(np.shape(image_ref), halfsubwidth, stride)
+
+    if mask is not None:
+        if tuple(np.shape(mask)) != tuple(np.shape(image_ref)):
+            raise ValueError('wavepy: mask must have the same shape of ' +
+                             'the images.')
+
+        mask = _grid_mask(mask, grid, halfsubwidth, maskFraction)
+
+    parameters = dict(stride=stride,
+                      halfTemplateSize=halfTemplateSize,
+                      subpixelResolution=subpixelResolution,
+                      ncores=ncores,
+                      taskPerCore=taskPerCore,
+                      backend=backend,
+                      verbose=verbose,
+                      grid=grid,
+                      subpixelFit=subpixelFit,
+                      maxShift=maxShift)
+
+    # parameters of the warm started search
+    if subpixelResolution is not None:
+        if maxShift is not None:
+            maxShiftWarm = min(maxShift, maxShiftWarm)
+        warm = dict(parameters, halfsubwidth=halfsubwidth,
+                    maxShift=maxShiftWarm)
+    else:
+        warm = dict(parameters, halfsubwidth=halfsubwidthWarm)
 
-        res = _speckleDisplacementMulticore(image, image_ref,
-                                            stride=stride,
-                                            halfsubwidth=halfsubwidth,
-                                            halfTemplateSize=halfTemplateSize,
-                                            subpixelResolution=subpixelResolution,
-                                            ncores=ncores, taskPerCore=taskPerCore,
-                                            verbose=verbose)
+    previous = None
 
-    return res
+    for n, image in enumerate(images):
+
+        if previous is None:
+            (sx, sy, error, _) = _speckleDisplacementBackend(
+                                    image, image_ref,
+                                    halfsubwidth=halfsubwidth,
+                                    reference=reference,
+                                    mask=mask,
+                                    **parameters)
+
+        else:
+            (sx_prev, sy_prev, error_prev) = previous
+
+            offsets = (np.round(np.nan_to_num(sy_prev)).astype(int),
+                       np.round(np.nan_to_num(sx_prev)).astype(int))
+
+            (sx, sy, error, _) = _speckleDisplacementBackend(
+                                    image, image_ref,
+                                    offsets=offsets,
+                                    mask=mask,
+                                    **warm)
+
+            # full search where the warm started search is worse
+            full = ~(error <= error_prev + errorTolerance)
+
+            if mask is not None:
+                full &= mask
+
+            if verbose:
+                print('MESSAGE: speckleDisplacementSequence: image ' +
+                      '%d, full search of %d windows' % (n, np.sum(full)))
+
+            if np.any(full):
+                (sx_full,
+                 sy_full,
+                 error_full, _) = _speckleDisplacementBackend(
+                                    image, image_ref,
+                                    halfsubwidth=halfsubwidth,
+                                    reference=reference,
+                                    mask=full,
+                                    **parameters)
+
+                # keep the best of both searches
+                full &= ~(error_full >= error)
+
+                sx[full] = sx_full[full]
+                sy[full] = sy_full[full]
+                error[full] = error_full[full]
+
+        previous = (sx, sy, error)
+
+        yield (sx, sy, error, stride)
+
+        if _cancelled(progress, n + 1, nimages):
+            return
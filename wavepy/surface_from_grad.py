@@ -296,7 +296,7 @@ def frankotchellappa(del_f_del_x, del_f_del_y, reflec_pad=True):
 
     """
 
-    from numpy.fft import fft2, ifft2, fftfreq
+    from wavepy.fft import fft2, ifft2, fftfreq
 
     if reflec_pad:
         del_f_del_x, del_f_del_y = _reflec_pad_grad_fields(del_f_del_x,
@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# #########################################################################
+# Copyright (c) 2015, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2015. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+
+"""
+Autotuner of the parallel parameters of the speckle tracking.
+
+The best values of ``ncores``, ``taskPerCore`` and ``backend`` of
+:py:func:`wavepy.speckletracking.speckleDisplacement` depend on the size of
+the images and of the windows, and on the machine. The functions of this
+module measure the speed of all combinations of these parameters with
+synthetic speckle images, and store the fastest one in a cache file, keyed
+by the shape of the images, the parameters of the windows and the cpu. The
+cache is in the directory given by the environment variable
+``WAVEPY_CACHE_DIR``, or ``~/.cache/wavepy``.
+
+When ``speckleDisplacement`` is called with ``ncores``, ``taskPerCore`` or
+``backend`` equal to ``'auto'``, the cached values are used, and the tuning
+is done (only once) if there is no cached value for these parameters.
+
+Example
+-------
+
+>>> import wavepy.tune as wptune
+>>> wptune.tune_speckleDisplacement((2048, 2048), halfsubwidth=10,
+...                                 halfTemplateSize=4, stride=2)
+>>> sx, sy, error, stride = speckleDisplacement(image, image_ref,
+...                                             halfsubwidth=10,
+...                                             halfTemplateSize=4, stride=2,
+...                                             ncores='auto',
+...                                             taskPerCore='auto',
+...                                             backend='auto')
+
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import itertools
+import json
+import os
+import platform
+import time
+
+import numpy as np
+
+import wavepy.utils as wpu
+
+
+__authors__ = "Walan Grizolli"
+__copyright__ = "Copyright (c) 2016-2017, Argonne National Laboratory"
+__version__ = "0.1.0"
+__docformat__ = "restructuredtext en"
+__all__ = ['cache_file', 'clear_cache', 'tune_speckleDisplacement',
+           'tuned_parameters']
+
+
+_CACHE_NAME = 'tune.json'
+
+
+def cache_file():
+    '''
+    Name of the file with the cached results of the tuning.
+    '''
+
+    cache_dir = os.environ.get('WAVEPY_CACHE_DIR',
+                               os.path.join(os.path.expanduser('~'),
+                                            '.cache', 'wavepy'))
+
+    return os.path.join(cache_dir, _CACHE_NAME)
+
+
+def _cpu_id():
+    """
+    Identification of the processor of this machine: model name and number
+    of cpu's.
+    """
+
+    model = platform.processor() or platform.machine()
+
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    model = line.split(':', 1)[1].strip()
+                    break
+    except (IOError, OSError):
+        pass
+
+    return '{} ({} cpus)'.format(model, os.cpu_count())
+
+
+def _cache_key(shape, halfsubwidth, halfTemplateSize, subpixelResolution,
+               stride):
+    """
+    Key of the cache for the tracking of images with ``shape`` in this cpu.
+    """
+
+    return '{}x{}|halfsubwidth={}|halfTemplateSize={}|'.format(
+                shape[0], shape[1], halfsubwidth, halfTemplateSize) + \
+           'subpixelResolution={}|stride={}|{}'.format(
+                subpixelResolution, stride, _cpu_id())
+
+
+def _load_cache():
+
+    try:
+        with open(cache_file()) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _save_cache(cache):
+    """
+    Write ``cache`` in a temporary file that replaces the cache file, so the
+    cache file is never partially written.
+    """
+
+    fname = cache_file()
+
+    if not os.path.isdir(os.path.dirname(fname)):
+        os.makedirs(os.path.dirname(fname))
+
+    tmp_fname = fname + '.{}.tmp'.format(os.getpid())
+
+    with open(tmp_fname, 'w') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+
+    os.replace(tmp_fname, fname)
+
+
+def clear_cache():
+    '''
+    Remove all the cached results of the tuning.
+    '''
+
+    if os.path.exists(cache_file()):
+        os.remove(cache_file())
+
+
+def tuned_parameters(shape, halfsubwidth=10, halfTemplateSize=None,
+                     subpixelResolution=None, stride=1):
+    '''
+    Cached result of :py:func:`tune_speckleDisplacement` for images with
+    ``shape`` and the given parameters of the windows, in this cpu.
+
+    Returns
+    -------
+    dict or None
+        dictionary with ``ncores``, ``taskPerCore`` and ``backend``, or
+        ``None`` if these parameters were not tuned.
+    '''
+
+    key = _cache_key(shape, halfsubwidth, halfTemplateSize,
+                     subpixelResolution, stride)
+
+    return _load_cache().get(key)
+
+
+def tune_speckleDisplacement(shape, halfsubwidth=10, halfTemplateSize=None,
+                             subpixelResolution=None, stride=1,
+                             ncores=None, taskPerCore=(1, 4, 16, 100),
+                             backends=('shared_memory', 'threads'),
+                             sampleWindows=20000, repeat=2, cache=True,
+                             verbose=False):
+    '''
+    Find the fastest ``ncores``, ``taskPerCore`` and ``backend`` of
+    :py:func:`wavepy.speckletracking.speckleDisplacement` for images with
+    ``shape``, by tracking synthetic speckle images (see
+    :py:func:`wavepy.speckle_benchmark.synthetic_speckle`) with all their
+    combinations.
+
+    To keep the tuning short, the synthetic images have the width of
+    ``shape``, but only the number of rows required for about
+    ``sampleWindows`` windows. ``taskPerCore`` is scaled by the fraction of
+    rows of the sample, so each task has the same size as in the full image.
+
+    Parameters
+    ----------
+    shape : tuple
+        shape of the images.
+
+    halfsubwidth, halfTemplateSize, subpixelResolution, stride :
+        parameters of the tracking, see
+        :py:func:`wavepy.speckletracking.speckleDisplacement`.
+
+    ncores : list of float
+        fractions of the cpu's to be tested. The default tests one cpu, half
+        and all of the cpu's.
+
+    taskPerCore : list of int
+        number of tasks per core to be tested.
+
+    backends : list of str
+        multicore backends to be tested.
+
+    sampleWindows : int
+        approximated number of windows of the synthetic images.
+
+    repeat : int
+        number of times each combination is tracked (at least 2). The speed
+        is the best of all runs, so the first (cold) run, which also
+        includes the start of the processes, the imports and the
+        compilation of the kernels, does not penalise any combination.
+
+    cache : bool
+        save the result in the cache file, see :py:func:`cache_file`.
+
+    verbose : bool
+        print the speed of each combination.
+
+    Returns
+    -------
+    dict
+        ``ncores``, ``taskPerCore``, ``backend`` and the speed
+        ``windows_per_s`` of the fastest combination.
+    '''
+
+    # imported here, as speckletracking uses this module for 'auto'
+    import wavepy.speckletracking as wpst
+    from wavepy.speckle_benchmark import synthetic_speckle
+
+    ncpus = wpst.cpu_count()
+
+    if ncores is None:
+        ncores = [1 / ncpus, 0.5, 1.0]
+
+    # as in speckleDisplacement, ncores is a fraction of the cpu's
+    ncores = sorted(set(min(max(value, 0), 1) for value in ncores))
+
+    irange, jrange = wpst._speckle_grid(shape, halfsubwidth, stride)
+
+    nrows_grid = max(np.size(irange), 1)
+    nrows_sample = min(-(-sampleWindows // max(np.size(jrange), 1)),
+                       nrows_grid)
+    fraction = nrows_sample / nrows_grid
+
+    sample_shape = (min((nrows_sample - 1) * stride + 2 * halfsubwidth + 1,
+                        shape[0]), shape[1])
+
+    image, image_ref, _, _ = synthetic_speckle(sample_shape, seed=0)
+
+    wpu.print_blue('MESSAGE: tuning speckleDisplacement for shape ' +
+                   '{}x{} with a sample of {}x{} pixels'.format(
+                        shape[0], shape[1], *sample_shape))
+
+    candidates = []
+    for fraction_cores in ncores:
+        if int(ncpus * fraction_cores) <= 1:
+            # single core: taskPerCore and backend are not used
+            if not any(int(ncpus * c[0]) <= 1 for c in candidates):
+                candidates.append((fraction_cores, taskPerCore[0],
+                                   backends[0]))
+        else:
+            candidates += [(fraction_cores, tpc, backend)
+                           for tpc, backend in itertools.product(taskPerCore,
+                                                                 backends)]
+
+    best = None
+
+    for fraction_cores, tpc, backend in candidates:
+
+        elapsed = np.inf
+
+        for _ in range(max(repeat, 2)):
+
+            t0 = time.perf_counter()
+
+            sx, _, _, _ = wpst.speckleDisplacement(
+                            image, image_ref,
+                            stride=stride,
+                            halfsubwidth=halfsubwidth,
+                            halfTemplateSize=halfTemplateSize,
+                            subpixelResolution=subpixelResolution,
+                            ncores=fraction_cores,
+                            taskPerCore=max(int(round(tpc * fraction)), 1),
+                            backend=backend,
+                            verbose=False)
+
+            elapsed = min(elapsed, time.perf_counter() - t0)
+
+        windows_per_s = sx.size / elapsed
+
+        if verbose:
+            print('MESSAGE: ncores={:.3g}, taskPerCore={}, '.format(
+                        fraction_cores, tpc) +
+                  'backend={}: {:.4g} windows/s'.format(backend,
+                                                        windows_per_s))
+
+        if best is None or windows_per_s > best['windows_per_s']:
+            best = {'ncores': fraction_cores, 'taskPerCore': tpc,
+                    'backend': backend, 'windows_per_s': windows_per_s}
+
+    best['date'] = wpu.datetime_now_str()
+
+    wpu.print_blue('MESSAGE: fastest: ncores={:.3g}, '.format(best['ncores']) +
+                   'taskPerCore={}, backend={}'.format(best['taskPerCore'],
+                                                       best['backend']))
+
+    if cache:
+        key = _cache_key(shape, halfsubwidth, halfTemplateSize,
+                         subpixelResolution, stride)
+        cache_content = _load_cache()
+        cache_content[key] = best
+        _save_cache(cache_content)
+
+    return best
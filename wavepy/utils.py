@@ -52,6 +52,7 @@ Utility functions to help.
 from __future__ import (print_function)
 
 import numpy as np
+import wavepy.fft as wpfft
 from scipy import constants
 
 
@@ -87,7 +88,8 @@ __all__ = ['print_color', 'print_red', 'print_blue', 'plot_profile',
            'realcoordvec', 'realcoordmatrix_fromvec', 'realcoordmatrix',
            'reciprocalcoordvec', 'reciprocalcoordmatrix',
            'h5_list_of_groups',
-           'progress_bar4pmap', 'load_ini_file', 'rocking_3d_figure']
+           'ProgressCallback', 'progress_bar4pmap', 'load_ini_file',
+           'rocking_3d_figure']
 
 
 hc = constants.value('inverse meter-electron volt relationship')  # hc
@@ -2543,20 +2545,80 @@ def h5_list_of_groups(h5file):
 # Progress bar
 
 
-def progress_bar4pmap(res, sleep_time=1.0):
+class ProgressCallback(object):
+    """
+    Progress report and cancellation of long calculations.
+
+    The calculation calls the instance with the amount of work ``done`` and
+    the ``total``, which are passed to the user function ``callback``. If
+    ``callback`` returns ``False``, or if :py:meth:`cancel` is called (for
+    instance from another thread, like a GUI), the calculation is stopped
+    cleanly and returns partial results.
+
+    Parameters
+    ----------
+    callback : callable
+        function ``callback(done, total)``. Any return value other than
+        ``False`` continues the calculation.
+
+    Example
+    -------
+
+    >>> def callback(done, total):
+    ...     print('%d of %d' % (done, total))
+    ...     return not stop_button_pressed
+    >>> progress = ProgressCallback(callback)
+    >>> sx, sy, error, stride = speckleDisplacement(image, image_ref,
+    ...                                             halfTemplateSize=4,
+    ...                                             callback=progress)
+    >>> progress.cancelled
+
+    """
+
+    def __init__(self, callback=None):
+
+        self.callback = callback
+        self.cancelled = False
+
+    def cancel(self):
+        """Ask the calculation to stop."""
+        self.cancelled = True
+
+    def __call__(self, done, total):
+        """
+        Report the progress. Returns ``False`` if the calculation must stop.
+        """
+
+        if not self.cancelled and self.callback is not None:
+            if self.callback(done, total) is False:
+                self.cancelled = True
+
+        return not self.cancelled
+
+
+def progress_bar4pmap(res, sleep_time=1.0, callback=None):
     """
     Progress bar from :py:mod:`tqdm` to be used with the function
     :py:func:`multiprocessing.starmap_async`.
 
-    It holds the program in a loop waiting
-    :py:func:`multiprocessing.starmap_async` to finish
+    It holds the program waiting :py:func:`multiprocessing.starmap_async` to
+    finish, and returns as soon as the result is ready.
 
 
     Parameters
     ----------
 
     res: result object of the :py:class:`multiprocessing.Pool` class
-    sleep_time:
+    sleep_time: maximum time (in seconds) between updates of the progress bar
+    callback: function ``callback(done, total)`` or
+        :py:class:`ProgressCallback`, called at each update with the number
+        of chunks of tasks. If it returns ``False``, stops waiting.
+
+    Return
+    ------
+    bool
+        ``False`` if the wait was cancelled by ``callback``. In this case the
+        pool should be terminated by the caller.
 
 
     Example
@@ -2570,18 +2632,32 @@ def progress_bar4pmap(res, sleep_time=1.0):
 
     """
 
-    old_res_n_left = res._number_left
-    pbar = tqdm(total=old_res_n_left)
+    if not isinstance(callback, ProgressCallback):
+        callback = ProgressCallback(callback)
+
+    total = res._number_left
+    old_res_n_left = total
+    pbar = tqdm(total=total)
+
+    while not res.ready():
+        res.wait(sleep_time)  # returns when the result is ready
 
-    while res._number_left > 0:
         if old_res_n_left != res._number_left:
             pbar.update(old_res_n_left - res._number_left)
             old_res_n_left = res._number_left
-        time.sleep(sleep_time)
 
+        if not callback(total - old_res_n_left, total):
+            pbar.close()
+            return False
+
+    pbar.update(old_res_n_left)
     pbar.close()
     print('')
 
+    callback(total, total)
+
+    return True
+
 
 def load_ini_file_terminal_dialog(inifname):
     """
@@ -2921,12 +2997,12 @@ def fourier_spline_1d(vec1d, n=2):
     # reflec pad to avoid discontinuity at the edges
     pad_vec1d = np.pad(vec1d, (0, vec1d.shape[0]), 'reflect')
 
-    fftvec = np.fft.fftshift(np.fft.fft(pad_vec1d))
+    fftvec = wpfft.fftshift(wpfft.fft(pad_vec1d))
 
     fftvec = np.pad(fftvec, pad_width=fftvec.shape[0]*(n-1)//2,
                     mode='constant', constant_values=0.0)
 
-    res = np.fft.ifft(np.fft.ifftshift(fftvec))*n
+    res = wpfft.ifft(wpfft.ifftshift(fftvec))*n
 
     return res[0:res.shape[0]//2]
 
@@ -2942,7 +3018,7 @@ def fourier_spline_2d_axis(array, n=2, axis=0):
 
     pad_array = np.pad(array, pad_width=padwidth, mode='reflect')
 
-    fftvec = np.fft.fftshift(np.fft.fft(pad_array, axis=axis), axes=axis)
+    fftvec = wpfft.fftshift(wpfft.fft(pad_array, axis=axis), axes=axis)
 
     listpad = [(0, 0), (0, 0)]
 
@@ -2956,7 +3032,7 @@ def fourier_spline_2d_axis(array, n=2, axis=0):
     fftvec = np.pad(fftvec, pad_width=listpad,
                     mode='constant', constant_values=0.0)
 
-    res = np.fft.ifft(np.fft.ifftshift(fftvec, axes=axis), axis=axis)*n
+    res = wpfft.ifft(wpfft.ifftshift(fftvec, axes=axis), axis=axis)*n
     res = np.real(res)
 
     if axis == 0: